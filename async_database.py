@@ -0,0 +1,239 @@
+import asyncio
+import functools
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Optional, List, Union
+
+from database import Database
+from models import Broadcast, User, Subscription, Payment, ExpiredSubscription, RenewalCandidate
+from sharded_database import ShardedDatabase
+
+
+class AsyncDatabase:
+    """Асинхронная обертка над Database: запросы выполняются в отдельном пуле потоков БД,
+    поэтому дисковый ввод-вывод никогда не блокирует цикл событий бота"""
+
+    def __init__(self, db: Union[Database, ShardedDatabase], max_workers: Optional[int] = None):
+        self.db = db
+        # Потоков не больше, чем соединений в пуле, иначе они будут ждать друг друга
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or db.pool_size,
+            thread_name_prefix="db"
+        )
+        # Подписчики на изменения подписок: callback(user_id, end_date или None при деактивации)
+        self._subscription_listeners: List[Callable[[int, Optional[int]], None]] = []
+        self.logger = logging.getLogger(__name__)
+
+    async def _run(self, func, *args, **kwargs):
+        """Выполнение синхронного метода Database в потоке БД"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _iterate(self, func, *args, chunk_size: int = 500) -> AsyncIterator:
+        """Ленивый обход выборки: строки читаются с курсора пачками в потоке БД"""
+        loop = asyncio.get_running_loop()
+        iterator = iter(func(*args))
+        try:
+            while True:
+                chunk = await loop.run_in_executor(
+                    self._executor, lambda: list(itertools.islice(iterator, chunk_size))
+                )
+                if not chunk:
+                    break
+                for item in chunk:
+                    yield item
+        finally:
+            # Закрываем генератор, чтобы вернуть соединение в пул
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self._executor, close)
+
+    def add_subscription_listener(self, listener: Callable[[int, Optional[int]], None]):
+        """Подписка на создание/деактивацию подписок (вызывается в цикле событий)"""
+        self._subscription_listeners.append(listener)
+
+    def _notify_subscription_changed(self, user_id: int, end_date: Optional[int]):
+        """Оповещение подписчиков об изменении подписки пользователя"""
+        for listener in self._subscription_listeners:
+            try:
+                listener(user_id, end_date)
+            except Exception as e:
+                self.logger.error(f"Ошибка обработчика изменения подписки: {e}")
+
+    async def close(self):
+        """Дожидается завершения запросов и закрывает соединения"""
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown, True)
+        self.db.close()
+
+    async def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        """Добавление пользователя"""
+        return await self._run(self.db.add_user, user_id, username, first_name, last_name)
+
+    async def upsert_users(self, users: List[tuple]):
+        """Пакетное добавление/обновление пользователей"""
+        return await self._run(self.db.upsert_users, users)
+
+    async def get_user(self, user_id: int) -> Optional[User]:
+        """Получение профиля пользователя"""
+        return await self._run(self.db.get_user, user_id)
+
+    async def create_subscription(self, user_id: int, payment_id: str, amount: int = 100000):
+        """Создание подписки (amount в копейках, 100000 = 1000 рублей), возвращает end_date"""
+        end_date = await self._run(self.db.create_subscription, user_id, payment_id, amount)
+        self._notify_subscription_changed(user_id, end_date)
+        return end_date
+
+    async def get_user_subscription(self, user_id: int) -> Optional[Subscription]:
+        """Получение активной подписки пользователя"""
+        return await self._run(self.db.get_user_subscription, user_id)
+
+    async def deactivate_subscription(self, user_id: int):
+        """Деактивация подписки"""
+        await self._run(self.db.deactivate_subscription, user_id)
+        self._notify_subscription_changed(user_id, None)
+
+    def cache_stats(self) -> dict:
+        """Статистика кэша подписок (без обращения к диску)"""
+        return self.db.cache_stats()
+
+    def iter_expired_subscriptions(self) -> AsyncIterator[Subscription]:
+        """Истекшие, но еще активные подписки (ленивый обход)"""
+        return self._iterate(self.db.iter_expired_subscriptions)
+
+    def iter_subscription_deadlines(self, until: int) -> AsyncIterator[tuple]:
+        """Дедлайны активных подписок, истекающих не позже until (ленивый обход)"""
+        return self._iterate(self.db.iter_subscription_deadlines, until)
+
+    async def claim_expired_subscriptions(self, batch_size: int = 500) -> List[ExpiredSubscription]:
+        """Захват пачки истекших подписок"""
+        return await self._run(self.db.claim_expired_subscriptions, batch_size)
+
+    async def finish_expired_subscriptions(self, expired_subscriptions: List[ExpiredSubscription]):
+        """Окончательная деактивация захваченных подписок"""
+        return await self._run(self.db.finish_expired_subscriptions, expired_subscriptions)
+
+    async def release_expiring_subscriptions(self, expired_subscriptions: Optional[List[ExpiredSubscription]] = None) -> int:
+        """Возврат захваченных подписок (переданных или всех) в очередь на обработку"""
+        return await self._run(self.db.release_expiring_subscriptions, expired_subscriptions)
+
+    async def add_payment(self, user_id: int, payment_id: str, amount: int, status: str = 'pending',
+                          confirmation_url: Optional[str] = None, idempotency_key: Optional[str] = None):
+        """Добавление записи о платеже"""
+        return await self._run(
+            self.db.add_payment, user_id, payment_id, amount, status, confirmation_url, idempotency_key
+        )
+
+    async def find_open_payment(self, user_id: int, amount: int, created_after: int) -> Optional[Payment]:
+        """Последний ожидающий оплаты счет пользователя на эту сумму"""
+        return await self._run(self.db.find_open_payment, user_id, amount, created_after)
+
+    async def reserve_payment_key(self, user_id: int, amount: int, created_after: int, new_key: str) -> str:
+        """Ключ идемпотентности для нового счета (записывается до обращения к провайдеру)"""
+        return await self._run(self.db.reserve_payment_key, user_id, amount, created_after, new_key)
+
+    async def get_payment_by_key(self, user_id: int, idempotency_key: str) -> Optional[Payment]:
+        """Платеж пользователя (или резерв без payment_id) по ключу идемпотентности"""
+        return await self._run(self.db.get_payment_by_key, user_id, idempotency_key)
+
+    async def get_invoice_number(self, user_id: int, idempotency_key: str) -> int:
+        """Номер счета для ключа идемпотентности (один и тот же при повторах)"""
+        return await self._run(self.db.get_invoice_number, user_id, idempotency_key)
+
+    async def attach_payment(self, user_id: int, idempotency_key: str, payment_id: str,
+                             confirmation_url: Optional[str] = None) -> bool:
+        """Привязка созданного провайдером платежа к ключу идемпотентности"""
+        return await self._run(self.db.attach_payment, user_id, idempotency_key, payment_id, confirmation_url)
+
+    async def cancel_payment_key(self, user_id: int, idempotency_key: str) -> int:
+        """Отмена неоплаченного платежа (или резерва) с этим ключом идемпотентности"""
+        return await self._run(self.db.cancel_payment_key, user_id, idempotency_key)
+
+    async def get_payment(self, payment_id: str) -> Optional[Payment]:
+        """Получение платежа по идентификатору платежной системы"""
+        return await self._run(self.db.get_payment, payment_id)
+
+    async def update_payment_status(self, payment_id: str, status: str) -> bool:
+        """Обновление статуса платежа"""
+        return await self._run(self.db.update_payment_status, payment_id, status)
+
+    async def activate_payment(self, payment_id: str) -> Optional[Subscription]:
+        """Перевод платежа в 'paid' и создание или продление подписки (ровно один раз)"""
+        subscription = await self._run(self.db.activate_payment, payment_id)
+        if subscription is not None:
+            self._notify_subscription_changed(subscription.user_id, subscription.end_date)
+        return subscription
+
+    async def save_payment_method(self, user_id: int, payment_method_id: str):
+        """Сохранение способа оплаты пользователя для автопродления"""
+        return await self._run(self.db.save_payment_method, user_id, payment_method_id)
+
+    async def delete_payment_method(self, user_id: int):
+        """Удаление сохраненного способа оплаты"""
+        return await self._run(self.db.delete_payment_method, user_id)
+
+    async def claim_renewals(self, until: int, limit: int, max_attempts: int,
+                             lease: int = 900) -> List[RenewalCandidate]:
+        """Захват подписок, которым пора автопродление"""
+        return await self._run(self.db.claim_renewals, until, limit, max_attempts, lease)
+
+    async def schedule_renewal(self, user_id: int, subscription_id: int, attempts: int, next_renewal_at: int):
+        """Назначение следующей попытки автопродления"""
+        return await self._run(self.db.schedule_renewal, user_id, subscription_id, attempts, next_renewal_at)
+
+    async def claim_pending_payments(self, limit: int, lease: int = 300) -> List[Payment]:
+        """Захват ожидающих платежей для проверки у провайдера"""
+        return await self._run(self.db.claim_pending_payments, limit, lease)
+
+    async def reschedule_payment_check(self, payment_id: str, next_check_at: int):
+        """Назначение следующей проверки ожидающего платежа"""
+        return await self._run(self.db.reschedule_payment_check, payment_id, next_check_at)
+
+    async def expire_stale_payments(self, created_before: int) -> int:
+        """Перевод давно ожидающих платежей в 'expired'"""
+        return await self._run(self.db.expire_stale_payments, created_before)
+
+    async def archive_history(self, before: int, batch_size: int = 500) -> dict:
+        """Перенос пачки старой истории в архивную БД"""
+        return await self._run(self.db.archive_history, before, batch_size)
+
+    async def get_user_history(self, user_id: int) -> dict:
+        """История платежей и подписок пользователя, включая архивную"""
+        return await self._run(self.db.get_user_history, user_id)
+
+    async def create_broadcast(self, text: str, audience: str) -> int:
+        """Создание рассылки"""
+        return await self._run(self.db.create_broadcast, text, audience)
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Broadcast]:
+        """Рассылка по id"""
+        return await self._run(self.db.get_broadcast, broadcast_id)
+
+    async def get_unfinished_broadcasts(self) -> List[Broadcast]:
+        """Незавершенные рассылки в порядке создания"""
+        return await self._run(self.db.get_unfinished_broadcasts)
+
+    async def get_broadcast_recipients(self, broadcast_id: int, audience: str,
+                                       after_user_id: int, limit: int) -> List[int]:
+        """Следующая страница еще не обработанных получателей рассылки"""
+        return await self._run(self.db.get_broadcast_recipients, broadcast_id, audience, after_user_id, limit)
+
+    async def count_broadcast_recipients(self, broadcast_id: int, audience: str) -> int:
+        """Сколько получателей рассылки еще не обработано"""
+        return await self._run(self.db.count_broadcast_recipients, broadcast_id, audience)
+
+    async def record_broadcast_deliveries(self, broadcast_id: int, deliveries: List[tuple]):
+        """Отметки об обработке получателей пачкой"""
+        return await self._run(self.db.record_broadcast_deliveries, broadcast_id, deliveries)
+
+    async def get_broadcast_stats(self, broadcast_id: int) -> dict:
+        """Число обработанных получателей рассылки по статусам"""
+        return await self._run(self.db.get_broadcast_stats, broadcast_id)
+
+    async def finish_broadcast(self, broadcast_id: int):
+        """Отметка о завершении рассылки"""
+        return await self._run(self.db.finish_broadcast, broadcast_id)
+
+    async def get_report(self) -> dict:
+        """Сводка для отчетов"""
+        return await self._run(self.db.get_report)
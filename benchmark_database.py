@@ -0,0 +1,276 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from database import Database
+from sharded_database import ShardedDatabase
+
+DAY = 86400
+
+
+def percentile(samples: list, fraction: float) -> float:
+    """Перцентиль по отсортированной выборке (миллисекунды)"""
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+def summarize(samples: list) -> dict:
+    """p50/p95/p99 и средняя задержка по выборке секунд"""
+    ms = sorted(sample * 1000 for sample in samples)
+    return {
+        'count': len(ms),
+        'mean_ms': round(statistics.fmean(ms), 4) if ms else 0.0,
+        'p50_ms': round(percentile(ms, 0.50), 4),
+        'p95_ms': round(percentile(ms, 0.95), 4),
+        'p99_ms': round(percentile(ms, 0.99), 4),
+    }
+
+
+def generate_dataset(db, users: int, subscriptions_per_user: float, payments_per_user: float,
+                     expired_fraction: float, seed: int, batch_size: int = 50000):
+    """Генерация синтетических пользователей, подписок и платежей напрямую через executemany"""
+    rng = random.Random(seed)
+    now = int(time.time())
+    shards = db.shards if isinstance(db, ShardedDatabase) else [db]
+
+    def insert(rows_by_shard: dict, sql: str):
+        for index, rows in rows_by_shard.items():
+            if rows:
+                with shards[index].pool.transaction() as conn:
+                    conn.executemany(sql, rows)
+
+    def route(user_id: int) -> int:
+        return user_id % len(shards)
+
+    for start in range(1, users + 1, batch_size):
+        user_rows = {index: [] for index in range(len(shards))}
+        subscription_rows = {index: [] for index in range(len(shards))}
+        payment_rows = {index: [] for index in range(len(shards))}
+
+        for user_id in range(start, min(start + batch_size, users + 1)):
+            index = route(user_id)
+            registration = now - rng.randint(0, 365 * DAY)
+            user_rows[index].append((user_id, f"user{user_id}", "Имя", None, registration))
+
+            for _ in range(int(subscriptions_per_user) + (rng.random() < subscriptions_per_user % 1)):
+                if rng.random() < expired_fraction:
+                    end_date = now - rng.randint(1, 300 * DAY)
+                else:
+                    end_date = now + rng.randint(1, 30 * DAY)
+                is_active = 1 if end_date > now or rng.random() < 0.01 else 0
+                subscription_rows[index].append(
+                    (user_id, end_date - 30 * DAY, end_date, is_active, uuid.uuid4().hex, 100000)
+                )
+
+            for _ in range(int(payments_per_user) + (rng.random() < payments_per_user % 1)):
+                status = rng.choice(('paid', 'paid', 'pending', 'canceled'))
+                created = now - rng.randint(0, 300 * DAY)
+                payment_rows[index].append(
+                    (user_id, uuid.uuid4().hex, 100000, status, created, created + 60 if status == 'paid' else None)
+                )
+
+        insert(user_rows, '''
+            INSERT INTO users (user_id, username, first_name, last_name, registration_date)
+            VALUES (?, ?, ?, ?, ?)
+        ''')
+        insert(subscription_rows, '''
+            INSERT INTO subscriptions (user_id, start_date, end_date, is_active, payment_id, amount)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''')
+        insert(payment_rows, '''
+            INSERT INTO payments (user_id, payment_id, amount, status, created_date, paid_date)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''')
+
+    for shard in shards:
+        with shard.pool.connection() as conn:
+            conn.execute('ANALYZE')
+
+
+def time_operation(operation, iterations: int) -> dict:
+    """Последовательный замер одной операции"""
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        operation(i)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def benchmark_methods(db, users: int, iterations: int, rng: random.Random) -> dict:
+    """Замер каждого публичного метода Database"""
+    results = {}
+    random_user = lambda: rng.randint(1, users)
+    new_user_base = users + 1_000_000
+
+    # Кэш подписок отключается на время замера чтения из SQLite
+    def uncached_subscription(i):
+        user_id = random_user()
+        target = db.shard_for(user_id) if isinstance(db, ShardedDatabase) else db
+        target.subscription_cache.clear()
+        target.get_user_subscription(user_id)
+
+    results['get_user_subscription'] = time_operation(uncached_subscription, iterations)
+    results['get_user_subscription_cached'] = time_operation(
+        lambda i: db.get_user_subscription(1 + i % 100), iterations
+    )
+    results['get_user'] = time_operation(lambda i: db.get_user(random_user()), iterations)
+    results['add_user'] = time_operation(
+        lambda i: db.add_user(random_user(), f"renamed{i}", "Имя", None), iterations
+    )
+    results['upsert_users_batch_100'] = time_operation(
+        lambda i: db.upsert_users([(new_user_base + i * 100 + j, "u", "Имя", None) for j in range(100)]),
+        max(1, iterations // 10)
+    )
+    results['create_subscription'] = time_operation(
+        lambda i: db.create_subscription(random_user(), uuid.uuid4().hex), iterations
+    )
+    results['deactivate_subscription'] = time_operation(
+        lambda i: db.deactivate_subscription(random_user()), iterations
+    )
+
+    payment_ids = []
+    def add_payment(i):
+        payment_id = uuid.uuid4().hex
+        payment_ids.append(payment_id)
+        db.add_payment(random_user(), payment_id, 100000)
+
+    results['add_payment'] = time_operation(add_payment, iterations)
+    results['get_payment'] = time_operation(lambda i: db.get_payment(payment_ids[i % len(payment_ids)]), iterations)
+    results['update_payment_status'] = time_operation(
+        lambda i: db.update_payment_status(payment_ids[i % len(payment_ids)], 'paid'), iterations
+    )
+
+    def scan_expired(i):
+        for _ in db.iter_expired_subscriptions():
+            pass
+
+    results['iter_expired_subscriptions'] = time_operation(scan_expired, max(1, iterations // 100))
+    results['iter_subscription_deadlines'] = time_operation(
+        lambda i: sum(1 for _ in db.iter_subscription_deadlines(int(time.time()) + 12 * 3600)),
+        max(1, iterations // 100)
+    )
+    results['get_report'] = time_operation(lambda i: db.get_report(), max(1, iterations // 100))
+
+    # Захват истекших подписок в последнюю очередь: он меняет данные
+    def claim(i):
+        expired = db.claim_expired_subscriptions(500)
+        db.finish_expired_subscriptions(expired)
+
+    results['claim_expired_subscriptions_500'] = time_operation(claim, max(1, iterations // 100))
+    return results
+
+
+def benchmark_mixed(db, users: int, threads: int, duration: float, write_ratio: float, seed: int) -> dict:
+    """Смешанная нагрузка чтение/запись из нескольких потоков"""
+    reads, writes, errors = [], [], []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(worker_id: int):
+        rng = random.Random(seed + worker_id)
+        local_reads, local_writes, local_errors = [], [], 0
+        while time.perf_counter() < deadline:
+            user_id = rng.randint(1, users)
+            is_write = rng.random() < write_ratio
+            started = time.perf_counter()
+            try:
+                if is_write:
+                    if rng.random() < 0.5:
+                        db.add_payment(user_id, uuid.uuid4().hex, 100000)
+                    else:
+                        db.add_user(user_id, f"u{rng.randint(0, 10)}", "Имя", None)
+                else:
+                    db.get_user_subscription(user_id)
+            except Exception:
+                local_errors += 1
+                continue
+            (local_writes if is_write else local_reads).append(time.perf_counter() - started)
+        with lock:
+            reads.extend(local_reads)
+            writes.extend(local_writes)
+            errors.append(local_errors)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(worker, range(threads)))
+
+    total = len(reads) + len(writes)
+    return {
+        'threads': threads,
+        'duration_s': duration,
+        'write_ratio': write_ratio,
+        'ops_per_second': round(total / duration, 1),
+        'errors': sum(errors),
+        'reads': summarize(reads),
+        'writes': summarize(writes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный замер хранилища на синтетических данных")
+    parser.add_argument('--users', type=int, default=10000, help="Количество пользователей (10k - 5M)")
+    parser.add_argument('--subscriptions-per-user', type=float, default=1.5)
+    parser.add_argument('--payments-per-user', type=float, default=2.0)
+    parser.add_argument('--expired-fraction', type=float, default=0.4, help="Доля истекших подписок")
+    parser.add_argument('--shards', type=int, default=1, help="Количество шардов (1 - один файл)")
+    parser.add_argument('--pool-size', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=1000, help="Повторов на метод")
+    parser.add_argument('--threads', type=int, default=8, help="Потоков смешанной нагрузки")
+    parser.add_argument('--duration', type=float, default=10.0, help="Длительность смешанной нагрузки, с")
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', help="Каталог для БД (по умолчанию временный)")
+    parser.add_argument('--output', help="Файл для JSON-результата (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        db_path = os.path.join(workdir, 'benchmark.db')
+        if args.shards > 1:
+            db = ShardedDatabase(db_path, args.shards, args.pool_size)
+        else:
+            db = Database(db_path, args.pool_size)
+
+        try:
+            started = time.perf_counter()
+            generate_dataset(
+                db, args.users, args.subscriptions_per_user, args.payments_per_user,
+                args.expired_fraction, args.seed
+            )
+            generation_time = time.perf_counter() - started
+            print(f"Данные сгенерированы за {generation_time:.1f} с", file=sys.stderr)
+
+            result = {
+                'timestamp': int(time.time()),
+                'config': vars(args),
+                'schema_version': db.get_schema_version(),
+                'dataset': db.get_report(),
+                'generation_s': round(generation_time, 2),
+                'methods': benchmark_methods(db, args.users, args.iterations, random.Random(args.seed)),
+                'mixed': benchmark_mixed(
+                    db, args.users, args.threads, args.duration, args.write_ratio, args.seed
+                ),
+                'cache': db.cache_stats(),
+            }
+        finally:
+            db.close()
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
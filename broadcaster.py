@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+from async_database import AsyncDatabase
+from models import Broadcast
+from telegram_pacer import TelegramPacer
+
+# Статусы отметок о доставке
+DELIVERY_SENT = 'sent'
+DELIVERY_BLOCKED = 'blocked'  # Пользователь заблокировал бота или удалил аккаунт
+DELIVERY_FAILED = 'failed'
+
+
+def format_duration(seconds: float) -> str:
+    """Длительность для логов: 1 ч 05 мин, 2 мин 33 с, 12 с"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60:02d} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин {seconds % 60:02d} с"
+    return f"{seconds} с"
+
+
+class Broadcaster:
+    """Рассылка сообщений пользователям с соблюдением лимитов Telegram.
+
+    Получатели читаются из БД страницами по page_size (по возрастанию user_id)
+    и раздаются workers параллельным отправителям через ограниченную очередь.
+    Общий темп задает TelegramPacer, общий с остальными фоновыми задачами
+    (RetryAfter приостанавливает всю рассылку, сообщение отправляется повторно),
+    в один чат - не чаще раза в per_chat_interval секунд. Результат по каждому
+    получателю пишется в broadcast_deliveries пачками, поэтому после перезапуска рассылка
+    продолжается с необработанных получателей (повторно могут уйти только
+    сообщения из последней незаписанной пачки). Рассылки выполняются по одной,
+    в порядке создания; ход рассылки и оценка оставшегося времени пишутся в лог."""
+
+    def __init__(self, bot: Bot, db: AsyncDatabase, pacer: TelegramPacer, workers: int = 8,
+                 page_size: int = 500, flush_size: int = 100, progress_interval: float = 10.0,
+                 per_chat_interval: float = 1.0, max_retries: int = 3):
+        self.bot = bot
+        self.db = db
+        self.workers = workers
+        self.page_size = page_size
+        self.flush_size = flush_size
+        self.progress_interval = progress_interval
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.pacer = pacer
+        self.logger = logging.getLogger(__name__)
+
+        self._broadcasts: asyncio.Queue = asyncio.Queue()
+        self._chat_sent: OrderedDict = OrderedDict()  # chat_id -> время последней отправки
+        self._results: List[tuple] = []  # Незаписанные отметки (user_id, статус)
+        self._progress: Optional[dict] = None
+        self.stats = {'broadcasts': 0, 'sent': 0, 'blocked': 0, 'failed': 0}
+
+    async def start_broadcast(self, text: str, audience: str) -> int:
+        """Создание рассылки и постановка в очередь; возвращает id рассылки"""
+        broadcast_id = await self.db.create_broadcast(text, audience)
+        self._broadcasts.put_nowait(broadcast_id)
+        return broadcast_id
+
+    def progress(self) -> Optional[dict]:
+        """Ход текущей рассылки (None, если рассылки нет)"""
+        if self._progress is None:
+            return None
+        progress = dict(self._progress)
+        elapsed = time.monotonic() - progress.pop('started')
+        processed = progress.pop('processed')
+        remaining = max(progress['total'] - progress['done'], 0)
+        progress['rate'] = round(processed / elapsed, 1) if elapsed > 0 else 0.0
+        progress['eta'] = round(remaining / progress['rate']) if progress['rate'] else None
+        return progress
+
+    def _log_progress(self):
+        progress = self.progress()
+        if progress is None:
+            return
+        percent = progress['done'] * 100 // progress['total'] if progress['total'] else 100
+        eta = format_duration(progress['eta']) if progress['eta'] is not None else '?'
+        self.logger.info(
+            f"Рассылка #{progress['id']}: {progress['done']}/{progress['total']} ({percent}%), "
+            f"доставлено {progress['sent']}, недоступно {progress['blocked']}, ошибок {progress['failed']}, "
+            f"{progress['rate']} сообщ/с, осталось ~{eta}"
+        )
+
+    async def _wait_chat(self, chat_id: int):
+        """Соблюдение интервала между сообщениями в один чат"""
+        now = time.monotonic()
+        # Записи упорядочены по времени отправки: устаревшие лежат в начале
+        while self._chat_sent and next(iter(self._chat_sent.values())) <= now - self.per_chat_interval:
+            self._chat_sent.popitem(last=False)
+        last = self._chat_sent.get(chat_id)
+        if last is not None:
+            await asyncio.sleep(last + self.per_chat_interval - now)
+
+    async def _send(self, chat_id: int, text: str) -> str:
+        """Отправка одного сообщения с повторами; возвращает статус доставки"""
+        for attempt in range(self.max_retries + 1):
+            await self._wait_chat(chat_id)
+            self._chat_sent[chat_id] = time.monotonic()
+            self._chat_sent.move_to_end(chat_id)
+            try:
+                await self.pacer.call(self.bot.send_message, chat_id=chat_id, text=text)
+                return DELIVERY_SENT
+            except RetryAfter:
+                # Повторы после RetryAfter исчерпаны в TelegramPacer
+                return DELIVERY_FAILED
+            except Forbidden:
+                return DELIVERY_BLOCKED
+            except BadRequest as e:
+                self.logger.debug(f"Сообщение пользователю {chat_id} не принято: {e}")
+                return DELIVERY_FAILED
+            except TimedOut:
+                # Сообщение могло дойти: повтор рискует дублем, отмечаем как ошибку
+                return DELIVERY_FAILED
+            except NetworkError as e:
+                self.logger.debug(f"Сетевая ошибка при отправке пользователю {chat_id}: {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except TelegramError as e:
+                self.logger.debug(f"Ошибка отправки пользователю {chat_id}: {e}")
+                return DELIVERY_FAILED
+        return DELIVERY_FAILED
+
+    async def _flush(self, broadcast_id: int):
+        """Запись накопленных отметок о доставке"""
+        results, self._results = self._results, []
+        if not results:
+            return
+        try:
+            await self.db.record_broadcast_deliveries(broadcast_id, results)
+        except Exception as e:
+            self._results.extend(results)
+            self.logger.error(f"Ошибка записи хода рассылки #{broadcast_id}: {e}")
+
+    async def _worker(self, broadcast: Broadcast, recipients: asyncio.Queue):
+        while True:
+            user_id = await recipients.get()
+            if user_id is None:
+                return
+            status = await self._send(user_id, broadcast.text)
+            self.stats[status] += 1
+            self._progress[status] += 1
+            self._progress['done'] += 1
+            self._progress['processed'] += 1
+            self._results.append((user_id, status))
+            if len(self._results) >= self.flush_size:
+                await self._flush(broadcast.id)
+
+    async def _produce(self, broadcast: Broadcast, recipients: asyncio.Queue):
+        """Постраничное чтение получателей в очередь отправителей"""
+        after_user_id = 0
+        while True:
+            page = await self.db.get_broadcast_recipients(broadcast.id, broadcast.audience, after_user_id, self.page_size)
+            for user_id in page:
+                await recipients.put(user_id)
+            if len(page) < self.page_size:
+                return
+            after_user_id = page[-1]
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self._log_progress()
+
+    async def run_broadcast(self, broadcast: Broadcast):
+        """Отправка рассылки необработанным получателям"""
+        self._results = []
+        done = sum((await self.db.get_broadcast_stats(broadcast.id)).values())
+        remaining = await self.db.count_broadcast_recipients(broadcast.id, broadcast.audience)
+        self._progress = {
+            'id': broadcast.id, 'total': done + remaining, 'done': done,
+            'sent': 0, 'blocked': 0, 'failed': 0, 'processed': 0, 'started': time.monotonic()
+        }
+        self.logger.info(f"Рассылка #{broadcast.id} ({broadcast.audience}): осталось {remaining} из {done + remaining}")
+
+        recipients = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.create_task(self._worker(broadcast, recipients)) for _ in range(self.workers)]
+        reporter = asyncio.create_task(self._report())
+        try:
+            await self._produce(broadcast, recipients)
+            for _ in workers:
+                await recipients.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers + [reporter]:
+                task.cancel()
+            await self._flush(broadcast.id)
+
+        await self.db.finish_broadcast(broadcast.id)
+        self.stats['broadcasts'] += 1
+        self._log_progress()
+        self._progress = None
+
+    async def run(self):
+        """Фоновая задача: продолжение прерванных рассылок, затем новые по очереди"""
+        for broadcast in await self.db.get_unfinished_broadcasts():
+            self._broadcasts.put_nowait(broadcast.id)
+        while True:
+            broadcast_id = await self._broadcasts.get()
+            try:
+                broadcast = await self.db.get_broadcast(broadcast_id)
+                if broadcast is not None and broadcast.status == 'running':
+                    await self.run_broadcast(broadcast)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Ошибка рассылки #{broadcast_id}: {e}")
+                self._progress = None
@@ -0,0 +1,91 @@
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from telegram import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import ContextTypes
+
+# Обработчик нажатия: (query, аргумент) -> None. Аргумент - остаток callback_data после префикса
+CallbackHandler = Callable[[CallbackQuery, str], Awaitable[None]]
+
+
+def build_keyboard(rows: Sequence[Sequence[Tuple[str, str]]]) -> InlineKeyboardMarkup:
+    """Клавиатура из строк кнопок (текст, callback_data); объекты Telegram неизменяемы,
+    поэтому одну клавиатуру можно отправлять сколько угодно раз"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(label, callback_data=data) for label, data in row]
+        for row in rows
+    ])
+
+
+class _PrefixNode:
+    __slots__ = ('children', 'handler')
+
+    def __init__(self):
+        self.children: Dict[str, '_PrefixNode'] = {}
+        self.handler: Optional[CallbackHandler] = None
+
+
+class CallbackRouter:
+    """Маршрутизация нажатий inline-кнопок по callback_data.
+
+    Точные значения ищутся в словаре, префиксные маршруты (check_payment_<id>) -
+    в префиксном дереве за длину callback_data, выбирается самый длинный префикс.
+    Статические шаги воронки (текст и следующая кнопка) собираются один раз при
+    регистрации; шаги с логикой регистрируются как обработчики."""
+
+    def __init__(self, fallback: Optional[CallbackHandler] = None):
+        self._exact: Dict[str, CallbackHandler] = {}
+        self._prefixes = _PrefixNode()
+        self.fallback = fallback
+        self.logger = logging.getLogger(__name__)
+
+    def add(self, data: str, handler: CallbackHandler):
+        """Обработчик для точного значения callback_data"""
+        self._exact[data] = handler
+
+    def add_prefix(self, prefix: str, handler: CallbackHandler):
+        """Обработчик для всех callback_data, начинающихся с prefix"""
+        node = self._prefixes
+        for char in prefix:
+            node = node.children.setdefault(char, _PrefixNode())
+        node.handler = handler
+
+    def add_step(self, data: str, text: str, keyboard: Optional[InlineKeyboardMarkup] = None):
+        """Статический шаг воронки: ответ с готовым текстом и клавиатурой"""
+        async def reply(query: CallbackQuery, _: str):
+            await query.message.reply_text(text=text, reply_markup=keyboard)
+        self.add(data, reply)
+
+    def add_funnel(self, steps: Sequence[Tuple[str, str, List[List[Tuple[str, str]]]]]):
+        """Регистрация шагов воронки (callback_data, текст, строки кнопок (текст, callback_data))"""
+        for data, text, rows in steps:
+            self.add_step(data, text, build_keyboard(rows) if rows else None)
+
+    def resolve(self, data: str) -> Tuple[Optional[CallbackHandler], str]:
+        """Обработчик и его аргумент для callback_data"""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, ''
+
+        node = self._prefixes
+        match, match_length = None, 0
+        for index, char in enumerate(data):
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.handler is not None:
+                match, match_length = node.handler, index + 1
+        return match, data[match_length:]
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработчик для CallbackQueryHandler"""
+        query = update.callback_query
+        await query.answer()
+
+        handler, argument = self.resolve(query.data or '')
+        if handler is None:
+            handler, argument = self.fallback, query.data
+        if handler is None:
+            self.logger.warning(f"Нет обработчика для callback_data {query.data!r}")
+            return
+        await handler(query, argument)
@@ -1,150 +1,1070 @@
+import os
 import sqlite3
-import datetime
-from typing import Optional, List
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional, List
+
+from models import Broadcast, RenewalCandidate, User, Subscription, Payment, ExpiredSubscription, columns, row_factory
+from subscription_cache import SubscriptionCache, MISSING
+
+
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite в режиме WAL"""
+
+    def __init__(self, db_path: str, size: int = 4, busy_timeout: float = 30.0):
+        self.db_path = db_path
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие соединения с настройкой PRAGMA"""
+        # isolation_level=None: транзакциями управляем сами через BEGIN IMMEDIATE
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')  # В режиме WAL безопасно и без fsync на каждый коммит
+        conn.execute('PRAGMA cache_size = -16000')  # ~16 МБ страничного кэша
+        conn.execute('PRAGMA mmap_size = 268435456')  # 256 МБ
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}')
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """Получение соединения из пула (открывает новое, пока не достигнут размер пула)"""
+        if self._closed:
+            raise sqlite3.ProgrammingError("Пул соединений закрыт")
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.busy_timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Нет свободных соединений в пуле")
+
+    def release(self, conn: sqlite3.Connection):
+        """Возврат соединения в пул"""
+        if conn.in_transaction:
+            conn.rollback()
+
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self):
+        """Соединение для чтения (autocommit, в WAL не блокируется писателями)"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Пишущая транзакция: блокировка на запись берется сразу, без апгрейда"""
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+
+    def close(self):
+        """Закрытие всех соединений пула"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+SUBSCRIPTION_DAYS = 30
+
+
+def _epoch(column: str, local_time: bool) -> str:
+    """SQL-выражение для перевода старой текстовой даты в Unix-время.
+    Даты из datetime.now() хранились в локальном времени, CURRENT_TIMESTAMP - в UTC"""
+    modifier = ", 'utc'" if local_time else ""
+    return (
+        f"CASE WHEN typeof({column}) = 'integer' THEN {column} "
+        f"ELSE CAST(strftime('%s', {column}{modifier}) AS INTEGER) END"
+    )
+
+
+def _migration_initial_schema(conn: sqlite3.Connection):
+    """Исходная схема: пользователи, подписки, платежи"""
+    # Таблица пользователей
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Таблица подписок
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            start_date TIMESTAMP,
+            end_date TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1,
+            payment_id TEXT,
+            amount INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    
+    # Таблица платежей
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            payment_id TEXT UNIQUE,
+            amount INTEGER,
+            status TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            paid_date TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+
+def _migration_epoch_timestamps(conn: sqlite3.Connection):
+    """Перевод дат в целочисленное Unix-время (секунды), чтобы сравнения шли по индексу"""
+    conn.execute('''
+        CREATE TABLE users_new (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            registration_date INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        )
+    ''')
+    conn.execute(f'''
+        INSERT INTO users_new (user_id, username, first_name, last_name, registration_date)
+        SELECT user_id, username, first_name, last_name, {_epoch('registration_date', False)}
+        FROM users
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE subscriptions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            start_date INTEGER,
+            end_date INTEGER,
+            is_active INTEGER DEFAULT 1,
+            payment_id TEXT,
+            amount INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    conn.execute(f'''
+        INSERT INTO subscriptions_new (id, user_id, start_date, end_date, is_active, payment_id, amount)
+        SELECT id, user_id, {_epoch('start_date', True)}, {_epoch('end_date', True)},
+               is_active, payment_id, amount
+        FROM subscriptions
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE payments_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            payment_id TEXT UNIQUE,
+            amount INTEGER,
+            status TEXT,
+            created_date INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            paid_date INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    conn.execute(f'''
+        INSERT INTO payments_new (id, user_id, payment_id, amount, status, created_date, paid_date)
+        SELECT id, user_id, payment_id, amount, status,
+               {_epoch('created_date', False)}, {_epoch('paid_date', True)}
+        FROM payments
+    ''')
+    
+    for table in ('users', 'subscriptions', 'payments'):
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+
+def _migration_hot_path_indexes(conn: sqlite3.Connection):
+    """Индексы для поиска подписки пользователя, истекших подписок и платежей"""
+    # get_user_subscription: WHERE user_id = ? AND is_active = 1 AND end_date > ? ORDER BY end_date
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active_end
+        ON subscriptions (user_id, is_active, end_date)
+    ''')
+    # get_expired_subscriptions: частичный индекс только по активным подпискам
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_active_end
+        ON subscriptions (end_date) WHERE is_active = 1
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_user_status
+        ON payments (user_id, status)
+    ''')
+
+
+def _migration_expiring_claims(conn: sqlite3.Connection):
+    """Индекс по подпискам, захваченным проверкой истечения (is_active = 2)"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_expiring
+        ON subscriptions (id) WHERE is_active = 2
+    ''')
+
+
+def _migration_pending_payment_checks(conn: sqlite3.Connection):
+    """Расписание фоновой проверки ожидающих платежей"""
+    conn.execute('ALTER TABLE payments ADD COLUMN next_check_at INTEGER')
+    conn.execute("UPDATE payments SET next_check_at = created_date WHERE status = 'pending'")
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_pending_check
+        ON payments (next_check_at) WHERE status = 'pending'
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_pending_created
+        ON payments (created_date) WHERE status = 'pending'
+    ''')
+
+
+def _migration_payment_intents(conn: sqlite3.Connection):
+    """Ссылка на оплату и ключ идемпотентности для повторного использования открытого счета"""
+    conn.execute('ALTER TABLE payments ADD COLUMN confirmation_url TEXT')
+    conn.execute('ALTER TABLE payments ADD COLUMN idempotency_key TEXT')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_user_open
+        ON payments (user_id, amount, created_date) WHERE status = 'pending'
+    ''')
+
+
+def _migration_recurring_billing(conn: sqlite3.Connection):
+    """Сохраненные способы оплаты и расписание автопродления подписок"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payment_methods (
+            user_id INTEGER PRIMARY KEY,
+            payment_method_id TEXT NOT NULL,
+            created_date INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    conn.execute('ALTER TABLE subscriptions ADD COLUMN renewal_attempts INTEGER NOT NULL DEFAULT 0')
+    conn.execute('ALTER TABLE subscriptions ADD COLUMN next_renewal_at INTEGER')
+
+
+def _migration_broadcasts(conn: sqlite3.Connection):
+    """Рассылки и отметки о доставке каждому получателю (для продолжения после перезапуска)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            audience TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_date INTEGER NOT NULL,
+            finished_date INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_payment_reservations(conn: sqlite3.Connection):
+    """Поиск платежа по ключу идемпотентности: ключ записывается до обращения к провайдеру"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_user_key
+        ON payments (user_id, idempotency_key) WHERE idempotency_key IS NOT NULL
+    ''')
+
+
+def _migration_invoice_numbers(conn: sqlite3.Connection):
+    """Номера счетов для провайдеров с числовым номером заказа (InvId Робокассы):
+    последовательность, не зависящая от архивации платежей, и ключ идемпотентности номера"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS invoice_numbers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            created_date INTEGER NOT NULL
+        )
+    ''')
+
+
+# Миграции схемы: (версия, функция). Новые миграции добавляются только в конец списка
+MIGRATIONS = [
+    (1, _migration_initial_schema),
+    (2, _migration_epoch_timestamps),
+    (3, _migration_hot_path_indexes),
+    (4, _migration_expiring_claims),
+    (5, _migration_pending_payment_checks),
+    (6, _migration_payment_intents),
+    (7, _migration_recurring_billing),
+    (8, _migration_broadcasts),
+    (9, _migration_payment_reservations),
+    (10, _migration_invoice_numbers),
+]
+
+# Значения subscriptions.is_active
+SUBSCRIPTION_INACTIVE = 0
+SUBSCRIPTION_ACTIVE = 1
+SUBSCRIPTION_EXPIRING = 2  # Истекла и захвачена проверкой, доступ еще не отозван
+
+# Аудитории рассылок: условие отбора получателей из users (u)
+BROADCAST_AUDIENCES = {
+    'all': '',
+    'active': '''
+        AND EXISTS (
+            SELECT 1 FROM subscriptions s
+            WHERE s.user_id = u.user_id AND s.is_active = 1 AND s.end_date > :now
+        )
+    ''',
+}
+
+
+def archive_path(db_path: str) -> str:
+    """Путь к архивной БД: bot_database.db -> bot_database.archive.db"""
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.archive{ext or '.db'}"
+
+
+# Архивные таблицы: те же колонки, что у записей Payment/Subscription, и дата переноса.
+# Архив только дополняется, поэтому индексы нужны лишь для поиска истории пользователя
+ARCHIVE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS archive.payments (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        payment_id TEXT,
+        amount INTEGER,
+        status TEXT,
+        created_date INTEGER,
+        paid_date INTEGER,
+        confirmation_url TEXT,
+        idempotency_key TEXT,
+        archived_date INTEGER
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS archive.idx_archive_payments_user ON payments (user_id)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_archive_payments_payment_id ON payments (payment_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS archive.subscriptions (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        start_date INTEGER,
+        end_date INTEGER,
+        is_active INTEGER,
+        payment_id TEXT,
+        amount INTEGER,
+        archived_date INTEGER
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS archive.idx_archive_subscriptions_user ON subscriptions (user_id)',
+]
+
 
 class Database:
-    def __init__(self, db_path: str = "bot_database.db"):
+    def __init__(self, db_path: str = "bot_database.db", pool_size: int = 4,
+                 cache_size: int = 10000, cache_ttl: float = 300.0):
         self.db_path = db_path
+        self.archive_path = archive_path(db_path)
+        self.pool_size = pool_size
+        self.pool = ConnectionPool(db_path, pool_size)
+        self.subscription_cache = SubscriptionCache(cache_size, cache_ttl)
         self.init_db()
     
+    def close(self):
+        """Закрытие соединений с базой данных"""
+        self.pool.close()
+    
     def init_db(self):
-        """Инициализация базы данных"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Таблица пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Таблица подписок
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS subscriptions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    start_date TIMESTAMP,
-                    end_date TIMESTAMP,
-                    is_active BOOLEAN DEFAULT 1,
-                    payment_id TEXT,
-                    amount INTEGER,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+        """Инициализация базы данных: применение недостающих миграций схемы"""
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    applied_date INTEGER
                 )
             ''')
+            current_version = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
             
-            # Таблица платежей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS payments (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    payment_id TEXT UNIQUE,
-                    amount INTEGER,
-                    status TEXT,
-                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    paid_date TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-            ''')
-            
-            conn.commit()
+            # Все миграции применяются в одной транзакции: схема либо обновлена целиком, либо не тронута
+            for version, migration in MIGRATIONS:
+                if version > current_version:
+                    migration(conn)
+                    conn.execute(
+                        'INSERT INTO schema_version (version, applied_date) VALUES (?, ?)',
+                        (version, int(time.time()))
+                    )
+    
+    def get_schema_version(self) -> int:
+        """Текущая версия схемы БД"""
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
     
     def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
         """Добавление пользователя"""
-        with sqlite3.connect(self.db_path) as conn:
+        self.upsert_users([(user_id, username, first_name, last_name)])
+    
+    def upsert_users(self, users: List[tuple]):
+        """Пакетное добавление/обновление пользователей (user_id, username, first_name, last_name).
+        Дата регистрации сохраняется, неизмененные строки не перезаписываются"""
+        with self.pool.transaction() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO users (user_id, username, first_name, last_name)
+            cursor.executemany('''
+                INSERT INTO users (user_id, username, first_name, last_name)
                 VALUES (?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name))
-            conn.commit()
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name
+                WHERE users.username IS NOT excluded.username
+                   OR users.first_name IS NOT excluded.first_name
+                   OR users.last_name IS NOT excluded.last_name
+            ''', users)
     
     def create_subscription(self, user_id: int, payment_id: str, amount: int = 100000):
-        """Создание подписки (amount в копейках, 100000 = 1000 рублей)"""
-        end_date = datetime.datetime.now() + datetime.timedelta(days=30)
+        """Создание подписки (amount в копейках, 100000 = 1000 рублей), возвращает end_date"""
+        start_date = int(time.time())
+        end_date = start_date + SUBSCRIPTION_DAYS * 86400
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO subscriptions (user_id, start_date, end_date, payment_id, amount)
                 VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, datetime.datetime.now(), end_date, payment_id, amount))
-            conn.commit()
+            ''', (user_id, start_date, end_date, payment_id, amount))
+        self.subscription_cache.invalidate(user_id)
+        return end_date
     
-    def get_user_subscription(self, user_id: int) -> Optional[dict]:
-        """Получение активной подписки пользователя"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM subscriptions 
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Получение профиля пользователя"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT {columns(User)} FROM users WHERE user_id = ?
+            ''', (user_id,))
+            cursor.row_factory = row_factory(User)
+            return cursor.fetchone()
+    
+    def get_user_subscription(self, user_id: int) -> Optional[Subscription]:
+        """Получение активной подписки пользователя (даты - Unix-время в секундах)"""
+        cached = self.subscription_cache.get(user_id)
+        if cached is not MISSING:
+            return cached
+        
+        generation = self.subscription_cache.generation()
+        subscription = self._select_user_subscription(user_id)
+        self.subscription_cache.put(user_id, subscription, generation)
+        return subscription
+    
+    def _select_user_subscription(self, user_id: int) -> Optional[Subscription]:
+        """Чтение активной подписки пользователя из БД в обход кэша"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT {columns(Subscription)}
+                FROM subscriptions
                 WHERE user_id = ? AND is_active = 1 AND end_date > ?
                 ORDER BY end_date DESC LIMIT 1
-            ''', (user_id, datetime.datetime.now()))
-            
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'id': row[0],
-                    'user_id': row[1],
-                    'start_date': row[2],
-                    'end_date': row[3],
-                    'is_active': row[4],
-                    'payment_id': row[5],
-                    'amount': row[6]
-                }
-            return None
+            ''', (user_id, int(time.time())))
+            cursor.row_factory = row_factory(Subscription)
+            return cursor.fetchone()
     
     def deactivate_subscription(self, user_id: int):
         """Деактивация подписки"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE subscriptions 
                 SET is_active = 0 
-                WHERE user_id = ?
+                WHERE user_id = ? AND is_active != 0
             ''', (user_id,))
-            conn.commit()
+        self.subscription_cache.invalidate(user_id)
     
-    def get_expired_subscriptions(self) -> List[dict]:
-        """Получение списка истекших подписок"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT user_id, end_date FROM subscriptions 
+    def cache_stats(self) -> dict:
+        """Статистика кэша подписок (попадания, промахи, размер)"""
+        return self.subscription_cache.stats()
+    
+    def iter_expired_subscriptions(self) -> Iterator[Subscription]:
+        """Истекшие, но еще активные подписки; строки читаются с курсора по одной"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT {columns(Subscription)} FROM subscriptions 
                 WHERE is_active = 1 AND end_date <= ?
-            ''', (datetime.datetime.now(),))
+            ''', (int(time.time()),))
+            cursor.row_factory = row_factory(Subscription)
+            yield from cursor
+    
+    def iter_subscription_deadlines(self, until: int) -> Iterator[tuple]:
+        """Дедлайны активных подписок, истекающих не позже until: (user_id, end_date)"""
+        with self.pool.connection() as conn:
+            yield from conn.execute('''
+                SELECT user_id, MAX(end_date) FROM subscriptions
+                WHERE is_active = 1 AND end_date <= ?
+                GROUP BY user_id
+            ''', (until,))
+    
+    def claim_expired_subscriptions(self, batch_size: int = 500) -> List[ExpiredSubscription]:
+        """Захват пачки истекших подписок одной транзакцией (is_active 1 -> 2).
+        Возвращает по одной записи на пользователя"""
+        now = int(time.time())
+        with self.pool.transaction() as conn:
+            rows = conn.execute('''
+                UPDATE subscriptions
+                SET is_active = 2
+                WHERE id IN (
+                    SELECT id FROM subscriptions
+                    WHERE is_active = 1 AND end_date <= ?
+                    ORDER BY end_date
+                    LIMIT ?
+                )
+                RETURNING id, user_id, end_date
+            ''', (now, batch_size)).fetchall()
             
-            rows = cursor.fetchall()
-            return [{'user_id': row[0], 'end_date': row[1]} for row in rows]
+            # Одна запись на пользователя, даже если истекло несколько его подписок
+            end_dates = {}
+            subscription_ids = {}
+            for subscription_id, user_id, end_date in rows:
+                end_dates[user_id] = max(end_dates.get(user_id, end_date), end_date)
+                subscription_ids.setdefault(user_id, []).append(subscription_id)
+            
+            renewed = set()
+            if end_dates:
+                placeholders = ','.join('?' * len(end_dates))
+                renewed = {user_id for (user_id,) in conn.execute(f'''
+                    SELECT DISTINCT user_id FROM subscriptions
+                    WHERE user_id IN ({placeholders}) AND is_active = 1 AND end_date > ?
+                ''', (*end_dates, now))}
+        
+        if end_dates:
+            self.subscription_cache.invalidate(*end_dates)
+        return [
+            ExpiredSubscription(user_id, end_date, tuple(subscription_ids[user_id]), user_id in renewed)
+            for user_id, end_date in end_dates.items()
+        ]
+    
+    def finish_expired_subscriptions(self, expired_subscriptions: List[ExpiredSubscription]):
+        """Окончательная деактивация захваченных подписок после отзыва доступа"""
+        with self.pool.transaction() as conn:
+            conn.executemany('''
+                UPDATE subscriptions
+                SET is_active = 0
+                WHERE id = ? AND is_active = 2
+            ''', [
+                (subscription_id,)
+                for subscription in expired_subscriptions
+                for subscription_id in subscription.subscription_ids
+            ])
+    
+    def release_expiring_subscriptions(self, expired_subscriptions: Optional[List[ExpiredSubscription]] = None) -> int:
+        """Возврат захваченных подписок в очередь на обработку: переданных или, без аргумента,
+        всех (после прерванной проверки)"""
+        with self.pool.transaction() as conn:
+            if expired_subscriptions is None:
+                cursor = conn.execute('''
+                    UPDATE subscriptions
+                    SET is_active = 1
+                    WHERE is_active = 2
+                ''')
+            else:
+                cursor = conn.executemany('''
+                    UPDATE subscriptions
+                    SET is_active = 1
+                    WHERE id = ? AND is_active = 2
+                ''', [
+                    (subscription_id,)
+                    for subscription in expired_subscriptions
+                    for subscription_id in subscription.subscription_ids
+                ])
+            return cursor.rowcount
     
-    def add_payment(self, user_id: int, payment_id: str, amount: int, status: str = 'pending'):
+    def add_payment(self, user_id: int, payment_id: str, amount: int, status: str = 'pending',
+                    confirmation_url: Optional[str] = None, idempotency_key: Optional[str] = None):
         """Добавление записи о платеже"""
-        with sqlite3.connect(self.db_path) as conn:
+        now = int(time.time())
+        with self.pool.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO payments (user_id, payment_id, amount, status)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, payment_id, amount, status))
-            conn.commit()
+                INSERT INTO payments (user_id, payment_id, amount, status, created_date, next_check_at,
+                                      confirmation_url, idempotency_key)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, payment_id, amount, status, now, now, confirmation_url, idempotency_key))
+    
+    def find_open_payment(self, user_id: int, amount: int, created_after: int) -> Optional[Payment]:
+        """Последний ожидающий оплаты счет пользователя на эту сумму со ссылкой на оплату"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT {columns(Payment)} FROM payments
+                WHERE user_id = ? AND amount = ? AND status = 'pending' AND created_date > ?
+                  AND confirmation_url IS NOT NULL
+                ORDER BY created_date DESC
+                LIMIT 1
+            ''', (user_id, amount, created_after))
+            cursor.row_factory = row_factory(Payment)
+            return cursor.fetchone()
+    
+    def reserve_payment_key(self, user_id: int, amount: int, created_after: int, new_key: str) -> str:
+        """Ключ идемпотентности для нового счета. Ключ записывается в payments строкой
+        без payment_id со статусом 'creating' до обращения к провайдеру; если такая строка
+        на эту сумму моложе created_after уже есть (ответ провайдера был потерян), возвращается
+        ее ключ, и провайдер вернет тот же платеж. Резервы автоплатежей имеют статус
+        'charging' и сюда не попадают: их ключ относится к другому запросу"""
+        now = int(time.time())
+        with self.pool.transaction() as conn:
+            row = conn.execute('''
+                SELECT idempotency_key FROM payments
+                WHERE user_id = ? AND status = 'creating' AND amount = ? AND created_date > ?
+                ORDER BY id DESC
+                LIMIT 1
+            ''', (user_id, amount, created_after)).fetchone()
+            if row is not None:
+                return row[0]
+            conn.execute('''
+                INSERT INTO payments (user_id, amount, status, created_date, idempotency_key)
+                VALUES (?, ?, 'creating', ?, ?)
+            ''', (user_id, amount, now, new_key))
+            return new_key
+    
+    def get_payment_by_key(self, user_id: int, idempotency_key: str) -> Optional[Payment]:
+        """Платеж пользователя (или резерв без payment_id) по ключу идемпотентности"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT {columns(Payment)} FROM payments
+                WHERE user_id = ? AND idempotency_key = ?
+                ORDER BY id DESC
+                LIMIT 1
+            ''', (user_id, idempotency_key))
+            cursor.row_factory = row_factory(Payment)
+            return cursor.fetchone()
+    
+    def get_invoice_number(self, user_id: int, idempotency_key: str) -> int:
+        """Номер счета для ключа идемпотентности: при первом обращении выдается следующий
+        номер последовательности (AUTOINCREMENT не выдает номера повторно), затем тот же"""
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                INSERT INTO invoice_numbers (idempotency_key, user_id, created_date)
+                VALUES (?, ?, ?)
+                ON CONFLICT(idempotency_key) DO NOTHING
+            ''', (idempotency_key, user_id, int(time.time())))
+            return conn.execute('''
+                SELECT id FROM invoice_numbers WHERE idempotency_key = ?
+            ''', (idempotency_key,)).fetchone()[0]
+    
+    def attach_payment(self, user_id: int, idempotency_key: str, payment_id: str,
+                       confirmation_url: Optional[str] = None) -> bool:
+        """Привязка созданного провайдером платежа к строке с ключом идемпотентности.
+        Платеж становится ожидающим оплаты; False - строки с этим ключом нет"""
+        now = int(time.time())
+        with self.pool.transaction() as conn:
+            cursor = conn.execute('''
+                UPDATE payments
+                SET payment_id = ?, confirmation_url = ?, status = 'pending', next_check_at = ?
+                WHERE user_id = ? AND idempotency_key = ? AND payment_id IS NULL
+            ''', (payment_id, confirmation_url, now, user_id, idempotency_key))
+            return cursor.rowcount > 0
+    
+    def cancel_payment_key(self, user_id: int, idempotency_key: str) -> int:
+        """Отмена неоплаченного платежа (или резерва без payment_id) с этим ключом
+        идемпотентности, например после отклоненного автоплатежа. Возвращает число строк"""
+        with self.pool.transaction() as conn:
+            cursor = conn.execute('''
+                UPDATE payments
+                SET status = 'canceled'
+                WHERE user_id = ? AND idempotency_key = ? AND status IN ('creating', 'charging', 'pending')
+            ''', (user_id, idempotency_key))
+            return cursor.rowcount
     
-    def update_payment_status(self, payment_id: str, status: str):
-        """Обновление статуса платежа"""
-        with sqlite3.connect(self.db_path) as conn:
+    def get_payment(self, payment_id: str) -> Optional[Payment]:
+        """Получение платежа по идентификатору платежной системы"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT {columns(Payment)} FROM payments WHERE payment_id = ?
+            ''', (payment_id,))
+            cursor.row_factory = row_factory(Payment)
+            return cursor.fetchone()
+    
+    def update_payment_status(self, payment_id: str, status: str) -> bool:
+        """Обновление статуса платежа, возвращает True, если платеж найден"""
+        with self.pool.transaction() as conn:
             cursor = conn.cursor()
             if status == 'paid':
                 cursor.execute('''
                     UPDATE payments 
                     SET status = ?, paid_date = ?
                     WHERE payment_id = ?
-                ''', (status, datetime.datetime.now(), payment_id))
+                ''', (status, int(time.time()), payment_id))
             else:
                 cursor.execute('''
                     UPDATE payments 
                     SET status = ?
                     WHERE payment_id = ?
                 ''', (status, payment_id))
-            conn.commit()
+            return cursor.rowcount > 0
+    
+    def activate_payment(self, payment_id: str) -> Optional[Subscription]:
+        """Перевод платежа в 'paid' и продление подписки в одной транзакции: действующая
+        подписка пользователя продлевается на SUBSCRIPTION_DAYS, иначе создается новая.
+        Возвращает подписку, только если платеж был активирован именно этим вызовом"""
+        now = int(time.time())
+        with self.pool.transaction() as conn:
+            row = conn.execute('''
+                UPDATE payments
+                SET status = 'paid', paid_date = ?
+                WHERE payment_id = ? AND status != 'paid'
+                RETURNING user_id, amount
+            ''', (now, payment_id)).fetchone()
+            if row is None:
+                return None
+            
+            user_id, amount = row
+            # Продление (в том числе автоплатежом) сдвигает end_date текущей подписки
+            cursor = conn.execute(f'''
+                UPDATE subscriptions
+                SET end_date = MAX(end_date, ?) + ?, is_active = 1,
+                    renewal_attempts = 0, next_renewal_at = NULL
+                WHERE id = (
+                    SELECT id FROM subscriptions
+                    WHERE user_id = ? AND is_active != 0
+                    ORDER BY end_date DESC LIMIT 1
+                )
+                RETURNING {columns(Subscription)}
+            ''', (now, SUBSCRIPTION_DAYS * 86400, user_id))
+            cursor.row_factory = row_factory(Subscription)
+            subscription = cursor.fetchone()
+            if subscription is None:
+                cursor = conn.execute(f'''
+                    INSERT INTO subscriptions (user_id, start_date, end_date, payment_id, amount)
+                    VALUES (?, ?, ?, ?, ?)
+                    RETURNING {columns(Subscription)}
+                ''', (user_id, now, now + SUBSCRIPTION_DAYS * 86400, payment_id, amount))
+                cursor.row_factory = row_factory(Subscription)
+                subscription = cursor.fetchone()
+        
+        self.subscription_cache.invalidate(user_id)
+        return subscription
+    
+    def save_payment_method(self, user_id: int, payment_method_id: str):
+        """Сохранение способа оплаты пользователя для автопродления"""
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                INSERT INTO payment_methods (user_id, payment_method_id, created_date)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    payment_method_id = excluded.payment_method_id,
+                    created_date = excluded.created_date
+                WHERE payment_method_id IS NOT excluded.payment_method_id
+            ''', (user_id, payment_method_id, int(time.time())))
+    
+    def delete_payment_method(self, user_id: int):
+        """Удаление сохраненного способа оплаты (отключение автопродления)"""
+        with self.pool.transaction() as conn:
+            conn.execute('DELETE FROM payment_methods WHERE user_id = ?', (user_id,))
+    
+    def claim_renewals(self, until: int, limit: int, max_attempts: int, lease: int = 900) -> List[RenewalCandidate]:
+        """Захват действующих подписок с сохраненным способом оплаты, которые истекают
+        до until и которым пора списание. Следующая попытка откладывается на lease секунд
+        на случай сбоя обработчика"""
+        now = int(time.time())
+        with self.pool.transaction() as conn:
+            rows = conn.execute('''
+                UPDATE subscriptions
+                SET next_renewal_at = ?
+                WHERE id IN (
+                    SELECT s.id FROM subscriptions s
+                    JOIN payment_methods m ON m.user_id = s.user_id
+                    WHERE s.is_active = 1 AND s.end_date <= ? AND s.renewal_attempts < ?
+                      AND (s.next_renewal_at IS NULL OR s.next_renewal_at <= ?)
+                    ORDER BY s.end_date
+                    LIMIT ?
+                )
+                RETURNING id, user_id, end_date, amount, renewal_attempts
+            ''', (now + lease, until, max_attempts, now, limit)).fetchall()
+            if not rows:
+                return []
+            
+            user_ids = [row[1] for row in rows]
+            methods = dict(conn.execute(f'''
+                SELECT user_id, payment_method_id FROM payment_methods
+                WHERE user_id IN ({', '.join('?' * len(user_ids))})
+            ''', user_ids).fetchall())
+        
+        return [
+            RenewalCandidate(subscription_id, user_id, end_date, amount, attempts, methods[user_id])
+            for subscription_id, user_id, end_date, amount, attempts in rows
+            if user_id in methods
+        ]
+    
+    def schedule_renewal(self, user_id: int, subscription_id: int, attempts: int, next_renewal_at: int):
+        """Назначение следующей попытки автопродления подписки"""
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                UPDATE subscriptions
+                SET renewal_attempts = ?, next_renewal_at = ?
+                WHERE id = ? AND user_id = ?
+            ''', (attempts, next_renewal_at, subscription_id, user_id))
+    
+    def claim_pending_payments(self, limit: int, lease: int = 300) -> List[Payment]:
+        """Захват ожидающих платежей, которые пора проверить у провайдера.
+        Следующая проверка откладывается на lease секунд на случай сбоя обработчика"""
+        now = int(time.time())
+        with self.pool.transaction() as conn:
+            cursor = conn.execute(f'''
+                UPDATE payments
+                SET next_check_at = ?
+                WHERE id IN (
+                    SELECT id FROM payments
+                    WHERE status = 'pending' AND next_check_at <= ?
+                    ORDER BY next_check_at
+                    LIMIT ?
+                )
+                RETURNING {columns(Payment)}
+            ''', (now + lease, now, limit))
+            cursor.row_factory = row_factory(Payment)
+            return cursor.fetchall()
+    
+    def reschedule_payment_check(self, payment_id: str, next_check_at: int):
+        """Назначение следующей проверки ожидающего платежа"""
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                UPDATE payments
+                SET next_check_at = ?
+                WHERE payment_id = ? AND status = 'pending'
+            ''', (next_check_at, payment_id))
+    
+    def expire_stale_payments(self, created_before: int) -> int:
+        """Перевод давно ожидающих платежей и брошенных резервов ключей ('creating' - счета,
+        'charging' - автоплатежи) в 'expired'"""
+        with self.pool.transaction() as conn:
+            cursor = conn.execute('''
+                UPDATE payments
+                SET status = 'expired'
+                WHERE status IN ('pending', 'creating', 'charging') AND created_date < ?
+            ''', (created_before,))
+            return cursor.rowcount
+    
+    @contextmanager
+    def _archive_connection(self):
+        """Соединение из пула с подключенной архивной БД (файл создается при первом обращении)"""
+        with self.pool.connection() as conn:
+            conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+            try:
+                conn.execute('PRAGMA archive.journal_mode = WAL')
+                for statement in ARCHIVE_SCHEMA:
+                    conn.execute(statement)
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.execute('DETACH DATABASE archive')
+    
+    def archive_history(self, before: int, batch_size: int = 500) -> dict:
+        """Перенос одной пачки старой истории в архивную БД: завершенные платежи, созданные
+        до before, и неактивные подписки, закончившиеся до before. Возвращает число перенесенных
+        строк по таблицам.
+        
+        В режиме WAL транзакция над двумя файлами атомарна только для каждого из них, поэтому
+        строки вставляются через INSERT OR IGNORE: после сбоя между фиксациями повторный
+        перенос просто удалит из рабочей БД строки, уже попавшие в архив"""
+        now = int(time.time())
+        moved = {}
+        with self._archive_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for table, record_type, condition in (
+                    ('payments', Payment, "status != 'pending' AND created_date < ?"),
+                    ('subscriptions', Subscription, "is_active = 0 AND end_date < ?"),
+                ):
+                    ids = [row[0] for row in conn.execute(f'''
+                        SELECT id FROM main.{table}
+                        WHERE {condition}
+                        ORDER BY id
+                        LIMIT ?
+                    ''', (before, batch_size))]
+                    moved[table] = len(ids)
+                    if not ids:
+                        continue
+                    placeholders = ', '.join('?' * len(ids))
+                    conn.execute(f'''
+                        INSERT OR IGNORE INTO archive.{table} ({columns(record_type)}, archived_date)
+                        SELECT {columns(record_type)}, ? FROM main.{table} WHERE id IN ({placeholders})
+                    ''', (now, *ids))
+                    conn.execute(f'DELETE FROM main.{table} WHERE id IN ({placeholders})', ids)
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+        return moved
+    
+    def get_user_history(self, user_id: int) -> dict:
+        """Все платежи и подписки пользователя из рабочей и архивной БД (для поддержки)"""
+        # Архив подключается, только если он уже создан: чтение истории не должно создавать файлы
+        archived = os.path.exists(self.archive_path)
+        history = {}
+        with (self._archive_connection() if archived else self.pool.connection()) as conn:
+            for table, record_type, order in (
+                ('payments', Payment, 'created_date'),
+                ('subscriptions', Subscription, 'start_date'),
+            ):
+                query = f'SELECT {columns(record_type)} FROM main.{table} WHERE user_id = ?'
+                params = (user_id,)
+                if archived:
+                    query += f' UNION ALL SELECT {columns(record_type)} FROM archive.{table} WHERE user_id = ?'
+                    params += (user_id,)
+                cursor = conn.execute(f'{query} ORDER BY {order}, id', params)
+                cursor.row_factory = row_factory(record_type)
+                history[table] = cursor.fetchall()
+        return history
+    
+    def create_broadcast(self, text: str, audience: str) -> int:
+        """Создание рассылки, возвращает ее id"""
+        if audience not in BROADCAST_AUDIENCES:
+            raise ValueError(f"Неизвестная аудитория рассылки: {audience}")
+        with self.pool.transaction() as conn:
+            cursor = conn.execute('''
+                INSERT INTO broadcasts (text, audience, created_date)
+                VALUES (?, ?, ?)
+            ''', (text, audience, int(time.time())))
+            return cursor.lastrowid
+    
+    def get_broadcast(self, broadcast_id: int) -> Optional[Broadcast]:
+        """Рассылка по id"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(f'SELECT {columns(Broadcast)} FROM broadcasts WHERE id = ?', (broadcast_id,))
+            cursor.row_factory = row_factory(Broadcast)
+            return cursor.fetchone()
+    
+    def get_unfinished_broadcasts(self) -> List[Broadcast]:
+        """Незавершенные рассылки в порядке создания"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT {columns(Broadcast)} FROM broadcasts
+                WHERE status = 'running'
+                ORDER BY id
+            ''')
+            cursor.row_factory = row_factory(Broadcast)
+            return cursor.fetchall()
+    
+    def get_broadcast_recipients(self, broadcast_id: int, audience: str,
+                                 after_user_id: int, limit: int) -> List[int]:
+        """Следующая страница получателей рассылки: user_id > after_user_id по возрастанию,
+        без уже отмеченных в broadcast_deliveries. Постраничный обход по ключу не держит
+        читающую транзакцию на время всей рассылки"""
+        with self.pool.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT u.user_id FROM users u
+                WHERE u.user_id > :after
+                  AND NOT EXISTS (
+                      SELECT 1 FROM broadcast_deliveries d
+                      WHERE d.broadcast_id = :broadcast_id AND d.user_id = u.user_id
+                  )
+                  {BROADCAST_AUDIENCES[audience]}
+                ORDER BY u.user_id
+                LIMIT :limit
+            ''', {'after': after_user_id, 'broadcast_id': broadcast_id, 'limit': limit, 'now': int(time.time())})
+            return [user_id for user_id, in rows]
+    
+    def count_broadcast_recipients(self, broadcast_id: int, audience: str) -> int:
+        """Сколько получателей рассылки еще не обработано"""
+        with self.pool.connection() as conn:
+            return conn.execute(f'''
+                SELECT COUNT(*) FROM users u
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM broadcast_deliveries d
+                    WHERE d.broadcast_id = :broadcast_id AND d.user_id = u.user_id
+                )
+                {BROADCAST_AUDIENCES[audience]}
+            ''', {'broadcast_id': broadcast_id, 'now': int(time.time())}).fetchone()[0]
+    
+    def record_broadcast_deliveries(self, broadcast_id: int, deliveries: List[tuple]):
+        """Отметки об обработке получателей пачкой: (user_id, status)"""
+        if not deliveries:
+            return
+        with self.pool.transaction() as conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status)
+                VALUES (?, ?, ?)
+            ''', [(broadcast_id, user_id, status) for user_id, status in deliveries])
+    
+    def get_broadcast_stats(self, broadcast_id: int) -> dict:
+        """Число обработанных получателей рассылки по статусам"""
+        with self.pool.connection() as conn:
+            return dict(conn.execute('''
+                SELECT status, COUNT(*) FROM broadcast_deliveries
+                WHERE broadcast_id = ?
+                GROUP BY status
+            ''', (broadcast_id,)).fetchall())
+    
+    def finish_broadcast(self, broadcast_id: int):
+        """Отметка о завершении рассылки"""
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                UPDATE broadcasts
+                SET status = 'finished', finished_date = ?
+                WHERE id = ?
+            ''', (int(time.time()), broadcast_id))
+    
+    def get_report(self) -> dict:
+        """Сводка для отчетов: пользователи, активные подписки, платежи по статусам"""
+        with self.pool.connection() as conn:
+            report = {
+                'users': conn.execute('SELECT COUNT(*) FROM users').fetchone()[0],
+                'active_subscriptions': conn.execute(
+                    'SELECT COUNT(*) FROM subscriptions WHERE is_active = 1 AND end_date > ?',
+                    (int(time.time()),)
+                ).fetchone()[0],
+                'payments': {},
+                'paid_amount': 0
+            }
+            for status, count, amount in conn.execute(
+                'SELECT status, COUNT(*), COALESCE(SUM(amount), 0) FROM payments GROUP BY status'
+            ):
+                report['payments'][status] = count
+                if status == 'paid':
+                    report['paid_amount'] = amount
+            return report
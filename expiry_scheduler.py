@@ -0,0 +1,101 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from async_database import AsyncDatabase
+
+
+class ExpiryScheduler:
+    """Планировщик истечения подписок.
+
+    Дедлайны (end_date) лежат в мин-куче; планировщик спит ровно до ближайшего
+    и запускает обработку истекших подписок. В память загружаются только
+    дедлайны в пределах горизонта (два интервала сверки), остальные подтягивает
+    периодическая сверка, которая заодно страхует от пропущенных событий."""
+
+    def __init__(self, db: AsyncDatabase, sweep: Callable[[], Awaitable[None]],
+                 reconcile_interval: float = 6 * 3600):
+        self.db = db
+        self.sweep = sweep
+        self.reconcile_interval = reconcile_interval
+        self.logger = logging.getLogger(__name__)
+
+        self._heap: List[Tuple[int, int]] = []  # (end_date, user_id)
+        self._deadlines: Dict[int, int] = {}  # Актуальный дедлайн пользователя; устаревшие записи кучи пропускаются
+        self._horizon = 0
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def on_subscription_changed(self, user_id: int, end_date: Optional[int]):
+        """Обработчик изменений подписок из AsyncDatabase"""
+        if end_date is None:
+            self.cancel(user_id)
+        else:
+            self.schedule(user_id, end_date)
+
+    def schedule(self, user_id: int, end_date: int):
+        """Добавление дедлайна пользователя (учитывается самый поздний)"""
+        if end_date > self._horizon or end_date <= self._deadlines.get(user_id, 0):
+            return
+
+        self._deadlines[user_id] = end_date
+        heapq.heappush(self._heap, (end_date, user_id))
+        # Будим цикл, только если новый дедлайн стал ближайшим
+        if self._wakeup is not None and self._heap[0] == (end_date, user_id):
+            self._wakeup.set()
+
+    def cancel(self, user_id: int):
+        """Снятие дедлайна пользователя (запись в куче удалится лениво)"""
+        self._deadlines.pop(user_id, None)
+
+    def _pop_due(self, now: float) -> int:
+        """Извлечение наступивших дедлайнов, возвращает число актуальных"""
+        due = 0
+        while self._heap and self._heap[0][0] <= now:
+            end_date, user_id = heapq.heappop(self._heap)
+            if self._deadlines.get(user_id) == end_date:
+                del self._deadlines[user_id]
+                due += 1
+        return due
+
+    async def _reconcile(self):
+        """Страховочная сверка: полная обработка истекших и загрузка дедлайнов на новый горизонт"""
+        await self.sweep()
+        self._horizon = int(time.time() + 2 * self.reconcile_interval)
+        async for user_id, end_date in self.db.iter_subscription_deadlines(self._horizon):
+            self.schedule(user_id, end_date)
+        self.logger.info(f"Сверка подписок выполнена, дедлайнов в очереди: {len(self._deadlines)}")
+
+    async def run(self):
+        """Основной цикл: сон до ближайшего дедлайна или до следующей сверки"""
+        self._wakeup = asyncio.Event()
+        next_reconcile = 0.0
+
+        while True:
+            try:
+                now = time.time()
+                if now >= next_reconcile:
+                    await self._reconcile()
+                    next_reconcile = time.time() + self.reconcile_interval
+                    continue
+
+                if self._pop_due(now):
+                    await self.sweep()
+                    continue
+
+                timeout = next_reconcile - now
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now)
+
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Ошибка в планировщике истечения подписок: {e}")
+                await asyncio.sleep(300)  # При ошибке ждем 5 минут
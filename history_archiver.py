@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import time
+
+from async_database import AsyncDatabase
+from database import Database
+from sharded_database import ShardedDatabase, shard_path
+
+
+class HistoryArchiver:
+    """Фоновый перенос старой истории из рабочих таблиц в архивную БД.
+
+    Завершенные платежи (включая брошенные, которые сверка перевела в 'expired')
+    и неактивные подписки старше horizon_days переносятся пачками по batch_size
+    строк. Каждая пачка - короткая отдельная транзакция, между пачками делается
+    пауза, чтобы запись бота не ждала блокировку."""
+
+    def __init__(self, db: AsyncDatabase, horizon_days: int = 180, interval: float = 6 * 3600,
+                 batch_size: int = 500, pause: float = 0.2):
+        self.db = db
+        self.horizon_days = horizon_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.logger = logging.getLogger(__name__)
+
+        self.stats = {'payments': 0, 'subscriptions': 0, 'batches': 0}
+
+    async def run_once(self) -> dict:
+        """Один проход: переносит все, что старше горизонта, возвращает число строк по таблицам"""
+        before = int(time.time()) - self.horizon_days * 86400
+        moved = {'payments': 0, 'subscriptions': 0}
+        while True:
+            batch = await self.db.archive_history(before, self.batch_size)
+            self.stats['batches'] += 1
+            for table, count in batch.items():
+                moved[table] += count
+                self.stats[table] += count
+            if max(batch.values(), default=0) < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+        if any(moved.values()):
+            self.logger.info(f"Перенесено в архив: {moved}")
+        return moved
+
+    async def run(self):
+        """Фоновая задача архивации"""
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.logger.error(f"Ошибка архивации истории: {e}")
+            await asyncio.sleep(self.interval)
+
+
+def _format_date(timestamp) -> str:
+    if timestamp is None:
+        return '-'
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y %H:%M')
+
+
+def print_user_history(db, user_id: int):
+    """Вывод истории пользователя для обращений в поддержку"""
+    history = db.get_user_history(user_id)
+    print(f"Платежи пользователя {user_id}:")
+    for payment in history['payments']:
+        print(f"  {_format_date(payment.created_date)}  {payment.payment_id}  "
+              f"{payment.amount / 100:.2f} руб.  {payment.status}  оплачен: {_format_date(payment.paid_date)}")
+    print(f"Подписки пользователя {user_id}:")
+    for subscription in history['subscriptions']:
+        print(f"  {_format_date(subscription.start_date)} - {_format_date(subscription.end_date)}  "
+              f"активна: {subscription.is_active}  платеж: {subscription.payment_id}")
+
+
+async def archive_once(db, horizon_days: int, batch_size: int) -> dict:
+    """Проход архивации из командной строки тем же кодом, что и у фоновой задачи"""
+    async_db = AsyncDatabase(db)
+    try:
+        return await HistoryArchiver(async_db, horizon_days, batch_size=batch_size).run_once()
+    finally:
+        await async_db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Архив истории платежей и подписок")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    history_parser = subparsers.add_parser('history', help="История пользователя, включая архив")
+    history_parser.add_argument('database', help="Путь к БД, например bot_database.db")
+    history_parser.add_argument('user_id', type=int)
+    history_parser.add_argument('--shards', type=int, default=1, help="Количество шардов (DATABASE_SHARDS)")
+
+    archive_parser = subparsers.add_parser('archive', help="Перенести старую историю в архив")
+    archive_parser.add_argument('database', help="Путь к БД, например bot_database.db")
+    archive_parser.add_argument('--days', type=int, default=180, help="Горизонт в днях")
+    archive_parser.add_argument('--shards', type=int, default=1, help="Количество шардов (DATABASE_SHARDS)")
+    archive_parser.add_argument('--batch-size', type=int, default=500)
+
+    args = parser.parse_args()
+    first_file = shard_path(args.database, 0) if args.shards > 1 else args.database
+    if not os.path.exists(first_file):
+        parser.error(f"БД не найдена: {first_file}")
+    db = ShardedDatabase(args.database, args.shards) if args.shards > 1 else Database(args.database)
+    try:
+        if args.command == 'history':
+            print_user_history(db, args.user_id)
+        elif args.command == 'archive':
+            moved = asyncio.run(archive_once(db, args.days, args.batch_size))
+            print(f"Перенесено в архив: {moved}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    408: 'Request Timeout',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class HTTPRequest:
+    """Входящий HTTP-запрос"""
+
+    def __init__(self, method: str, target: str, headers: Dict[str, str], body: bytes,
+                 peer: Optional[Tuple[str, int]] = None):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path
+        self.query = dict(parse_qsl(parts.query))
+        self.headers = headers  # Имена заголовков в нижнем регистре
+        self.body = body
+        self.peer = peer
+
+    def json(self):
+        """Тело запроса как JSON"""
+        return json.loads(self.body.decode('utf-8'))
+
+    def form(self) -> Dict[str, str]:
+        """Тело запроса как application/x-www-form-urlencoded (параметры строки запроса тоже учитываются)"""
+        params = dict(self.query)
+        params.update(parse_qsl(self.body.decode('utf-8')))
+        return params
+
+
+class HTTPResponse:
+    """Ответ на HTTP-запрос"""
+
+    def __init__(self, status: int = 200, body=b'', content_type: str = 'text/plain; charset=utf-8',
+                 headers: Optional[Dict[str, str]] = None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @classmethod
+    def json(cls, data, status: int = 200) -> 'HTTPResponse':
+        return cls(status, json.dumps(data, ensure_ascii=False), 'application/json; charset=utf-8')
+
+    def encode(self, keep_alive: bool) -> bytes:
+        lines = [
+            f"HTTP/1.1 {self.status} {REASONS.get(self.status, 'Unknown')}",
+            f"Content-Type: {self.content_type}",
+            f"Content-Length: {len(self.body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        lines.extend(f"{name}: {value}" for name, value in self.headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + self.body
+
+
+Handler = Callable[[HTTPRequest], Awaitable[HTTPResponse]]
+
+
+class HTTPServer:
+    """Минимальный HTTP/1.1-сервер на asyncio для вебхуков.
+
+    Маршруты - точное совпадение (метод, путь) в словаре, префиксные маршруты
+    проверяются после него. Поддерживаются keep-alive и тело с Content-Length;
+    chunked-запросы не принимаются."""
+
+    def __init__(self, host: str = '0.0.0.0', port: int = 8080, max_body_size: int = 1024 * 1024,
+                 read_timeout: float = 15.0):
+        self.host = host
+        self.port = port
+        self.max_body_size = max_body_size
+        self.read_timeout = read_timeout
+        self.logger = logging.getLogger(__name__)
+
+        self._routes: Dict[Tuple[str, str], Handler] = {}
+        self._prefix_routes: List[Tuple[str, str, Handler]] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[asyncio.StreamWriter, asyncio.Task] = {}
+
+    def add_route(self, method: str, path: str, handler: Handler):
+        """Регистрация обработчика для метода и пути"""
+        self._routes[(method.upper(), path)] = handler
+
+    def add_prefix_route(self, method: str, prefix: str, handler: Handler):
+        """Регистрация обработчика для всех путей с префиксом (например, /v3/payments/<id>)"""
+        self._prefix_routes.append((method.upper(), prefix, handler))
+
+    @property
+    def bound_port(self) -> int:
+        """Фактический порт (полезно при port=0)"""
+        return self._server.sockets[0].getsockname()[1] if self._server else self.port
+
+    async def start(self):
+        """Запуск приема соединений"""
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.logger.info(f"HTTP-сервер слушает {self.host}:{self.bound_port}")
+
+    async def stop(self):
+        """Остановка сервера"""
+        if self._server is not None:
+            self._server.close()
+            # Простаивающие keep-alive соединения закрываем сами, иначе wait_closed будет их ждать
+            for writer in list(self._connections):
+                writer.close()
+            if self._connections:
+                await asyncio.wait(list(self._connections.values()), timeout=self.read_timeout)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader: asyncio.StreamReader, peer) -> Optional[HTTPRequest]:
+        """Чтение одного запроса; None - клиент закрыл соединение"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise ValueError("Некорректная строка запроса")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            raise ValueError("Chunked-запросы не поддерживаются")
+        length = int(headers.get('content-length') or 0)
+        if length > self.max_body_size:
+            raise OverflowError("Слишком большое тело запроса")
+        body = await reader.readexactly(length) if length else b''
+        return HTTPRequest(method.upper(), target, headers, body, peer)
+
+    async def _dispatch(self, request: HTTPRequest) -> HTTPResponse:
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            handler = next((
+                prefix_handler for method, prefix, prefix_handler in self._prefix_routes
+                if method == request.method and request.path.startswith(prefix)
+            ), None)
+        if handler is None:
+            if any(path == request.path for _, path in self._routes) or any(
+                request.path.startswith(prefix) for _, prefix, _ in self._prefix_routes
+            ):
+                return HTTPResponse(405, 'Method Not Allowed')
+            return HTTPResponse(404, 'Not Found')
+        try:
+            return await handler(request)
+        except Exception as e:
+            self.logger.error(f"Ошибка обработки {request.method} {request.path}: {e}")
+            return HTTPResponse(500, 'Internal Server Error')
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername')
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader, peer), self.read_timeout)
+                except asyncio.TimeoutError:
+                    break
+                except OverflowError:
+                    writer.write(HTTPResponse(413, 'Payload Too Large').encode(keep_alive=False))
+                    break
+                except (ValueError, asyncio.IncompleteReadError):
+                    writer.write(HTTPResponse(400, 'Bad Request').encode(keep_alive=False))
+                    break
+                if request is None:
+                    break
+
+                response = await self._dispatch(request)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                writer.write(response.encode(keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
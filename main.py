@@ -1,13 +1,31 @@
 import asyncio
+import datetime
 import logging
 import os
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, TypeHandler
 from dotenv import load_dotenv
 
-from database import Database
+from database import BROADCAST_AUDIENCES, Database
+from async_database import AsyncDatabase
+from sharded_database import ShardedDatabase
+from user_profile_writer import UserProfileWriter
 from payment_system import MockPaymentSystem, YooKassaPayment, RobokassaPayment
+from payment_simulator import SimulatedPaymentSystem
 from subscription_manager import SubscriptionManager, run_subscription_checker
+from payment_reconciler import PaymentReconciler
+from payment_intents import PaymentIntents
+from payment_status import PaymentStatusLookup
+from renewal_engine import RenewalEngine
+from history_archiver import HistoryArchiver
+from resilience import ProviderUnavailableError
+from http_server import HTTPServer, HTTPResponse
+from payment_webhooks import PaymentWebhookHandler
+from telegram_updates import ALLOWED_UPDATES, TelegramWebhook, UserOrderedUpdateProcessor
+from callback_router import CallbackRouter, build_keyboard
+from user_rate_limiter import UserRateLimiter
+from broadcaster import Broadcaster
+from telegram_pacer import TelegramPacer
 
 # Загружаем переменные окружения
 load_dotenv() 
@@ -22,21 +40,90 @@ PAID_CHANNEL_ID = os.getenv('PAID_CHANNEL_ID')
 USE_REAL_PAYMENTS = os.getenv('USE_REAL_PAYMENTS', 'False').lower() == 'true'
 PAYMENT_PROVIDER = os.getenv('PAYMENT_PROVIDER', 'mock')
 
+# Интервал страховочной сверки истекших подписок (секунды)
+SUBSCRIPTION_RECONCILE_INTERVAL = float(os.getenv('SUBSCRIPTION_RECONCILE_INTERVAL', '21600'))
+
+# Фоновая сверка ожидающих платежей
+PAYMENT_RECONCILE_INTERVAL = float(os.getenv('PAYMENT_RECONCILE_INTERVAL', '30'))
+PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv('PAYMENT_RECONCILE_CONCURRENCY', '10'))
+PAYMENT_PENDING_TTL = int(os.getenv('PAYMENT_PENDING_TTL', '86400'))
+# Сколько секунд неоплаченный счет выдается повторно вместо создания нового
+PAYMENT_INTENT_TTL = int(os.getenv('PAYMENT_INTENT_TTL', '3600'))
+# Сколько секунд ответ "еще не оплачен" переиспользуется для повторных нажатий "Проверить оплату"
+PAYMENT_STATUS_CACHE_TTL = float(os.getenv('PAYMENT_STATUS_CACHE_TTL', '5'))
+
+# Автопродление: за сколько секунд до окончания списывать, как часто проверять и сколько списаний параллельно
+RENEWAL_WINDOW = int(os.getenv('RENEWAL_WINDOW', '259200'))
+RENEWAL_INTERVAL = float(os.getenv('RENEWAL_INTERVAL', '600'))
+RENEWAL_CONCURRENCY = int(os.getenv('RENEWAL_CONCURRENCY', '20'))
+
+# Перенос старых платежей и неактивных подписок в архивную БД (0 дней - выключен)
+HISTORY_ARCHIVE_DAYS = int(os.getenv('HISTORY_ARCHIVE_DAYS', '180'))
+HISTORY_ARCHIVE_INTERVAL = float(os.getenv('HISTORY_ARCHIVE_INTERVAL', '21600'))
+
+# HTTP-сервер для уведомлений платежных систем (пустой порт - выключен)
+PAYMENT_WEBHOOK_HOST = os.getenv('PAYMENT_WEBHOOK_HOST', '0.0.0.0')
+PAYMENT_WEBHOOK_PORT = os.getenv('PAYMENT_WEBHOOK_PORT', '')
+
+# Прием обновлений Telegram: пустой URL - long polling, иначе вебхук на HTTP-сервере бота
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', '')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET') or None
+# Сколько обновлений обрабатывается одновременно (обновления одного пользователя - по очереди)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
+
 # Робокасса
 ROBOKASSA_MERCHANT_LOGIN = os.getenv('ROBOKASSA_MERCHANT_LOGIN')
 ROBOKASSA_PASSWORD1 = os.getenv('ROBOKASSA_PASSWORD1')
 ROBOKASSA_PASSWORD2 = os.getenv('ROBOKASSA_PASSWORD2')
 ROBOKASSA_TEST_MODE = os.getenv('ROBOKASSA_TEST_MODE', 'True').lower() == 'true'
+# Подключен ли сервис "Робокасса Рекуррент" (автоплатежи)
+ROBOKASSA_RECURRING = os.getenv('ROBOKASSA_RECURRING', 'False').lower() == 'true'
+# Адреса API (переопределяются для локального стенда payment_simulator.py)
+ROBOKASSA_API_URL = os.getenv('ROBOKASSA_API_URL') or None
+ROBOKASSA_RECURRING_URL = os.getenv('ROBOKASSA_RECURRING_URL') or None
 
 # ЮKassa
 YOOKASSA_SHOP_ID = os.getenv('YOOKASSA_SHOP_ID')
 YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY')
+YOOKASSA_API_URL = os.getenv('YOOKASSA_API_URL') or None
+
+# Симулятор платежной системы (PAYMENT_PROVIDER=simulator): задержки и сбои для нагрузочных прогонов
+SIMULATOR_LATENCY_MS = float(os.getenv('SIMULATOR_LATENCY_MS', '200'))
+SIMULATOR_ERROR_RATE = float(os.getenv('SIMULATOR_ERROR_RATE', '0'))
+SIMULATOR_TIMEOUT_RATE = float(os.getenv('SIMULATOR_TIMEOUT_RATE', '0'))
+SIMULATOR_SUCCESS_DELAY = float(os.getenv('SIMULATOR_SUCCESS_DELAY', '30'))
+
+# Общий темп вызовов Bot API из фоновых задач (рассылки, отзыв доступа, уведомления).
+# Telegram допускает около 30 сообщений в секунду от одного бота
+TELEGRAM_API_RATE = float(os.getenv('TELEGRAM_API_RATE', '25'))
+TELEGRAM_API_CONCURRENCY = int(os.getenv('TELEGRAM_API_CONCURRENCY', '16'))
+
+# Рассылки: администраторы (user_id через запятую) и число параллельных отправителей
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').replace(',', ' ').split()}
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
 
 # База данных
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'bot_database.db')
+DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', '4'))
+DATABASE_SHARDS = int(os.getenv('DATABASE_SHARDS', '1'))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '10000'))
+SUBSCRIPTION_CACHE_TTL = float(os.getenv('SUBSCRIPTION_CACHE_TTL', '300'))
+USER_FLUSH_INTERVAL_MS = int(os.getenv('USER_FLUSH_INTERVAL_MS', '500'))
+USER_FLUSH_BATCH = int(os.getenv('USER_FLUSH_BATCH', '500'))
 
 # Инициализация компонентов
-db = Database(DATABASE_PATH)
+if DATABASE_SHARDS > 1:
+    storage = ShardedDatabase(
+        DATABASE_PATH,
+        DATABASE_SHARDS,
+        DATABASE_POOL_SIZE,
+        SUBSCRIPTION_CACHE_SIZE,
+        SUBSCRIPTION_CACHE_TTL
+    )
+else:
+    storage = Database(DATABASE_PATH, DATABASE_POOL_SIZE, SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL)
+db = AsyncDatabase(storage)
+user_writer = UserProfileWriter(db, USER_FLUSH_INTERVAL_MS / 1000, USER_FLUSH_BATCH)
 
 if USE_REAL_PAYMENTS:
     if PAYMENT_PROVIDER == "robokassa":
@@ -44,19 +131,36 @@ if USE_REAL_PAYMENTS:
             ROBOKASSA_MERCHANT_LOGIN, 
             ROBOKASSA_PASSWORD1, 
             ROBOKASSA_PASSWORD2,
-            ROBOKASSA_TEST_MODE
+            ROBOKASSA_TEST_MODE,
+            ROBOKASSA_RECURRING,
+            ROBOKASSA_API_URL,
+            ROBOKASSA_RECURRING_URL,
+            invoice_numbers=db.get_invoice_number
         )
     elif PAYMENT_PROVIDER == "yookassa":
-        payment_system = YooKassaPayment(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
+        payment_system = YooKassaPayment(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, YOOKASSA_API_URL)
+    elif PAYMENT_PROVIDER == "simulator":
+        payment_system = SimulatedPaymentSystem(
+            latency=SIMULATOR_LATENCY_MS / 1000,
+            error_rate=SIMULATOR_ERROR_RATE,
+            timeout_rate=SIMULATOR_TIMEOUT_RATE,
+            success_delay=SIMULATOR_SUCCESS_DELAY,
+            # Уведомления об оплате приходят на собственный HTTP-сервер бота
+            webhook_url=f"http://127.0.0.1:{PAYMENT_WEBHOOK_PORT}/yookassa/notifications" if PAYMENT_WEBHOOK_PORT else None
+        )
     else:
         payment_system = MockPaymentSystem()
 else:
     payment_system = MockPaymentSystem()
+payment_intents = PaymentIntents(db, payment_system, PAYMENT_INTENT_TTL)
+payment_status = PaymentStatusLookup(payment_system, PAYMENT_STATUS_CACHE_TTL)
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
 # Тексты сообщений
+PROVIDER_UNAVAILABLE_TEXT = "⏳ Платежная система временно недоступна. Попробуйте через несколько минут."
+
 WELCOME_TEXT = """Привет! Это Ольга Сухова и мой бот-ассистент, я благодарю тебя за интерес к моему каналу и помогу тебе во всём, что касается присоединению к каналу и твоему комфортному нахождению в нём."""
 
 ABOUT_CHANNEL_TEXT = """Мой канал — для тех, кто не прячется за оправданиями и не списывает всё подряд на «плохое настроение», а хочет осознанно и целостно подойти к своему здоровью — и телесному, и ментальному."""
@@ -88,164 +192,127 @@ DOCUMENTS_TEXT = """Осталась последняя формальность
 2. Политика обработки персональных данных
 3. Согласие на обработку персональных данных"""
 
+# Статические шаги воронки: (callback_data, текст, кнопки (текст, callback_data)).
+# Клавиатуры собираются один раз при запуске; новый шаг - новая строка здесь
+FUNNEL = [
+    ("about_channel", ABOUT_CHANNEL_TEXT, [[("А что ещё?", "philosophy")]]),
+    ("philosophy", PHILOSOPHY_TEXT, [[("Что хочу вам дать?", "what_i_give")]]),
+    ("what_i_give", WHAT_I_GIVE_TEXT, [[("Что внутри канала?", "channel_content")]]),
+    ("channel_content", CHANNEL_CONTENT_TEXT, [[("Как оформить подписку?", "subscription_info")]]),
+    ("subscription_info", SUBSCRIPTION_INFO_TEXT, [[("Далее", "documents")]]),
+    ("documents", DOCUMENTS_TEXT, [[("Принято", "accepted")]]),
+    ("accepted", "Отлично! Теперь можно перейти к оплате.", [[("Перейти к оплате подписки", "payment")]]),
+]
+START_KEYBOARD = build_keyboard([[("Про что мой канал", "about_channel")]])
+
+def format_date(timestamp: int) -> str:
+    """Форматирование Unix-времени из БД для сообщений пользователю"""
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y %H:%M')
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет приветственное сообщение при вызове команды /start."""
     user = update.effective_user
     
-    # Добавляем пользователя в БД
-    db.add_user(
+    # Добавляем пользователя в БД (запись буферизуется и пропускается, если профиль не менялся)
+    user_writer.submit(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
         last_name=user.last_name
     )
     
-    keyboard = [
-        [InlineKeyboardButton("Про что мой канал", callback_data="about_channel")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(WELCOME_TEXT, reply_markup=reply_markup)
-
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает нажатия кнопок."""
-    query = update.callback_query
-    await query.answer()
-
-    if query.data == "about_channel":
-        keyboard = [
-            [InlineKeyboardButton("А что ещё?", callback_data="philosophy")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(text=ABOUT_CHANNEL_TEXT, reply_markup=reply_markup)
-    
-    elif query.data == "philosophy":
-        keyboard = [
-            [InlineKeyboardButton("Что хочу вам дать?", callback_data="what_i_give")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(text=PHILOSOPHY_TEXT, reply_markup=reply_markup)
-    
-    elif query.data == "what_i_give":
-        keyboard = [
-            [InlineKeyboardButton("Что внутри канала?", callback_data="channel_content")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(text=WHAT_I_GIVE_TEXT, reply_markup=reply_markup)
-    
-    elif query.data == "channel_content":
-        keyboard = [
-            [InlineKeyboardButton("Как оформить подписку?", callback_data="subscription_info")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(text=CHANNEL_CONTENT_TEXT, reply_markup=reply_markup)
-    
-    elif query.data == "subscription_info":
-        keyboard = [
-            [InlineKeyboardButton("Далее", callback_data="documents")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(text=SUBSCRIPTION_INFO_TEXT, reply_markup=reply_markup)
-    
-    elif query.data == "documents":
-        keyboard = [
-            [InlineKeyboardButton("Принято", callback_data="accepted")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(text=DOCUMENTS_TEXT, reply_markup=reply_markup)
+    await update.message.reply_text(WELCOME_TEXT, reply_markup=START_KEYBOARD)
+
+async def payment_button(query, _: str) -> None:
+    """Выдача счета на оплату подписки"""
+    user_id = query.from_user.id
     
-    elif query.data == "accepted":
-        keyboard = [
-            [InlineKeyboardButton("Перейти к оплате подписки", callback_data="payment")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(text="Отлично! Теперь можно перейти к оплате.", reply_markup=reply_markup)
+    # Проверяем, есть ли уже активная подписка
+    subscription = await db.get_user_subscription(user_id)
+    if subscription:
+        await query.message.reply_text(
+            text="✅ У вас уже есть активная подписка! "
+                 f"Действует до: {format_date(subscription.end_date)}"
+        )
+        return
     
-    elif query.data == "payment":
-        user_id = query.from_user.id
-        
-        # Проверяем, есть ли уже активная подписка
-        subscription = db.get_user_subscription(user_id)
-        if subscription:
-            await query.message.reply_text(
-                text="✅ У вас уже есть активная подписка! "
-                     f"Действует до: {subscription['end_date']}"
-            )
-            return
-        
-        # Создаем платеж
-        payment = payment_system.create_payment(
+    # Выдаем открытый счет или создаем платеж (сохраняется в БД)
+    try:
+        payment = await payment_intents.get_or_create(
+            user_id=user_id,
             amount=100000,  # 1000 рублей в копейках
             description="Подписка на канал Ольги Суховой",
-            user_id=user_id
+            save_payment_method=True
         )
-        
-        if payment:
-            # Сохраняем информацию о платеже в БД
-            db.add_payment(
-                user_id=user_id,
-                payment_id=payment['id'],
-                amount=100000,
-                status='pending'
-            )
+    except ProviderUnavailableError as e:
+        logging.warning(f"Не удалось создать платеж: {e}")
+        await query.message.reply_text(text=PROVIDER_UNAVAILABLE_TEXT)
+        return
+    
+    if payment:
+        if USE_REAL_PAYMENTS:
+            # Для реальных платежей отправляем ссылку на оплату
+            keyboard = [
+                [InlineKeyboardButton("💳 Оплатить", url=payment.confirmation_url)],
+                [InlineKeyboardButton("🔄 Проверить оплату", callback_data=f"check_payment_{payment.payment_id}")]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
             
-            if USE_REAL_PAYMENTS:
-                # Для реальных платежей отправляем ссылку на оплату
-                payment_url = payment['confirmation']['confirmation_url']
-                keyboard = [
-                    [InlineKeyboardButton("💳 Оплатить", url=payment_url)],
-                    [InlineKeyboardButton("🔄 Проверить оплату", callback_data=f"check_payment_{payment['id']}")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.message.reply_text(
-                    text="💳 Для оплаты подписки нажмите кнопку ниже.\n\n"
-                         "После успешной оплаты нажмите 'Проверить оплату'.",
-                    reply_markup=reply_markup
-                )
-            else:
-                # Для тестирования автоматически помечаем платеж как успешный
-                payment_system.simulate_successful_payment(payment['id'])
-                await process_successful_payment(payment['id'], query)
-        else:
             await query.message.reply_text(
-                text="❌ Ошибка создания платежа. Попробуйте позже или обратитесь в поддержку."
+                text="💳 Для оплаты подписки нажмите кнопку ниже.\n\n"
+                     "После успешной оплаты нажмите 'Проверить оплату'.",
+                reply_markup=reply_markup
             )
+        else:
+            # Для тестирования автоматически помечаем платеж как успешный
+            payment_system.simulate_successful_payment(payment.payment_id)
+            payment_info = await payment_system.check_payment_status(payment.payment_id)
+            await process_successful_payment(payment.payment_id, query, payment_info)
+    else:
+        await query.message.reply_text(
+            text="❌ Ошибка создания платежа. Попробуйте позже или обратитесь в поддержку."
+        )
+
+async def cancel_subscription_button(query, _: str) -> None:
+    """Отмена подписки и автоплатежей"""
+    user_id = query.from_user.id
     
-    elif query.data.startswith("check_payment_"):
-        payment_id = query.data.replace("check_payment_", "")
-        await check_payment_status(payment_id, query)
+    # Деактивируем подписку и забываем способ оплаты
+    await db.deactivate_subscription(user_id)
+    await db.delete_payment_method(user_id)
     
-    elif query.data == "cancel_subscription":
-        user_id = query.from_user.id
-        
-        # Деактивируем подписку
-        db.deactivate_subscription(user_id)
+    # Удаляем из канала
+    try:
+        bot = query.bot
+        subscription_manager = SubscriptionManager(bot, db, payment_system, PAID_CHANNEL_ID)
+        await subscription_manager._remove_user_from_channel(user_id)
         
-        # Удаляем из канала
-        try:
-            bot = query.bot
-            subscription_manager = SubscriptionManager(bot, db, payment_system, PAID_CHANNEL_ID)
-            await subscription_manager._remove_user_from_channel(user_id)
-            
-            await query.message.reply_text(
-                text="✅ Подписка отменена. Автоплатежи остановлены.\n\n"
-                     "Вы можете оформить новую подписку в любое время, нажав /start"
-            )
-        except Exception as e:
-            logging.error(f"Ошибка при отмене подписки: {e}")
-            await query.message.reply_text(
-                text="✅ Подписка отменена. Автоплатежи остановлены."
-            )
-    
-    else:
-        await query.message.reply_text(text=f"Неизвестная команда: {query.data}")
+        await query.message.reply_text(
+            text="✅ Подписка отменена. Автоплатежи остановлены.\n\n"
+                 "Вы можете оформить новую подписку в любое время, нажав /start"
+        )
+    except Exception as e:
+        logging.error(f"Ошибка при отмене подписки: {e}")
+        await query.message.reply_text(
+            text="✅ Подписка отменена. Автоплатежи остановлены."
+        )
+
+async def unknown_button(query, data: str) -> None:
+    """Нажатие кнопки без обработчика (например, из старого сообщения)"""
+    await query.message.reply_text(text=f"Неизвестная команда: {data}")
 
 async def check_payment_status(payment_id: str, query):
     """Проверка статуса платежа"""
-    payment_info = payment_system.check_payment_status(payment_id)
+    try:
+        payment_info = await payment_status.check_payment_status(payment_id)
+    except ProviderUnavailableError as e:
+        logging.warning(f"Не удалось проверить платеж {payment_id}: {e}")
+        keyboard = [[InlineKeyboardButton("🔄 Проверить снова", callback_data=f"check_payment_{payment_id}")]]
+        await query.message.reply_text(text=PROVIDER_UNAVAILABLE_TEXT, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
     
     if payment_info and payment_info.get('status') == 'succeeded':
-        await process_successful_payment(payment_id, query)
+        await process_successful_payment(payment_id, query, payment_info)
     else:
         keyboard = [
             [InlineKeyboardButton("🔄 Проверить снова", callback_data=f"check_payment_{payment_id}")],
@@ -258,23 +325,21 @@ async def check_payment_status(payment_id: str, query):
             reply_markup=reply_markup
         )
 
-async def process_successful_payment(payment_id: str, query):
+async def process_successful_payment(payment_id: str, query, payment_info: dict = None):
     """Обработка успешной оплаты"""
-    user_id = query.from_user.id
-    
-    # Обновляем статус платежа в БД
-    db.update_payment_status(payment_id, 'paid')
-    
-    # Создаем подписку
-    db.create_subscription(user_id, payment_id, 100000)
-    
-    # Добавляем пользователя в канал (если subscription_manager инициализирован)
     try:
+        # Платеж помечается оплаченным и создает подписку ровно один раз,
+        # даже если его параллельно обработала фоновая сверка
         bot = query.bot
         subscription_manager = SubscriptionManager(bot, db, payment_system, PAID_CHANNEL_ID)
-        success = await subscription_manager.add_user_to_channel(user_id)
+        success = await subscription_manager.activate_payment(payment_id, payment_info)
         
-        if success:
+        if success is None:
+            await query.message.reply_text(
+                text="✅ Этот платеж уже обработан, подписка активна.\n\n"
+                     "Для управления подпиской используйте команду /subscription"
+            )
+        elif success:
             await query.message.reply_text(
                 text="🎉 Отлично! Оплата прошла успешно.\n\n"
                      "Вы получили персональную ссылку для доступа к каналу. "
@@ -295,7 +360,7 @@ async def process_successful_payment(payment_id: str, query):
 async def subscription_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда для управления подпиской"""
     user_id = update.effective_user.id
-    subscription = db.get_user_subscription(user_id)
+    subscription = await db.get_user_subscription(user_id)
     
     if subscription:
         keyboard = [
@@ -305,9 +370,9 @@ async def subscription_command(update: Update, context: ContextTypes.DEFAULT_TYP
         
         await update.message.reply_text(
             text=f"📋 Ваша подписка:\n\n"
-                 f"Статус: {'✅ Активна' if subscription['is_active'] else '❌ Неактивна'}\n"
-                 f"Действует до: {subscription['end_date']}\n"
-                 f"Стоимость: {subscription['amount'] / 100} ₽\n\n"
+                 f"Статус: {'✅ Активна' if subscription.is_active else '❌ Неактивна'}\n"
+                 f"Действует до: {format_date(subscription.end_date)}\n"
+                 f"Стоимость: {subscription.amount / 100} ₽\n\n"
                  f"Автоплатеж включен. Подписка будет автоматически продлена.",
             reply_markup=reply_markup
         )
@@ -375,28 +440,162 @@ async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "• /test - эта команда"
     )
 
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Запуск рассылки: /broadcast active|all текст (только для администраторов)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    parts = (update.message.text or '').split(maxsplit=2)
+    if len(parts) < 3 or parts[1] not in BROADCAST_AUDIENCES:
+        await update.message.reply_text(
+            "Использование: /broadcast active|all текст\n\n"
+            "• active - пользователям с действующей подпиской\n"
+            "• all - всем пользователям бота"
+        )
+        return
+    
+    broadcaster = context.bot_data['broadcaster']
+    broadcast_id = await broadcaster.start_broadcast(parts[2], parts[1])
+    await update.message.reply_text(
+        f"📨 Рассылка #{broadcast_id} поставлена в очередь. Ход рассылки: /broadcast_status"
+    )
+
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ход текущей рассылки (только для администраторов)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    progress = context.bot_data['broadcaster'].progress()
+    if progress is None:
+        await update.message.reply_text("Сейчас рассылок нет.")
+        return
+    
+    eta = f"~{progress['eta']} с" if progress['eta'] is not None else "неизвестно"
+    await update.message.reply_text(
+        f"📨 Рассылка #{progress['id']}: {progress['done']} из {progress['total']}\n"
+        f"Доставлено: {progress['sent']}, недоступно: {progress['blocked']}, ошибок: {progress['failed']}\n"
+        f"Скорость: {progress['rate']} сообщ/с, осталось: {eta}"
+    )
+
+async def health(request) -> HTTPResponse:
+    """Состояние платежной системы для мониторинга: 503, пока цепь провайдера не замкнута"""
+    resilience = getattr(payment_system, 'resilience', None)
+    provider = resilience.snapshot() if resilience is not None else None
+    healthy = provider is None or provider['breaker']['state'] == 'closed'
+    return HTTPResponse.json(
+        {
+            'status': 'ok' if healthy else 'degraded',
+            'provider': type(payment_system).__name__,
+            'resilience': provider,
+            'status_lookup': payment_status.snapshot(),
+        },
+        status=200 if healthy else 503
+    )
+
+# Нажатия кнопок: шаги воронки и обработчики по callback_data
+button = CallbackRouter(fallback=unknown_button)
+button.add_funnel(FUNNEL)
+button.add("payment", payment_button)
+button.add("cancel_subscription", cancel_subscription_button)
+button.add_prefix("check_payment_", lambda query, payment_id: check_payment_status(payment_id, query))
+
 def main() -> None:
     """Запускает бота."""
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(UserOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+        .build()
+    )
 
+    # Ограничение частоты действий пользователя проверяется раньше всех обработчиков
+    application.add_handler(TypeHandler(Update, UserRateLimiter()), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("subscription", subscription_command))
     application.add_handler(CommandHandler("get_chat_id", get_chat_id_command))  # Временная команда
     application.add_handler(CommandHandler("test", test_command))  # Тестовая команда
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("broadcast_status", broadcast_status_command))
     application.add_handler(CallbackQueryHandler(button))
 
-    # Создаем subscription_manager для фоновых задач
+    # Создаем subscription_manager для фоновых задач: их вызовы Bot API идут в общем темпе,
+    # а ответы на нажатия пользователей (SubscriptionManager без pacer) его не ждут
     bot = application.bot
-    subscription_manager = SubscriptionManager(bot, db, payment_system, PAID_CHANNEL_ID)
+    telegram_pacer = TelegramPacer(TELEGRAM_API_RATE, TELEGRAM_API_CONCURRENCY)
+    subscription_manager = SubscriptionManager(bot, db, payment_system, PAID_CHANNEL_ID, telegram_pacer)
+    payment_reconciler = PaymentReconciler(
+        db,
+        payment_system,
+        subscription_manager.activate_payment,
+        interval=PAYMENT_RECONCILE_INTERVAL,
+        concurrency=PAYMENT_RECONCILE_CONCURRENCY,
+        pending_ttl=PAYMENT_PENDING_TTL
+    )
+    renewal_engine = RenewalEngine(
+        db,
+        payment_system,
+        subscription_manager.activate_payment,
+        subscription_manager.notify_renewal_failed,
+        window=RENEWAL_WINDOW,
+        interval=RENEWAL_INTERVAL,
+        concurrency=RENEWAL_CONCURRENCY
+    )
+    history_archiver = HistoryArchiver(db, HISTORY_ARCHIVE_DAYS, HISTORY_ARCHIVE_INTERVAL)
+    broadcaster = Broadcaster(bot, db, telegram_pacer, BROADCAST_WORKERS)
+    application.bot_data['broadcaster'] = broadcaster
+
+    webhook_server = None
+    if PAYMENT_WEBHOOK_PORT:
+        webhook_server = HTTPServer(PAYMENT_WEBHOOK_HOST, int(PAYMENT_WEBHOOK_PORT))
+        PaymentWebhookHandler(payment_system, subscription_manager.activate_payment).register(webhook_server)
+        webhook_server.add_route('GET', '/health', health)
+    
+    telegram_webhook = None
+    if TELEGRAM_WEBHOOK_URL:
+        if webhook_server is None:
+            raise SystemExit("Для TELEGRAM_WEBHOOK_URL нужен HTTP-сервер бота: укажите PAYMENT_WEBHOOK_PORT")
+        telegram_webhook = TelegramWebhook(application, TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_SECRET)
+        telegram_webhook.register(webhook_server)
+    
+    # Запускаем фоновые задачи проверки подписок и платежей после инициализации
+    background_tasks = []
     
-    # Запускаем фоновую задачу проверки подписок после инициализации
     async def post_init(application):
-        asyncio.create_task(run_subscription_checker(subscription_manager))
+        user_writer.start()
+        background_tasks.extend([
+            asyncio.create_task(run_subscription_checker(subscription_manager, SUBSCRIPTION_RECONCILE_INTERVAL)),
+            asyncio.create_task(payment_reconciler.run()),
+            asyncio.create_task(renewal_engine.run()),
+            # Прерванные перезапуском рассылки продолжаются с необработанных получателей
+            asyncio.create_task(broadcaster.run()),
+        ])
+        if HISTORY_ARCHIVE_DAYS > 0:
+            background_tasks.append(asyncio.create_task(history_archiver.run()))
+        if webhook_server is not None:
+            await webhook_server.start()
+    
+    # Останавливаем фоновые задачи и закрываем соединения с БД при остановке
+    async def post_shutdown(application):
+        if webhook_server is not None:
+            await webhook_server.stop()
+        # Задачи могут быть посреди запроса к БД или провайдеру: дожидаемся их отмены
+        # до закрытия БД и HTTP-клиентов
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        background_tasks.clear()
+        await user_writer.stop()
+        await payment_system.aclose()
+        await db.close()
     
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
     
     logging.info("Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if telegram_webhook is not None:
+        asyncio.run(telegram_webhook.run())
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,74 @@
+from typing import NamedTuple, Optional, Tuple
+
+
+# Записи строк БД. NamedTuple не создает __dict__ на каждый объект (__slots__ = ()),
+# неизменяем и собирается прямо из кортежа строки через row_factory
+
+
+class User(NamedTuple):
+    user_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    registration_date: Optional[int]
+
+
+class Subscription(NamedTuple):
+    id: int
+    user_id: int
+    start_date: int
+    end_date: int
+    is_active: int
+    payment_id: Optional[str]
+    amount: int
+
+
+class Payment(NamedTuple):
+    id: int
+    user_id: int
+    payment_id: str
+    amount: int
+    status: str
+    created_date: Optional[int]
+    paid_date: Optional[int]
+    confirmation_url: Optional[str]
+    idempotency_key: Optional[str]
+
+
+class ExpiredSubscription(NamedTuple):
+    """Истекшие подписки пользователя, захваченные проверкой"""
+    user_id: int
+    end_date: int
+    subscription_ids: Tuple[int, ...]
+    renewed: bool  # У пользователя есть другая действующая подписка
+
+
+class RenewalCandidate(NamedTuple):
+    """Подписка, захваченная для автопродления"""
+    subscription_id: int
+    user_id: int
+    end_date: int
+    amount: int
+    attempts: int  # Неудачных попыток списания подряд
+    payment_method_id: str
+
+
+class Broadcast(NamedTuple):
+    """Рассылка: текст, аудитория ('all' или 'active') и состояние"""
+    id: int
+    text: str
+    audience: str
+    status: str  # 'running' или 'finished'
+    created_date: int
+    finished_date: Optional[int]
+
+
+def columns(record_type) -> str:
+    """Список колонок для SELECT в порядке полей записи"""
+    return ', '.join(record_type._fields)
+
+
+def row_factory(record_type):
+    """row_factory для курсора sqlite3, собирающий записи указанного типа"""
+    make = record_type._make
+    return lambda cursor, row: make(row)
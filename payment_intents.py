@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from async_database import AsyncDatabase
+
+
+class PaymentIntent(NamedTuple):
+    """Счет на оплату, который показывается пользователю"""
+    payment_id: str
+    confirmation_url: Optional[str]
+    reused: bool  # Выдан уже существующий открытый счет
+
+
+class PaymentIntents:
+    """Выдача счета на оплату без лишних обращений к провайдеру.
+
+    Если у пользователя есть неоплаченный счет на ту же сумму моложе intent_ttl,
+    повторно выдается он. Одновременные нажатия одного пользователя ждут одно и то
+    же создание счета. Ключ идемпотентности случайный и записывается в БД до
+    обращения к провайдеру, поэтому повтор после потерянного ответа провайдера
+    (в том числе после перезапуска бота) в пределах intent_ttl получит тот же
+    платеж, а новый счет после отмены или оплаты - новый ключ."""
+
+    def __init__(self, db: AsyncDatabase, payment_system, intent_ttl: int = 3600):
+        self.db = db
+        self.payment_system = payment_system
+        self.intent_ttl = intent_ttl
+        self.logger = logging.getLogger(__name__)
+
+        self._inflight: Dict[Tuple[int, int], asyncio.Future] = {}
+        self.stats = {'created': 0, 'reused': 0, 'collapsed': 0, 'failed': 0}
+
+    async def get_or_create(self, user_id: int, amount: int, description: str,
+                            save_payment_method: bool = False) -> Optional[PaymentIntent]:
+        """Открытый счет пользователя или новый; None - провайдер не создал платеж.
+        save_payment_method - сохранить способ оплаты для автопродления"""
+        key = (user_id, amount)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._get_or_create(user_id, amount, description, save_payment_method))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats['collapsed'] += 1
+        # shield: отмена одного ожидающего не прерывает создание для остальных
+        return await asyncio.shield(future)
+
+    async def _get_or_create(self, user_id: int, amount: int, description: str,
+                             save_payment_method: bool) -> Optional[PaymentIntent]:
+        open_payment = await self.db.find_open_payment(user_id, amount, int(time.time()) - self.intent_ttl)
+        if open_payment is not None:
+            self.stats['reused'] += 1
+            return PaymentIntent(open_payment.payment_id, open_payment.confirmation_url, True)
+
+        idempotency_key = await self.db.reserve_payment_key(
+            user_id, amount, int(time.time()) - self.intent_ttl, str(uuid.uuid4())
+        )
+        payment = await self.payment_system.create_payment(
+            amount=amount,
+            description=description,
+            user_id=user_id,
+            idempotency_key=idempotency_key,
+            save_payment_method=save_payment_method
+        )
+        if not payment:
+            # Резерв ключа остается: следующая попытка пойдет с тем же ключом
+            self.stats['failed'] += 1
+            return None
+
+        confirmation_url = (payment.get('confirmation') or {}).get('confirmation_url')
+        if not await self.db.attach_payment(user_id, idempotency_key, payment['id'], confirmation_url):
+            # Резерв уже привязан к другому платежу или устарел и перенесен в архив
+            await self.db.add_payment(
+                user_id=user_id,
+                payment_id=payment['id'],
+                amount=amount,
+                status='pending',
+                confirmation_url=confirmation_url,
+                idempotency_key=idempotency_key
+            )
+        self.stats['created'] += 1
+        return PaymentIntent(payment['id'], confirmation_url, False)
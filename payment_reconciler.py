@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from async_database import AsyncDatabase
+from models import Payment
+from resilience import ProviderUnavailableError
+
+# Итоговые статусы провайдера, после которых платеж больше не проверяется
+CANCELED_STATUSES = ('canceled', 'failed')
+
+
+class PaymentReconciler:
+    """Фоновая сверка ожидающих платежей с провайдером.
+
+    Платежи со статусом 'pending' проверяются пачками с ограниченной
+    параллельностью. Интервал до следующей проверки растет вместе с возрастом
+    платежа (age * backoff_factor), поэтому свежие платежи проверяются часто,
+    а старые - все реже. Успешные платежи активируются через тот же конвейер,
+    что и кнопка "Проверить оплату", платежи старше pending_ttl помечаются 'expired'.
+    Если провайдер умеет проверять счета пачкой (check_payment_statuses),
+    пачка отдается ему целиком, и он сам соблюдает свои ограничения частоты."""
+
+    def __init__(self, db: AsyncDatabase, payment_system, activate: Callable[[str, Optional[dict]], Awaitable],
+                 interval: float = 30.0, batch_size: int = 100, concurrency: int = 10,
+                 base_delay: int = 30, max_delay: int = 3600, backoff_factor: float = 0.5,
+                 pending_ttl: int = 24 * 3600):
+        self.db = db
+        self.payment_system = payment_system
+        self.activate = activate
+        self.interval = interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.pending_ttl = pending_ttl
+        self.logger = logging.getLogger(__name__)
+
+        self.stats = {'checked': 0, 'activated': 0, 'canceled': 0, 'expired': 0, 'errors': 0, 'unavailable': 0}
+
+    def next_check_delay(self, payment: Payment, now: int) -> int:
+        """Задержка до следующей проверки: растет пропорционально возрасту платежа"""
+        age = max(0, now - (payment.created_date or now))
+        return int(min(self.max_delay, max(self.base_delay, age * self.backoff_factor)))
+
+    async def _check_payment(self, payment: Payment, semaphore: asyncio.Semaphore):
+        """Проверка одного платежа у провайдера"""
+        try:
+            async with semaphore:
+                payment_info = await self.payment_system.check_payment_status(payment.payment_id)
+        except ProviderUnavailableError:
+            # Провайдер недоступен: платеж проверится после окончания аренды
+            self.stats['unavailable'] += 1
+            return
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.error(f"Ошибка сверки платежа {payment.payment_id}: {e}")
+            return
+        await self._apply_status(payment, payment_info)
+
+    async def _check_batch(self, payments: List[Payment]):
+        """Проверка пачки платежей одним вызовом провайдера"""
+        try:
+            statuses = await self.payment_system.check_payment_statuses(
+                [payment.payment_id for payment in payments]
+            )
+        except Exception as e:
+            self.stats['errors'] += len(payments)
+            self.logger.error(f"Ошибка пакетной сверки платежей: {e}")
+            return
+        # Непроверенные из-за недоступности провайдера платежи проверятся после окончания аренды
+        self.stats['unavailable'] += len(payments) - len(statuses)
+        await asyncio.gather(*(
+            self._apply_status(payment, statuses[payment.payment_id])
+            for payment in payments if payment.payment_id in statuses
+        ))
+
+    async def _apply_status(self, payment: Payment, payment_info: Optional[dict]):
+        """Применение ответа провайдера к платежу"""
+        try:
+            self.stats['checked'] += 1
+            status = payment_info.get('status') if payment_info else None
+
+            if status == 'succeeded':
+                if await self.activate(payment.payment_id, payment_info) is not None:
+                    self.stats['activated'] += 1
+            elif status in CANCELED_STATUSES:
+                await self.db.update_payment_status(payment.payment_id, 'canceled')
+                self.stats['canceled'] += 1
+            else:
+                now = int(time.time())
+                await self.db.reschedule_payment_check(payment.payment_id, now + self.next_check_delay(payment, now))
+
+        except Exception as e:
+            # Платеж остается захваченным до конца аренды и будет проверен повторно
+            self.stats['errors'] += 1
+            self.logger.error(f"Ошибка сверки платежа {payment.payment_id}: {e}")
+
+    async def run_once(self):
+        """Один проход сверки: устаревшие платежи и все платежи, которые пора проверить"""
+        expired = await self.db.expire_stale_payments(int(time.time()) - self.pending_ttl)
+        if expired:
+            self.stats['expired'] += expired
+            self.logger.info(f"Платежей просрочено без оплаты: {expired}")
+
+        batched = hasattr(self.payment_system, 'check_payment_statuses')
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            payments = await self.db.claim_pending_payments(self.batch_size)
+            if not payments:
+                break
+            if batched:
+                await self._check_batch(payments)
+            else:
+                await asyncio.gather(*(self._check_payment(payment, semaphore) for payment in payments))
+            if len(payments) < self.batch_size:
+                break
+
+    async def run(self):
+        """Фоновая задача периодической сверки"""
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.logger.error(f"Ошибка в фоновой сверке платежей: {e}")
+            await asyncio.sleep(self.interval)
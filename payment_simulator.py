@@ -0,0 +1,358 @@
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import math
+import random
+import time
+from typing import Optional
+from xml.sax.saxutils import escape
+
+import httpx
+
+from http_server import HTTPServer, HTTPRequest, HTTPResponse
+from payment_system import MockPaymentSystem
+from resilience import ProviderUnavailableError
+
+# Коды состояния счета Робокассы в ответе OpState
+ROBOKASSA_STATE_CODES = {'pending': 5, 'canceled': 10, 'succeeded': 100}
+
+
+class SimulatedPaymentSystem(MockPaymentSystem):
+    """Имитация платежной системы с задержками и сбоями для нагрузочных прогонов.
+
+    Каждый вызов ждет логнормальную задержку (медиана latency, разброс
+    latency_sigma), с вероятностью timeout_rate зависает на timeout секунд
+    и поднимает ProviderUnavailableError, с вероятностью error_rate
+    возвращает None (ошибка провайдера). Платеж переходит из 'pending'
+    в итоговый статус через success_delay секунд: 'succeeded' с вероятностью
+    success_rate, иначе 'canceled'. Если задан webhook_url, в момент перехода
+    отправляется уведомление в формате ЮKassa или Робокассы."""
+
+    def __init__(self, latency: float = 0.2, latency_sigma: float = 0.5, error_rate: float = 0.0,
+                 timeout_rate: float = 0.0, timeout: float = 30.0, success_delay: float = 30.0,
+                 success_rate: float = 1.0, webhook_url: Optional[str] = None,
+                 webhook_format: str = 'yookassa', password2: str = '', max_payments: int = 10000,
+                 seed: Optional[int] = None):
+        super().__init__(max_payments)
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.success_delay = success_delay
+        self.success_rate = success_rate
+        self.webhook_url = webhook_url
+        self.webhook_format = webhook_format
+        self.password2 = password2
+        self.random = random.Random(seed)
+        self.logger = logging.getLogger(__name__)
+
+        self._ids = itertools.count(int(time.time()) * 1000)
+        self._webhook_client: Optional[httpx.AsyncClient] = None
+        self._webhook_tasks = set()
+        self.stats = {'calls': 0, 'errors': 0, 'timeouts': 0, 'succeeded': 0, 'canceled': 0,
+                      'webhooks_sent': 0, 'webhooks_failed': 0}
+
+    def _new_payment_id(self) -> str:
+        # Робокасса работает с числовыми номерами счетов
+        if self.webhook_format == 'robokassa':
+            return str(next(self._ids))
+        return super()._new_payment_id()
+
+    async def fault(self, operation: str) -> Optional[str]:
+        """Задержка вызова и выбор сбоя: 'timeout', 'error' или None"""
+        self.stats['calls'] += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.random.lognormvariate(math.log(self.latency), self.latency_sigma))
+        roll = self.random.random()
+        if roll < self.timeout_rate:
+            self.stats['timeouts'] += 1
+            await asyncio.sleep(self.timeout)
+            return 'timeout'
+        if roll < self.timeout_rate + self.error_rate:
+            self.stats['errors'] += 1
+            return 'error'
+        return None
+
+    async def _faulty(self, operation: str) -> bool:
+        """Сбой в процессе бота: таймаут поднимается исключением, ошибка - True"""
+        failure = await self.fault(operation)
+        if failure == 'timeout':
+            raise ProviderUnavailableError(f"Симулятор: истек срок операции {operation}")
+        return failure == 'error'
+
+    def open_payment(self, payment: dict, delay: Optional[float] = None) -> dict:
+        """Назначение итога новому платежу и уведомления о нем"""
+        if 'settle_at' not in payment:
+            delay = self.success_delay if delay is None else delay
+            payment['settle_at'] = time.time() + delay
+            payment['outcome'] = 'succeeded' if self.random.random() < self.success_rate else 'canceled'
+            if self.webhook_url:
+                asyncio.get_running_loop().call_later(delay, self._schedule_webhook, payment['id'])
+        return payment
+
+    def settle(self, payment: Optional[dict]) -> Optional[dict]:
+        """Перевод платежа в итоговый статус, если его время пришло"""
+        if payment is not None and payment['status'] == 'pending' and time.time() >= payment.get('settle_at', 0):
+            payment['status'] = payment.get('outcome', 'succeeded')
+            self.stats[payment['status']] += 1
+            if payment['status'] == 'succeeded' and payment.get('save_payment_method'):
+                payment['payment_method'] = {'id': f"sim-method-{payment['user_id']}", 'saved': True}
+        return payment
+
+    async def create_payment(self, amount: int, description: str, user_id: int,
+                             idempotency_key: Optional[str] = None,
+                             save_payment_method: bool = False) -> Optional[dict]:
+        if await self._faulty('create_payment'):
+            return None
+        payment = await super().create_payment(amount, description, user_id, idempotency_key, save_payment_method)
+        return self.open_payment(payment)
+
+    async def charge_saved_payment_method(self, payment_method_id: str, amount: int, user_id: int,
+                                          idempotency_key: Optional[str] = None) -> Optional[dict]:
+        if await self._faulty('charge_saved_payment_method'):
+            return None
+        payment = await MockPaymentSystem.create_payment(
+            self, amount, "Автоплатеж за подписку", user_id, idempotency_key
+        )
+        # Списание с сохраненной карты проходит сразу
+        payment['payment_method'] = {'id': payment_method_id, 'saved': True}
+        return self.settle(self.open_payment(payment, delay=0))
+
+    async def check_payment_status(self, payment_id: str) -> Optional[dict]:
+        if await self._faulty('check_payment_status'):
+            return None
+        return self.settle(self.payments.get(payment_id))
+
+    def _schedule_webhook(self, payment_id: str):
+        task = asyncio.ensure_future(self._send_webhook(payment_id))
+        self._webhook_tasks.add(task)
+        task.add_done_callback(self._webhook_tasks.discard)
+
+    def webhook_request(self, payment: dict) -> dict:
+        """Параметры запроса уведомления для httpx"""
+        if self.webhook_format == 'robokassa':
+            out_sum = f"{payment['amount'] / 100:.6f}"
+            signature = hashlib.md5(f"{out_sum}:{payment['id']}:{self.password2}".encode()).hexdigest().upper()
+            return {'data': {'OutSum': out_sum, 'InvId': payment['id'], 'SignatureValue': signature}}
+        return {'json': {
+            'type': 'notification',
+            'event': f"payment.{payment['status']}",
+            'object': {'id': payment['id'], 'status': payment['status']},
+        }}
+
+    async def _send_webhook(self, payment_id: str):
+        """Отправка уведомления об итоге платежа"""
+        payment = self.settle(self.payments.get(payment_id))
+        if payment is None or payment['status'] == 'pending':
+            return
+        if self.webhook_format == 'robokassa' and payment['status'] != 'succeeded':
+            return  # Робокасса сообщает на Result URL только об успешной оплате
+        if self._webhook_client is None:
+            self._webhook_client = httpx.AsyncClient(timeout=10.0)
+        try:
+            response = await self._webhook_client.post(self.webhook_url, **self.webhook_request(payment))
+            self.stats['webhooks_sent' if response.status_code == 200 else 'webhooks_failed'] += 1
+        except httpx.HTTPError as e:
+            self.stats['webhooks_failed'] += 1
+            self.logger.warning(f"Симулятор: уведомление о платеже {payment_id} не доставлено: {e}")
+
+    async def aclose(self):
+        for task in list(self._webhook_tasks):
+            task.cancel()
+        if self._webhook_client is not None:
+            await self._webhook_client.aclose()
+            self._webhook_client = None
+
+
+class ProviderStandIn:
+    """Локальный HTTP-стенд, повторяющий эндпоинты ЮKassa (/v3/payments) и Робокассы
+    (OpState, Recurring) поверх SimulatedPaymentSystem. Позволяет гонять настоящие
+    клиенты YooKassaPayment/RobokassaPayment без сети: достаточно указать
+    YOOKASSA_API_URL / ROBOKASSA_API_URL / ROBOKASSA_RECURRING_URL."""
+
+    def __init__(self, simulator: SimulatedPaymentSystem, host: str = '127.0.0.1', port: int = 8090):
+        self.simulator = simulator
+        self.server = HTTPServer(host, port)
+        self.server.add_route('POST', '/v3/payments', self.yookassa_create)
+        self.server.add_prefix_route('GET', '/v3/payments/', self.yookassa_get)
+        for method in ('GET', 'POST'):
+            self.server.add_route(method, '/Merchant/WebService/Service.asmx/OpState', self.robokassa_op_state)
+        self.server.add_route('POST', '/Merchant/Recurring', self.robokassa_recurring)
+
+    async def start(self):
+        await self.server.start()
+
+    async def stop(self):
+        await self.server.stop()
+        await self.simulator.aclose()
+
+    async def _fault_response(self, operation: str) -> Optional[HTTPResponse]:
+        failure = await self.simulator.fault(operation)
+        if failure == 'timeout':
+            return HTTPResponse(504, 'Gateway Timeout')
+        if failure == 'error':
+            return HTTPResponse.json({'type': 'error', 'code': 'internal_server_error'}, status=500)
+        return None
+
+    @staticmethod
+    def _yookassa_payment(payment: dict) -> dict:
+        """Платеж в формате API ЮKassa"""
+        data = {
+            'id': payment['id'],
+            'status': payment['status'],
+            'paid': payment['status'] == 'succeeded',
+            'amount': {'value': f"{payment['amount'] / 100:.2f}", 'currency': 'RUB'},
+            'description': payment['description'],
+            'metadata': {'user_id': str(payment['user_id'])},
+            'confirmation': {'type': 'redirect', 'confirmation_url': payment['confirmation']['confirmation_url']},
+        }
+        if 'payment_method' in payment:
+            data['payment_method'] = payment['payment_method']
+        return data
+
+    async def yookassa_create(self, request: HTTPRequest) -> HTTPResponse:
+        failure = await self._fault_response('create_payment')
+        if failure is not None:
+            return failure
+        try:
+            body = request.json()
+            amount = round(float(body['amount']['value']) * 100)
+            user_id = int((body.get('metadata') or {}).get('user_id', 0))
+        except (ValueError, KeyError, TypeError):
+            return HTTPResponse.json({'type': 'error', 'code': 'invalid_request'}, status=400)
+
+        key = request.headers.get('idempotence-key')
+        payment = await MockPaymentSystem.create_payment(
+            self.simulator, amount, body.get('description', ''), user_id, key,
+            bool(body.get('save_payment_method'))
+        )
+        if body.get('payment_method_id'):
+            payment['payment_method'] = {'id': body['payment_method_id'], 'saved': True}
+            self.simulator.settle(self.simulator.open_payment(payment, delay=0))
+        else:
+            self.simulator.open_payment(payment)
+        return HTTPResponse.json(self._yookassa_payment(payment))
+
+    async def yookassa_get(self, request: HTTPRequest) -> HTTPResponse:
+        failure = await self._fault_response('check_payment_status')
+        if failure is not None:
+            return failure
+        payment = self.simulator.settle(self.simulator.payments.get(request.path.rsplit('/', 1)[-1]))
+        if payment is None:
+            return HTTPResponse.json({'type': 'error', 'code': 'not_found'}, status=404)
+        return HTTPResponse.json(self._yookassa_payment(payment))
+
+    def _robokassa_invoice(self, inv_id: str, amount: int = 0) -> dict:
+        """Счета Робокассы создаются у бота локально, стенд узнает о них при первом запросе"""
+        payment = self.simulator.payments.get(inv_id)
+        if payment is None:
+            payment = self.simulator._store({
+                'id': inv_id, 'status': 'pending', 'amount': amount, 'user_id': 0,
+                'description': '', 'confirmation': {'confirmation_url': ''},
+            })
+            self.simulator.open_payment(payment)
+        return self.simulator.settle(payment)
+
+    async def robokassa_op_state(self, request: HTTPRequest) -> HTTPResponse:
+        failure = await self._fault_response('check_payment_status')
+        if failure is not None:
+            return failure
+        params = request.form()
+        inv_id = params.get('InvoiceID', '')
+        if not inv_id.isdigit():
+            return self._op_state_xml(3)
+        payment = self._robokassa_invoice(inv_id)
+        return self._op_state_xml(0, payment)
+
+    @staticmethod
+    def _op_state_xml(result_code: int, payment: Optional[dict] = None) -> HTTPResponse:
+        parts = [
+            '<?xml version="1.0" encoding="utf-8"?>',
+            '<OperationStateResponse xmlns="http://merchant.roboxchange.com/WebService/">',
+            f'<Result><Code>{result_code}</Code></Result>',
+        ]
+        if payment is not None:
+            now = time.strftime('%Y-%m-%dT%H:%M:%S')
+            parts.append(
+                f"<State><Code>{ROBOKASSA_STATE_CODES[payment['status']]}</Code>"
+                f"<RequestDate>{now}</RequestDate><StateDate>{now}</StateDate></State>"
+                f"<Info><IncCurrLabel>BankCard</IncCurrLabel>"
+                f"<IncSum>{payment['amount'] / 100:.2f}</IncSum>"
+                f"<OutSum>{payment['amount'] / 100:.2f}</OutSum>"
+                f"<PaymentMethod><Code>BankCard</Code><Description>{escape('Банковская карта')}</Description>"
+                f"</PaymentMethod></Info>"
+            )
+        parts.append('</OperationStateResponse>')
+        return HTTPResponse(200, ''.join(parts), 'text/xml; charset=utf-8')
+
+    async def robokassa_recurring(self, request: HTTPRequest) -> HTTPResponse:
+        failure = await self._fault_response('charge_saved_payment_method')
+        if failure is not None:
+            return failure
+        params = request.form()
+        inv_id = params.get('InvoiceID', '')
+        if not inv_id.isdigit() or not params.get('PreviousInvoiceID'):
+            return HTTPResponse(400, 'ERROR')
+        if inv_id in self.simulator.payments:
+            # Как у Робокассы: второй счет с тем же номером не принимается
+            return HTTPResponse(200, 'ERROR: InvoiceID already exists')
+        self._robokassa_invoice(inv_id, round(float(params.get('OutSum', 0)) * 100))
+        return HTTPResponse(200, f"OK+{inv_id}")
+
+
+async def _serve(args):
+    simulator = SimulatedPaymentSystem(
+        latency=args.latency_ms / 1000,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate,
+        timeout=args.timeout,
+        success_delay=args.success_delay,
+        success_rate=args.success_rate,
+        webhook_url=args.webhook_url,
+        webhook_format=args.webhook_format,
+        password2=args.password2,
+        max_payments=args.max_payments,
+        seed=args.seed
+    )
+    stand_in = ProviderStandIn(simulator, args.host, args.port)
+    await stand_in.start()
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logging.info(f"Симулятор: платежей в памяти {len(simulator.payments)}, {json.dumps(simulator.stats)}")
+    finally:
+        await stand_in.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный стенд платежной системы с задержками и сбоями")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=float, default=200.0, help="Медиана задержки ответа")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="Разброс логнормальной задержки")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help="Доля зависших запросов")
+    parser.add_argument('--timeout', type=float, default=30.0, help="Сколько секунд висит зависший запрос")
+    parser.add_argument('--success-delay', type=float, default=30.0, help="Через сколько секунд платеж оплачивается")
+    parser.add_argument('--success-rate', type=float, default=1.0, help="Доля успешных платежей")
+    parser.add_argument('--webhook-url', help="Куда отправлять уведомления об итоге платежа")
+    parser.add_argument('--webhook-format', choices=('yookassa', 'robokassa'), default='yookassa')
+    parser.add_argument('--password2', default='', help="Пароль #2 Робокассы для подписи уведомлений")
+    parser.add_argument('--max-payments', type=int, default=10000, help="Сколько последних платежей хранить")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# Итоговые статусы: после них ответ провайдера больше не меняется
+TERMINAL_STATUSES = ('succeeded', 'canceled', 'failed')
+
+
+class PaymentStatusLookup:
+    """Проверка статуса платежа по нажатию "Проверить оплату" без лишних обращений к провайдеру.
+
+    Одновременные проверки одного payment_id ждут один и тот же запрос.
+    Промежуточный ответ ('pending') переиспользуется pending_ttl секунд,
+    итоговый - до вытеснения: хранится не больше max_terminal последних.
+    Ошибки и пустые ответы не кэшируются."""
+
+    def __init__(self, payment_system, pending_ttl: float = 5.0, max_terminal: int = 10000):
+        self.payment_system = payment_system
+        self.pending_ttl = pending_ttl
+        self.max_terminal = max_terminal
+        self.logger = logging.getLogger(__name__)
+
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._pending: Dict[str, Tuple[float, dict]] = {}  # payment_id -> (истекает, ответ)
+        self._terminal: OrderedDict = OrderedDict()
+        self.stats = {'lookups': 0, 'provider_calls': 0, 'collapsed': 0, 'cached': 0}
+
+    @property
+    def saved_calls(self) -> int:
+        """Сколько обращений к провайдеру удалось не делать"""
+        return self.stats['lookups'] - self.stats['provider_calls']
+
+    def snapshot(self) -> dict:
+        """Статистика для мониторинга"""
+        return {**self.stats, 'saved': self.saved_calls, 'terminal_cached': len(self._terminal)}
+
+    def _cached(self, payment_id: str) -> Optional[dict]:
+        payment_info = self._terminal.get(payment_id)
+        if payment_info is not None:
+            self._terminal.move_to_end(payment_id)
+            return payment_info
+        entry = self._pending.get(payment_id)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                return entry[1]
+            del self._pending[payment_id]
+        return None
+
+    async def check_payment_status(self, payment_id: str) -> Optional[dict]:
+        """Статус платежа; ProviderUnavailableError получают все ожидающие этот запрос"""
+        self.stats['lookups'] += 1
+        payment_info = self._cached(payment_id)
+        if payment_info is not None:
+            self.stats['cached'] += 1
+            return payment_info
+
+        future = self._inflight.get(payment_id)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(payment_id))
+            self._inflight[payment_id] = future
+            future.add_done_callback(lambda _: self._inflight.pop(payment_id, None))
+        else:
+            self.stats['collapsed'] += 1
+        # shield: отмена одного ожидающего не прерывает запрос для остальных
+        return await asyncio.shield(future)
+
+    async def _fetch(self, payment_id: str) -> Optional[dict]:
+        self.stats['provider_calls'] += 1
+        payment_info = await self.payment_system.check_payment_status(payment_id)
+        if payment_info:
+            if payment_info.get('status') in TERMINAL_STATUSES:
+                self._pending.pop(payment_id, None)
+                self._terminal[payment_id] = payment_info
+                while len(self._terminal) > self.max_terminal:
+                    self._terminal.popitem(last=False)
+            else:
+                self._pending[payment_id] = (time.monotonic() + self.pending_ttl, payment_info)
+                if len(self._pending) > self.max_terminal:
+                    self._drop_expired()
+        return payment_info
+
+    def _drop_expired(self):
+        """Удаление устаревших промежуточных ответов"""
+        now = time.monotonic()
+        for payment_id in [key for key, (expires, _) in self._pending.items() if expires <= now]:
+            del self._pending[payment_id]
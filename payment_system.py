@@ -1,31 +1,125 @@
+import asyncio
+import hashlib
 import uuid
-import requests
+import httpx
 import base64
 import json
-import datetime
-from typing import Optional
+import logging
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from typing import AsyncIterable, Awaitable, Callable, Dict, Iterable, Optional, Tuple
 
-class YooKassaPayment:
-    def __init__(self, shop_id: str, secret_key: str):
+from resilience import RateLimiter, ResiliencePolicy, ProviderUnavailableError
+
+
+class AsyncHttpClientMixin:
+    """Общий асинхронный HTTP-клиент провайдера: keep-alive соединения,
+    ограниченный пул и таймауты на подключение/чтение для каждого запроса"""
+    
+    connect_timeout = 5.0
+    read_timeout = 15.0
+    max_connections = 20
+    max_keepalive_connections = 10
+    
+    _client: Optional[httpx.AsyncClient] = None
+    _resilience: Optional[ResiliencePolicy] = None
+    
+    def _default_headers(self) -> dict:
+        """Заголовки, общие для всех запросов провайдера"""
+        return {}
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Клиент создается при первом запросе, уже внутри цикла событий"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                headers=self._default_headers(),
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections
+                )
+            )
+        return self._client
+    
+    @property
+    def resilience(self) -> ResiliencePolicy:
+        """Сроки, повторы и автомат защиты вызовов этого провайдера"""
+        if self._resilience is None:
+            self._resilience = ResiliencePolicy(type(self).__name__)
+        return self._resilience
+    
+    async def _request(self, operation: str, method: str, url: str, idempotent: bool = True, **kwargs) -> httpx.Response:
+        """HTTP-запрос к провайдеру через ResiliencePolicy.
+        Сетевые ошибки, 5xx и 429 считаются сбоем провайдера; когда ответа
+        получить не удалось, поднимается ProviderUnavailableError"""
+        client = self._get_client()
+        return await self.resilience.call(
+            operation,
+            lambda: client.request(method, url, **kwargs),
+            idempotent=idempotent,
+            is_failure=lambda response: response.status_code >= 500 or response.status_code == 429
+        )
+    
+    async def _stream_request(self, operation: str, method: str, url: str,
+                              read: Callable[[httpx.Response], Awaitable], idempotent: bool = True,
+                              **kwargs) -> Tuple[int, object]:
+        """Как _request, но тело ответа не загружается целиком: read(response) читает его
+        по частям (response.aiter_bytes()) и может остановиться раньше, остаток не читается.
+        Возвращает (код ответа, результат read); для кодов, кроме 200, read не вызывается"""
+        client = self._get_client()
+        
+        async def send():
+            async with client.stream(method, url, **kwargs) as response:
+                if response.status_code != 200:
+                    return response.status_code, None
+                return response.status_code, await read(response)
+        
+        return await self.resilience.call(
+            operation,
+            send,
+            idempotent=idempotent,
+            is_failure=lambda result: result[0] >= 500 or result[0] == 429
+        )
+    
+    async def aclose(self):
+        """Закрытие соединений клиента"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class YooKassaPayment(AsyncHttpClientMixin):
+    def __init__(self, shop_id: str, secret_key: str, api_url: Optional[str] = None):
         self.shop_id = shop_id
         self.secret_key = secret_key
-        self.api_url = "https://api.yookassa.ru/v3"
-    
-    def _get_headers(self):
-        """Получение заголовков для запросов к API"""
+        self.api_url = api_url or "https://api.yookassa.ru/v3"  # Переопределяется для локального стенда
+        
+        # Заголовок авторизации не меняется, собираем его один раз
         credentials = f"{self.shop_id}:{self.secret_key}"
         encoded_credentials = base64.b64encode(credentials.encode()).decode()
-        
+        self._authorization = f"Basic {encoded_credentials}"
+    
+    def _default_headers(self) -> dict:
         return {
-            "Authorization": f"Basic {encoded_credentials}",
-            "Content-Type": "application/json",
-            "Idempotence-Key": str(uuid.uuid4())
+            "Authorization": self._authorization,
+            "Content-Type": "application/json"
         }
     
-    def create_payment(self, amount: int, description: str, user_id: int, return_url: str = None) -> Optional[dict]:
+    def _get_headers(self, idempotency_key: Optional[str] = None):
+        """Получение заголовков для запросов к API (авторизация задана в клиенте).
+        Без переданного ключа идемпотентности генерируется случайный"""
+        return {
+            "Idempotence-Key": idempotency_key or str(uuid.uuid4())
+        }
+    
+    async def create_payment(self, amount: int, description: str, user_id: int, return_url: str = None,
+                             idempotency_key: Optional[str] = None,
+                             save_payment_method: bool = False) -> Optional[dict]:
         """
         Создание платежа
         amount - сумма в копейках (1000 рублей = 100000 копеек)
+        idempotency_key - повтор с тем же ключом вернет уже созданный платеж
+        save_payment_method - сохранить способ оплаты для автопродления
         """
         payment_data = {
             "amount": {
@@ -42,11 +136,13 @@ class YooKassaPayment:
                 "user_id": str(user_id)
             }
         }
+        if save_payment_method:
+            payment_data["save_payment_method"] = True
         
         try:
-            response = requests.post(
-                f"{self.api_url}/payments",
-                headers=self._get_headers(),
+            response = await self._request(
+                'create_payment', 'POST', f"{self.api_url}/payments",
+                headers=self._get_headers(idempotency_key),
                 json=payment_data
             )
             
@@ -56,16 +152,17 @@ class YooKassaPayment:
                 print(f"Ошибка создания платежа: {response.text}")
                 return None
                 
+        except ProviderUnavailableError:
+            raise
         except Exception as e:
             print(f"Ошибка при создании платежа: {e}")
             return None
     
-    def check_payment_status(self, payment_id: str) -> Optional[dict]:
+    async def check_payment_status(self, payment_id: str) -> Optional[dict]:
         """Проверка статуса платежа"""
         try:
-            response = requests.get(
-                f"{self.api_url}/payments/{payment_id}",
-                headers=self._get_headers()
+            response = await self._request(
+                'check_payment_status', 'GET', f"{self.api_url}/payments/{payment_id}"
             )
             
             if response.status_code == 200:
@@ -74,11 +171,13 @@ class YooKassaPayment:
                 print(f"Ошибка проверки платежа: {response.text}")
                 return None
                 
+        except ProviderUnavailableError:
+            raise
         except Exception as e:
             print(f"Ошибка при проверке платежа: {e}")
             return None
     
-    def create_subscription(self, amount: int, user_id: int, description: str = "Подписка на канал") -> Optional[dict]:
+    async def create_subscription(self, amount: int, user_id: int, description: str = "Подписка на канал") -> Optional[dict]:
         """Создание автоплатежа (подписки)"""
         payment_data = {
             "amount": {
@@ -102,8 +201,8 @@ class YooKassaPayment:
         }
         
         try:
-            response = requests.post(
-                f"{self.api_url}/payments",
+            response = await self._request(
+                'create_subscription', 'POST', f"{self.api_url}/payments",
                 headers=self._get_headers(),
                 json=payment_data
             )
@@ -114,11 +213,14 @@ class YooKassaPayment:
                 print(f"Ошибка создания подписки: {response.text}")
                 return None
                 
+        except ProviderUnavailableError:
+            raise
         except Exception as e:
             print(f"Ошибка при создании подписки: {e}")
             return None
     
-    def charge_saved_payment_method(self, payment_method_id: str, amount: int, user_id: int) -> Optional[dict]:
+    async def charge_saved_payment_method(self, payment_method_id: str, amount: int, user_id: int,
+                                          idempotency_key: Optional[str] = None) -> Optional[dict]:
         """Списание с сохраненного способа оплаты (автоплатеж)"""
         payment_data = {
             "amount": {
@@ -135,9 +237,9 @@ class YooKassaPayment:
         }
         
         try:
-            response = requests.post(
-                f"{self.api_url}/payments",
-                headers=self._get_headers(),
+            response = await self._request(
+                'charge_saved_payment_method', 'POST', f"{self.api_url}/payments",
+                headers=self._get_headers(idempotency_key),
                 json=payment_data
             )
             
@@ -147,6 +249,8 @@ class YooKassaPayment:
                 print(f"Ошибка автоплатежа: {response.text}")
                 return None
                 
+        except ProviderUnavailableError:
+            raise
         except Exception as e:
             print(f"Ошибка при автоплатеже: {e}")
             return None
@@ -154,42 +258,136 @@ class YooKassaPayment:
 
 # Пример простой системы платежей (заглушка для тестирования)
 class MockPaymentSystem:
-    """Простая заглушка для тестирования без реальных платежей"""
+    """Простая заглушка для тестирования без реальных платежей.
+    Хранит не больше max_payments последних платежей"""
     
-    def __init__(self):
-        self.payments = {}
+    def __init__(self, max_payments: int = 10000):
+        self.max_payments = max_payments
+        self.payments = OrderedDict()
+        self.idempotency_keys = {}
     
-    def create_payment(self, amount: int, description: str, user_id: int) -> dict:
-        payment_id = str(uuid.uuid4())
-        self.payments[payment_id] = {
+    def _new_payment_id(self) -> str:
+        return str(uuid.uuid4())
+    
+    def _store(self, payment: dict, idempotency_key: Optional[str] = None) -> dict:
+        """Сохранение платежа с вытеснением самых старых"""
+        self.payments[payment["id"]] = payment
+        if idempotency_key:
+            payment["idempotency_key"] = idempotency_key
+            self.idempotency_keys[idempotency_key] = payment["id"]
+        while len(self.payments) > self.max_payments:
+            _, evicted = self.payments.popitem(last=False)
+            self.idempotency_keys.pop(evicted.get("idempotency_key"), None)
+        return payment
+    
+    async def create_payment(self, amount: int, description: str, user_id: int,
+                             idempotency_key: Optional[str] = None,
+                             save_payment_method: bool = False) -> dict:
+        # Как у ЮKassa: повтор с тем же ключом возвращает тот же платеж
+        if idempotency_key in self.idempotency_keys:
+            return self.payments[self.idempotency_keys[idempotency_key]]
+        
+        payment_id = self._new_payment_id()
+        return self._store({
             "id": payment_id,
             "status": "pending",
             "amount": amount,
             "user_id": user_id,
             "description": description,
+            "save_payment_method": save_payment_method,
             "confirmation": {
                 "confirmation_url": f"https://mock-payment.example.com/pay/{payment_id}"
             }
-        }
-        return self.payments[payment_id]
+        }, idempotency_key)
     
-    def check_payment_status(self, payment_id: str) -> Optional[dict]:
+    async def charge_saved_payment_method(self, payment_method_id: str, amount: int, user_id: int,
+                                          idempotency_key: Optional[str] = None) -> dict:
+        """Имитация автоплатежа: списание всегда успешно"""
+        payment = await self.create_payment(amount, "Автоплатеж за подписку", user_id, idempotency_key)
+        payment["status"] = "succeeded"
+        payment["payment_method"] = {"id": payment_method_id, "saved": True}
+        return payment
+    
+    async def check_payment_status(self, payment_id: str) -> Optional[dict]:
         return self.payments.get(payment_id)
     
+    async def aclose(self):
+        pass
+    
     def simulate_successful_payment(self, payment_id: str):
         """Имитация успешной оплаты (для тестирования)"""
         if payment_id in self.payments:
-            self.payments[payment_id]["status"] = "succeeded"
+            payment = self.payments[payment_id]
+            payment["status"] = "succeeded"
+            if payment.get("save_payment_method"):
+                payment["payment_method"] = {"id": f"mock-method-{payment['user_id']}", "saved": True}
             return True
         return False
 
 
-class RobokassaPayment:
-    def __init__(self, merchant_login: str, password1: str, password2: str, test_mode: bool = True):
+# Коды состояния счета в ответе OpState Робокассы
+ROBOKASSA_STATES = {
+    5: 'pending',      # Счет создан, оплата не поступила
+    10: 'canceled',    # Оплата отменена
+    20: 'pending',     # Средства заблокированы (HOLD)
+    50: 'pending',     # Оплачен, деньги зачисляются магазину
+    60: 'canceled',    # Возврат после блокировки
+    80: 'pending',     # Исполнение приостановлено
+    100: 'succeeded',  # Оплачен
+}
+ROBOKASSA_INVOICE_NOT_FOUND = 3  # Покупатель еще не открывал страницу оплаты
+ROBOKASSA_MAX_INV_ID = 2 ** 31 - 1  # InvId - число от 1 до 2^31-1
+
+
+async def parse_op_state(chunks: AsyncIterable[bytes]) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+    """Разбор ответа OpState по мере чтения из сети: (Result/Code, State/Code, Info/OutSum).
+    Дерево документа не строится; как только состояние известно, чтение прекращается.
+    Оборванный документ или ответ не в XML поднимают ET.ParseError"""
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    path = []
+    result_code = state_code = out_sum = None
+    async for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            tag = element.tag.rsplit('}', 1)[-1]
+            if event == 'start':
+                path.append(tag)
+                continue
+            parent = path[-2] if len(path) > 1 else None
+            if tag == 'Code' and parent == 'Result':
+                result_code = int(element.text)
+                if result_code != 0:
+                    return result_code, None, None
+            elif tag == 'Code' and parent == 'State':
+                state_code = int(element.text)
+            elif tag == 'OutSum' and parent == 'Info':
+                out_sum = element.text
+            elif tag == 'Info':
+                return result_code, state_code, out_sum
+            path.pop()
+    # Поток кончился раньше, чем встретился Info: документ должен быть хотя бы полным
+    parser.close()
+    return result_code, state_code, out_sum
+
+
+class RobokassaPayment(AsyncHttpClientMixin):
+    # OpState: не больше op_state_rate запросов в секунду, op_state_concurrency одновременно
+    op_state_rate = 10.0
+    op_state_concurrency = 5
+    
+    def __init__(self, merchant_login: str, password1: str, password2: str, test_mode: bool = True,
+                 recurring: bool = False, api_url: Optional[str] = None, recurring_url: Optional[str] = None,
+                 invoice_numbers: Optional[Callable[[int, str], Awaitable[int]]] = None):
+        if invoice_numbers is None:
+            raise ValueError("Робокассе нужен источник номеров счетов (invoice_numbers)")
         self.merchant_login = merchant_login
         self.password1 = password1  # Пароль #1 для формирования подписи
         self.password2 = password2  # Пароль #2 для проверки подписи
         self.test_mode = test_mode
+        self.recurring = recurring  # Подключен ли сервис "Робокасса Рекуррент"
+        self.recurring_url = recurring_url or "https://auth.robokassa.ru/Merchant/Recurring"
+        # Номер счета по ключу идемпотентности (например, AsyncDatabase.get_invoice_number)
+        self.invoice_numbers = invoice_numbers
         
         if test_mode:
             self.pay_url = "https://auth.robokassa.ru/Merchant/Index.aspx"
@@ -197,31 +395,53 @@ class RobokassaPayment:
         else:
             self.pay_url = "https://auth.robokassa.ru/Merchant/Index.aspx"
             self.api_url = "https://auth.robokassa.ru/Merchant/WebService/Service.asmx"
+        if api_url:
+            self.api_url = api_url  # Локальный стенд
+        
+        # Подписи оплаты и OpState начинаются с логина: состояние md5 после него считается один раз
+        self._login_md5 = hashlib.md5(f"{merchant_login}:".encode())
+        self._op_state_url = f"{self.api_url}/OpState"
+        self._op_state_limiter = RateLimiter(self.op_state_rate, self.op_state_concurrency)
+        self._op_state_semaphore = asyncio.Semaphore(self.op_state_concurrency)
+        self.logger = logging.getLogger(__name__)
+    
+    def _sign_with_login(self, *parts) -> str:
+        """md5 строки "логин:part1:part2:..." от предвычисленного префикса"""
+        signature = self._login_md5.copy()
+        signature.update(':'.join(str(part) for part in parts).encode())
+        return signature.hexdigest().upper()
+    
+    async def _invoice_id(self, user_id: int, idempotency_key: Optional[str] = None) -> int:
+        """Номер счета (InvId) из последовательности в БД. Номер записан вместе с ключом
+        идемпотентности: повтор с тем же ключом получает тот же номер, а второй счет с ним
+        Робокасса не примет. Без ключа выдается новый номер"""
+        inv_id = await self.invoice_numbers(user_id, idempotency_key or str(uuid.uuid4()))
+        if not 1 <= inv_id <= ROBOKASSA_MAX_INV_ID:
+            raise ValueError(f"Номер счета {inv_id} вне допустимого для Робокассы диапазона")
+        return inv_id
     
     def _generate_signature_pay(self, out_sum: float, inv_id: int) -> str:
         """Генерация подписи для оплаты"""
-        import hashlib
-        
         # mrh_login:OutSum:InvId:mrh_pass1
-        signature_string = f"{self.merchant_login}:{out_sum}:{inv_id}:{self.password1}"
-        return hashlib.md5(signature_string.encode()).hexdigest().upper()
+        return self._sign_with_login(out_sum, inv_id, self.password1)
     
-    def _generate_signature_result(self, out_sum: float, inv_id: int) -> str:
+    def _generate_signature_result(self, out_sum: str, inv_id: int) -> str:
         """Генерация подписи для проверки результата"""
-        import hashlib
-        
         # OutSum:InvId:mrh_pass2
         signature_string = f"{out_sum}:{inv_id}:{self.password2}"
         return hashlib.md5(signature_string.encode()).hexdigest().upper()
     
-    def create_payment(self, amount: int, description: str, user_id: int) -> Optional[dict]:
+    async def create_payment(self, amount: int, description: str, user_id: int,
+                             idempotency_key: Optional[str] = None,
+                             save_payment_method: bool = False) -> Optional[dict]:
         """
         Создание платежа
         amount - сумма в копейках (1000 рублей = 100000 копеек)
+        idempotency_key - по нему выдается номер счета: повтор вернет ту же ссылку на оплату
         """
         try:
             out_sum = amount / 100  # Переводим в рубли
-            inv_id = int(f"{user_id}{int(datetime.datetime.now().timestamp())}")  # Уникальный ID заказа
+            inv_id = await self._invoice_id(user_id, idempotency_key)  # Уникальный ID заказа
             
             # Генерируем подпись
             signature = self._generate_signature_pay(out_sum, inv_id)
@@ -236,6 +456,9 @@ class RobokassaPayment:
                 'Culture': 'ru',
                 'IsTest': 1 if self.test_mode else 0
             }
+            if save_payment_method and self.recurring:
+                # Материнский платеж: последующие списания ссылаются на его InvId
+                payment_params['Recurring'] = 'true'
             
             # Формируем URL для оплаты
             params_string = '&'.join([f"{key}={value}" for key, value in payment_params.items()])
@@ -261,48 +484,131 @@ class RobokassaPayment:
             print(f"Ошибка создания платежа Робокасса: {e}")
             return None
     
-    def check_payment_status(self, payment_id: str) -> Optional[dict]:
-        """Проверка статуса платежа через Робокассу"""
+    async def _fetch_op_state(self, inv_id: int) -> Optional[Tuple[Optional[int], Optional[int], Optional[str]]]:
+        """Запрос OpState в пределах ограничения частоты: (Result/Code, State/Code, Info/OutSum);
+        None - Робокасса ответила ошибкой HTTP"""
+        async with self._op_state_semaphore:
+            await self._op_state_limiter.acquire()
+            status_code, op_state = await self._stream_request(
+                'check_payment_status', 'GET', self._op_state_url,
+                lambda response: parse_op_state(response.aiter_bytes()),
+                params={
+                    'MerchantLogin': self.merchant_login,
+                    'InvoiceID': inv_id,
+                    'Signature': self._sign_with_login(inv_id, self.password2)
+                }
+            )
+        if status_code != 200:
+            self.logger.error(f"Ошибка проверки платежа Робокасса {inv_id}: HTTP {status_code}")
+            return None
+        return op_state
+    
+    async def check_payment_status(self, payment_id: str) -> Optional[dict]:
+        """Проверка статуса платежа через OpState Робокассы"""
         try:
-            import xml.etree.ElementTree as ET
-            
-            # Для проверки статуса используем OpState
-            inv_id = int(payment_id)
-            
-            # Генерируем подпись для запроса статуса
-            import hashlib
-            signature_string = f"{self.merchant_login}:{inv_id}:{self.password2}"
-            signature = hashlib.md5(signature_string.encode()).hexdigest().upper()
-            
-            # Параметры запроса
-            params = {
-                'MerchantLogin': self.merchant_login,
-                'InvoiceID': inv_id,
-                'Signature': signature
-            }
-            
-            # Формируем URL для проверки
-            url = f"{self.api_url}/OpState"
+            op_state = await self._fetch_op_state(int(payment_id))
+            if op_state is None:
+                return None
             
-            # В реальной реализации здесь должен быть HTTP запрос к API
-            # Для демонстрации возвращаем заглушку
-            return {
-                'id': payment_id,
-                'status': 'pending',  # pending, succeeded, failed
-                'amount': 100000,
-                'description': 'Тестовый платеж'
-            }
+            result_code, state_code, out_sum = op_state
+            if result_code == ROBOKASSA_INVOICE_NOT_FOUND:
+                # Счет появляется у Робокассы, только когда покупатель перешел к оплате
+                return {'id': payment_id, 'status': 'pending'}
+            if result_code != 0 or state_code is None:
+                self.logger.error(f"Ошибка проверки платежа Робокасса {payment_id}: код {result_code}")
+                return None
             
+            payment_info = {'id': payment_id, 'status': ROBOKASSA_STATES.get(state_code, 'pending')}
+            if out_sum is not None:
+                payment_info['amount'] = round(float(out_sum) * 100)
+            if payment_info['status'] == 'succeeded' and self.recurring:
+                # Как и в уведомлении Result URL: оплаченный счет - материнский для автоплатежей
+                payment_info['payment_method'] = {'id': payment_id, 'saved': True}
+            return payment_info
+        
+        except ProviderUnavailableError:
+            raise
         except Exception as e:
-            print(f"Ошибка проверки платежа Робокасса: {e}")
+            self.logger.error(f"Ошибка проверки платежа Робокасса {payment_id}: {e}")
             return None
     
-    def verify_payment_result(self, out_sum: float, inv_id: int, signature: str) -> bool:
+    async def check_payment_statuses(self, payment_ids: Iterable[str]) -> Dict[str, Optional[dict]]:
+        """Параллельная проверка многих счетов в пределах ограничения частоты OpState.
+        Счета, которые не удалось проверить из-за недоступности Робокассы, в результат не попадают"""
+        payment_ids = list(payment_ids)
+        results = await asyncio.gather(
+            *(self.check_payment_status(payment_id) for payment_id in payment_ids),
+            return_exceptions=True
+        )
+        statuses = {}
+        for payment_id, result in zip(payment_ids, results):
+            if isinstance(result, ProviderUnavailableError):
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            statuses[payment_id] = result
+        return statuses
+    
+    async def charge_saved_payment_method(self, payment_method_id: str, amount: int, user_id: int,
+                                          idempotency_key: Optional[str] = None) -> Optional[dict]:
+        """
+        Повторное списание по материнскому платежу (payment_method_id - его InvId).
+        Робокасса только принимает запрос, результат приходит на Result URL,
+        поэтому платеж возвращается в статусе 'pending'. Номер счета выдается
+        по idempotency_key: повтор после сбоя не создаст второе списание, а если
+        счет уже был принят прошлой попыткой, возвращается его состояние
+        """
+        if not self.recurring:
+            return None
+        
+        out_sum = amount / 100
+        inv_id = await self._invoice_id(user_id, idempotency_key)
+        try:
+            response = await self._request(
+                'charge_saved_payment_method', 'POST', self.recurring_url,
+                idempotent=False,
+                data={
+                    'MerchantLogin': self.merchant_login,
+                    'InvoiceID': inv_id,
+                    'PreviousInvoiceID': payment_method_id,
+                    'OutSum': out_sum,
+                    'Description': "Автоплатеж за подписку",
+                    'SignatureValue': self._generate_signature_pay(out_sum, inv_id)
+                }
+            )
+            if response.status_code == 200 and response.text.startswith('OK'):
+                return {'id': str(inv_id), 'status': 'pending', 'amount': amount, 'user_id': user_id}
+            if idempotency_key is not None:
+                # Счет с этим номером мог быть принят прошлой попыткой (повторный номер отклоняется)
+                payment_info = await self._existing_invoice(inv_id)
+                if payment_info is not None:
+                    return {**payment_info, 'amount': amount, 'user_id': user_id}
+            self.logger.error(f"Ошибка рекуррентного платежа Робокасса {inv_id}: {response.text}")
+            return None
+        
+        except ProviderUnavailableError:
+            raise
+        except Exception as e:
+            self.logger.error(f"Ошибка рекуррентного платежа Робокасса {inv_id}: {e}")
+            return None
+    
+    async def _existing_invoice(self, inv_id: int) -> Optional[dict]:
+        """Состояние уже существующего счета; None - счета нет. Если проверить не удалось,
+        поднимается ProviderUnavailableError: считать списание неудачным нельзя"""
+        op_state = await self._fetch_op_state(inv_id)
+        if op_state is None or op_state[0] not in (0, ROBOKASSA_INVOICE_NOT_FOUND):
+            raise ProviderUnavailableError(f"Робокасса: не удалось проверить счет {inv_id}")
+        result_code, state_code, _ = op_state
+        if result_code == ROBOKASSA_INVOICE_NOT_FOUND:
+            return None
+        return {'id': str(inv_id), 'status': ROBOKASSA_STATES.get(state_code, 'pending')}
+    
+    def verify_payment_result(self, out_sum: str, inv_id: int, signature: str) -> bool:
         """Проверка подписи результата платежа"""
         expected_signature = self._generate_signature_result(out_sum, inv_id)
         return signature.upper() == expected_signature
     
-    def create_subscription(self, amount: int, user_id: int, description: str = "Подписка на канал") -> Optional[dict]:
+    async def create_subscription(self, amount: int, user_id: int, description: str = "Подписка на канал") -> Optional[dict]:
         """
         Создание подписки (рекуррентного платежа)
         Робокасса поддерживает рекуррентные платежи через отдельный сервис
@@ -311,15 +617,4 @@ class RobokassaPayment:
         # Это более сложная настройка, требующая отдельного договора
         
         # Пока создаем обычный платеж
-        return self.create_payment(amount, description, user_id)
-    
-    def charge_saved_payment_method(self, payment_method_id: str, amount: int, user_id: int) -> Optional[dict]:
-        """
-        Списание с сохраненного способа оплаты (рекуррентный платеж)
-        Требует настройки Робокасса Рекуррент
-        """
-        # Это заглушка - для реальной реализации нужен Робокасса Рекуррент
-        print(f"Попытка рекуррентного платежа: {amount} копеек для пользователя {user_id}")
-        
-        # Имитация неудачного автоплатежа (пока не настроен)
-        return None
+        return await self.create_payment(amount, description, user_id)
@@ -0,0 +1,111 @@
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from http_server import HTTPServer, HTTPRequest, HTTPResponse
+from payment_system import RobokassaPayment
+from resilience import ProviderUnavailableError
+
+YOOKASSA_PATH = '/yookassa/notifications'
+ROBOKASSA_RESULT_PATH = '/robokassa/result'
+
+
+class PaymentWebhookHandler:
+    """Прием уведомлений платежных систем о результате оплаты.
+
+    ЮKassa: уведомление не подписано, поэтому статус платежа перепроверяется
+    запросом к API. Робокасса (ResultURL): проверяется подпись с паролем #2.
+    Подтвержденные платежи передаются в activate (тот же конвейер, что и у
+    кнопки "Проверить оплату"); повторные доставки отвечаются сразу."""
+
+    def __init__(self, payment_system, activate: Callable[[str, Optional[dict]], Awaitable],
+                 processed_size: int = 10000):
+        self.payment_system = payment_system
+        self.activate = activate
+        self.processed_size = processed_size
+        self.logger = logging.getLogger(__name__)
+
+        self._processed: "OrderedDict[str, bool]" = OrderedDict()  # Недавно обработанные платежи
+        self.stats = {'received': 0, 'activated': 0, 'duplicates': 0, 'rejected': 0}
+
+    def register(self, server: HTTPServer):
+        """Подключение маршрутов текущей платежной системы к HTTP-серверу"""
+        if isinstance(self.payment_system, RobokassaPayment):
+            server.add_route('POST', ROBOKASSA_RESULT_PATH, self.handle_robokassa_result)
+        else:
+            # ЮKassa и тестовая система (уведомления в формате ЮKassa)
+            server.add_route('POST', YOOKASSA_PATH, self.handle_yookassa)
+
+    def _is_processed(self, payment_id: str) -> bool:
+        if payment_id in self._processed:
+            self._processed.move_to_end(payment_id)
+            self.stats['duplicates'] += 1
+            return True
+        return False
+
+    def _mark_processed(self, payment_id: str):
+        self._processed[payment_id] = True
+        while len(self._processed) > self.processed_size:
+            self._processed.popitem(last=False)
+
+    async def _activate(self, payment_id: str, payment_info: Optional[dict]):
+        """Передача подтвержденного платежа в конвейер (повторная активация безопасна)"""
+        if await self.activate(payment_id, payment_info) is not None:
+            self.stats['activated'] += 1
+            self.logger.info(f"Платеж {payment_id} подтвержден уведомлением провайдера")
+        self._mark_processed(payment_id)
+
+    async def handle_yookassa(self, request: HTTPRequest) -> HTTPResponse:
+        """Уведомление ЮKassa (payment.succeeded / payment.canceled)"""
+        self.stats['received'] += 1
+        try:
+            notification = request.json()
+            event = notification['event']
+            payment_id = str(notification['object']['id'])
+        except (ValueError, KeyError, TypeError):
+            self.stats['rejected'] += 1
+            return HTTPResponse(400, 'Bad Request')
+
+        if event != 'payment.succeeded' or self._is_processed(payment_id):
+            return HTTPResponse(200, 'OK')
+
+        # Уведомлению не доверяем: статус берем из API
+        try:
+            payment_info = await self.payment_system.check_payment_status(payment_id)
+        except ProviderUnavailableError:
+            payment_info = None
+        if payment_info is None:
+            # Провайдер повторит доставку позже
+            return HTTPResponse(503, 'Service Unavailable')
+        if payment_info.get('status') != 'succeeded':
+            self.stats['rejected'] += 1
+            self.logger.warning(f"Уведомление ЮKassa не подтвердилось для платежа {payment_id}")
+            return HTTPResponse(200, 'OK')
+
+        await self._activate(payment_id, payment_info)
+        return HTTPResponse(200, 'OK')
+
+    async def handle_robokassa_result(self, request: HTTPRequest) -> HTTPResponse:
+        """ResultURL Робокассы: OutSum, InvId, SignatureValue; ответ "OK<InvId>" """
+        self.stats['received'] += 1
+        params = request.form()
+        out_sum = params.get('OutSum')
+        inv_id = params.get('InvId')
+        signature = params.get('SignatureValue')
+        if not (out_sum and inv_id and signature and inv_id.isdigit()):
+            self.stats['rejected'] += 1
+            return HTTPResponse(400, 'bad request')
+
+        # Подпись считается от OutSum ровно в том виде, в каком его прислала Робокасса
+        if not self.payment_system.verify_payment_result(out_sum, int(inv_id), signature):
+            self.stats['rejected'] += 1
+            self.logger.warning(f"Неверная подпись ResultURL Робокассы для счета {inv_id}")
+            return HTTPResponse(403, 'bad sign')
+
+        if not self._is_processed(inv_id):
+            # При подключенном "Робокасса Рекуррент" оплаченный счет становится материнским для автоплатежей
+            payment_info = {'id': inv_id, 'status': 'succeeded'}
+            if self.payment_system.recurring:
+                payment_info['payment_method'] = {'id': inv_id, 'saved': True}
+            await self._activate(inv_id, payment_info)
+        return HTTPResponse(200, f"OK{inv_id}")
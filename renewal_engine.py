@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable, Optional, Sequence
+
+from async_database import AsyncDatabase
+from models import RenewalCandidate
+from resilience import ProviderUnavailableError
+
+# Пространство имен ключей идемпотентности автоплатежей
+RENEWAL_NAMESPACE = uuid.UUID('2d7b9c1e-4f3a-4b8e-9a61-5c0d8e7f1b24')
+
+
+class RenewalEngine:
+    """Автопродление подписок с сохраненным способом оплаты.
+
+    За window секунд до end_date подписки захватываются пачками и списания идут
+    параллельно (не больше concurrency одновременно). Успешное списание
+    активируется через тот же конвейер, что и обычная оплата, и продлевает
+    end_date. При неудаче следующая попытка назначается через retry_delays
+    (dunning); после последней подписка истекает в обычном порядке.
+    Ключ идемпотентности зависит от подписки, ее end_date и номера попытки и
+    записывается в payments до списания. Если по ключу уже есть принятый
+    провайдером платеж (ожидающее списание, а end_date еще не сдвинулся),
+    проверяется его статус, а не делается новое списание; если исход прошлого
+    вызова неизвестен, списание повторяется с тем же ключом."""
+
+    def __init__(self, db: AsyncDatabase, payment_system,
+                 activate: Callable[[str, Optional[dict]], Awaitable],
+                 on_failed: Optional[Callable[[int, bool], Awaitable]] = None,
+                 window: int = 3 * 86400, interval: float = 600.0, batch_size: int = 200,
+                 concurrency: int = 20, retry_delays: Sequence[int] = (6 * 3600, 24 * 3600, 24 * 3600),
+                 pending_recheck: int = 3600):
+        self.db = db
+        self.payment_system = payment_system
+        self.activate = activate
+        self.on_failed = on_failed
+        self.window = window
+        self.interval = interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retry_delays = tuple(retry_delays)
+        self.max_attempts = len(self.retry_delays) + 1
+        self.pending_recheck = pending_recheck
+        self.logger = logging.getLogger(__name__)
+
+        self.stats = {'charged': 0, 'pending': 0, 'failed': 0, 'gave_up': 0, 'unavailable': 0, 'errors': 0}
+
+    @staticmethod
+    def idempotency_key(candidate: RenewalCandidate) -> str:
+        """Ключ списания: один на подписку, период и попытку"""
+        return str(uuid.uuid5(
+            RENEWAL_NAMESPACE,
+            f"{candidate.user_id}:{candidate.subscription_id}:{candidate.end_date}:{candidate.attempts}"
+        ))
+
+    async def _charge(self, candidate: RenewalCandidate, idempotency_key: str) -> Optional[dict]:
+        """Списание или, если по ключу уже есть принятый провайдером платеж, его статус"""
+        outstanding = await self.db.get_payment_by_key(candidate.user_id, idempotency_key)
+        if outstanding is not None and outstanding.payment_id is not None:
+            payment = await self.payment_system.check_payment_status(outstanding.payment_id)
+            # Статус не получен: списание не считается неудачным, проверим позже
+            return payment or {'id': outstanding.payment_id, 'status': 'pending'}
+
+        if outstanding is None:
+            # Ключ записывается до списания, чтобы следующий захват подписки нашел этот платеж.
+            # Статус 'charging', а не 'creating': резерв не должен достаться счету на оплату
+            await self.db.add_payment(candidate.user_id, None, candidate.amount, 'charging',
+                                      idempotency_key=idempotency_key)
+        payment = await self.payment_system.charge_saved_payment_method(
+            candidate.payment_method_id,
+            candidate.amount,
+            candidate.user_id,
+            idempotency_key=idempotency_key
+        )
+        if payment and payment.get('status') in ('succeeded', 'pending'):
+            attached = await self.db.attach_payment(candidate.user_id, idempotency_key, payment['id'])
+            if not attached and await self.db.get_payment(payment['id']) is None:
+                await self.db.add_payment(candidate.user_id, payment['id'], candidate.amount, 'pending',
+                                          idempotency_key=idempotency_key)
+        return payment
+
+    async def _renew(self, candidate: RenewalCandidate, semaphore: asyncio.Semaphore):
+        """Одно списание с сохраненного способа оплаты"""
+        idempotency_key = self.idempotency_key(candidate)
+        try:
+            async with semaphore:
+                payment = await self._charge(candidate, idempotency_key)
+            status = payment.get('status') if payment else None
+            now = int(time.time())
+
+            if status == 'succeeded':
+                await self.activate(payment['id'], payment)
+                self.stats['charged'] += 1
+            elif status == 'pending':
+                # Итог придет уведомлением или через сверку платежей; попытку не расходуем,
+                # а при следующем захвате проверяется статус этого же платежа
+                await self.db.schedule_renewal(
+                    candidate.user_id, candidate.subscription_id, candidate.attempts, now + self.pending_recheck
+                )
+                self.stats['pending'] += 1
+            else:
+                # Следующая попытка пойдет с новым ключом: резерв этой больше не нужен
+                await self.db.cancel_payment_key(candidate.user_id, idempotency_key)
+                attempts = candidate.attempts + 1
+                final = attempts >= self.max_attempts
+                next_attempt = None if final else now + self.retry_delays[candidate.attempts]
+                await self.db.schedule_renewal(candidate.user_id, candidate.subscription_id, attempts, next_attempt)
+                self.stats['gave_up' if final else 'failed'] += 1
+                self.logger.info(f"Автоплатеж пользователя {candidate.user_id} не прошел (попытка {attempts})")
+                if self.on_failed is not None:
+                    await self.on_failed(candidate.user_id, final)
+
+        except ProviderUnavailableError:
+            # Подписка остается захваченной до конца аренды и будет списана с тем же ключом
+            self.stats['unavailable'] += 1
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.error(f"Ошибка автопродления подписки пользователя {candidate.user_id}: {e}")
+
+    async def run_once(self):
+        """Один проход: все подписки, которым пора списание"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        until = int(time.time()) + self.window
+        renewed = 0
+        while True:
+            candidates = await self.db.claim_renewals(until, self.batch_size, self.max_attempts)
+            if not candidates:
+                break
+            await asyncio.gather(*(self._renew(candidate, semaphore) for candidate in candidates))
+            renewed += len(candidates)
+            if len(candidates) < self.batch_size:
+                break
+        if renewed:
+            self.logger.info(f"Обработано автопродлений: {renewed}, итоги: {self.stats}")
+
+    async def run(self):
+        """Фоновая задача автопродления"""
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.logger.error(f"Ошибка в фоновом автопродлении: {e}")
+            await asyncio.sleep(self.interval)
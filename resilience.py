@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ProviderUnavailableError(Exception):
+    """Платежная система недоступна: цепь разомкнута, истек срок операции или не удалось достучаться"""
+
+
+class CircuitBreaker:
+    """Автомат защиты провайдера.
+
+    Результаты вызовов учитываются в скользящем окне window секунд. Если вызовов
+    не меньше min_calls и доля ошибок достигла failure_rate, цепь размыкается на
+    open_timeout секунд: вызовы сразу отклоняются. Затем пропускается один
+    пробный вызов (half-open): успех замыкает цепь, ошибка снова размыкает."""
+
+    def __init__(self, name: str, failure_rate: float = 0.5, min_calls: int = 10,
+                 window: float = 60.0, open_timeout: float = 30.0):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_timeout = open_timeout
+        self.logger = logging.getLogger(__name__)
+
+        self.state = CLOSED
+        self._outcomes: deque = deque()  # (время, успех)
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.stats = {'rejected': 0, 'opened': 0}
+
+    def _trim(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            _, ok = self._outcomes.popleft()
+            if not ok:
+                self._failures -= 1
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.logger.warning(f"Провайдер {self.name}: цепь {self.state} -> {state}")
+            self.state = state
+
+    def allow(self) -> bool:
+        """Можно ли выполнить вызов сейчас"""
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.open_timeout:
+            self._set_state(HALF_OPEN)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.stats['rejected'] += 1
+        return False
+
+    def release_probe(self):
+        """Освобождение пробного вызова, завершившегося без результата"""
+        self._probe_in_flight = False
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        self.stats['opened'] += 1
+        self._set_state(OPEN)
+
+    def record_success(self):
+        if self.state == HALF_OPEN:
+            self._outcomes.clear()
+            self._failures = 0
+            self._probe_in_flight = False
+            self._set_state(CLOSED)
+        self._record(True)
+
+    def record_failure(self):
+        self._record(False)
+        if self.state == HALF_OPEN:
+            self._open()
+        elif self.state == CLOSED and len(self._outcomes) >= self.min_calls \
+                and self._failures / len(self._outcomes) >= self.failure_rate:
+            self._open()
+
+    def _record(self, ok: bool):
+        now = time.monotonic()
+        self._trim(now)
+        self._outcomes.append((now, ok))
+        if not ok:
+            self._failures += 1
+
+    def snapshot(self) -> dict:
+        """Состояние для мониторинга"""
+        self._trim(time.monotonic())
+        calls = len(self._outcomes)
+        return {
+            'state': self.state,
+            'calls': calls,
+            'failures': self._failures,
+            'error_rate': round(self._failures / calls, 3) if calls else 0.0,
+            **self.stats,
+        }
+
+
+class RetryBudget:
+    """Бюджет повторов: в окне window секунд повторов не больше
+    min_retries + ratio * число первых попыток. Не дает повторам
+    умножать нагрузку на провайдера, когда ошибок много."""
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 3, window: float = 10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._requests: deque = deque()
+        self._retries: deque = deque()
+        self.stats = {'exhausted': 0}
+
+    def _trim(self, now: float):
+        for events in (self._requests, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        self._requests.append(time.monotonic())
+
+    def try_retry(self) -> bool:
+        """Списание одного повтора из бюджета"""
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._retries) >= self.min_retries + self.ratio * len(self._requests):
+            self.stats['exhausted'] += 1
+            return False
+        self._retries.append(now)
+        return True
+
+
+class RateLimiter:
+    """Ограничение частоты запросов к провайдеру (token bucket): в среднем
+    не больше rate запросов в секунду и не больше burst подряд. Ожидающие
+    получают разрешения в порядке очереди."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._resume_at = 0.0  # До этого момента разрешения не выдаются (pause)
+        self._lock = asyncio.Lock()
+        self.stats = {'acquired': 0, 'waited': 0}
+
+    async def acquire(self):
+        """Ожидание разрешения на один запрос"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._resume_at:
+                    self.stats['waited'] += 1
+                    await asyncio.sleep(self._resume_at - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.stats['acquired'] += 1
+                    return
+                self.stats['waited'] += 1
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Остановка выдачи разрешений на seconds секунд (например, по RetryAfter).
+        Паузы не складываются: одновременные вызовы продлевают остановку
+        до самого позднего срока"""
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
+class ResiliencePolicy:
+    """Общая обертка вызовов провайдера: срок на операцию целиком,
+    повторы с экспоненциальной задержкой и полным джиттером в пределах
+    бюджета и автомат защиты. Повторяются только идемпотентные вызовы."""
+
+    # Срок на операцию вместе со всеми повторами, секунды
+    deadlines = {
+        'create_payment': 20.0,
+        'check_payment_status': 10.0,
+        'create_subscription': 20.0,
+        'charge_saved_payment_method': 30.0,
+    }
+    default_deadline = 15.0
+    max_retries = 2
+    backoff_base = 0.2
+    backoff_cap = 2.0
+
+    def __init__(self, name: str, breaker: Optional[CircuitBreaker] = None,
+                 budget: Optional[RetryBudget] = None):
+        self.name = name
+        self.breaker = breaker or CircuitBreaker(name)
+        self.budget = budget or RetryBudget()
+        self.stats = {'calls': 0, 'retries': 0, 'timeouts': 0}
+
+    async def call(self, operation: str, send: Callable[[], Awaitable], idempotent: bool = False,
+                   is_failure: Callable[[object], bool] = lambda result: False):
+        """Выполнение вызова send(). Исключения send и результаты, для которых
+        is_failure истинно, считаются сбоем провайдера. Если ответа нет совсем,
+        поднимается ProviderUnavailableError; последний неуспешный ответ
+        возвращается вызывающему как есть"""
+        if not self.breaker.allow():
+            raise ProviderUnavailableError(f"{self.name}: провайдер временно недоступен")
+
+        self.stats['calls'] += 1
+        self.budget.record_request()
+        try:
+            return await asyncio.wait_for(
+                self._attempts(operation, send, idempotent, is_failure),
+                self.deadlines.get(operation, self.default_deadline)
+            )
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            self.breaker.record_failure()
+            raise ProviderUnavailableError(f"{self.name}: истек срок операции {operation}")
+        except asyncio.CancelledError:
+            # Прерванный пробный вызов не должен навсегда занять half-open
+            self.breaker.release_probe()
+            raise
+
+    async def _attempts(self, operation: str, send, idempotent: bool, is_failure):
+        attempt = 0
+        while True:
+            error = None
+            result = None
+            try:
+                result = await send()
+            except Exception as e:
+                error = e
+
+            if error is None and not is_failure(result):
+                self.breaker.record_success()
+                return result
+            self.breaker.record_failure()
+
+            if not idempotent or attempt >= self.max_retries or not self.budget.try_retry() \
+                    or not self.breaker.allow():
+                if error is None:
+                    return result
+                raise ProviderUnavailableError(f"{self.name}: ошибка операции {operation}: {error}") from error
+
+            attempt += 1
+            self.stats['retries'] += 1
+            await asyncio.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)))
+
+    def snapshot(self) -> Dict[str, object]:
+        """Состояние автомата, бюджета и счетчики вызовов для мониторинга"""
+        return {
+            'breaker': self.breaker.snapshot(),
+            'retry_budget_exhausted': self.budget.stats['exhausted'],
+            **self.stats,
+        }
@@ -0,0 +1,343 @@
+import argparse
+import itertools
+import os
+import sqlite3
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional
+
+from database import Database
+from models import Broadcast, User, Subscription, Payment, ExpiredSubscription, RenewalCandidate
+
+# Таблицы, строки которых распределяются по шардам по user_id
+SHARDED_TABLES = ('users', 'subscriptions', 'payments', 'payment_methods', 'broadcast_deliveries')
+# Таблицы, которые целиком хранятся в первом шарде
+GLOBAL_TABLES = ('broadcasts', 'invoice_numbers')
+
+
+def shard_path(db_path: str, index: int) -> str:
+    """Путь к файлу шарда: bot_database.db -> bot_database.shard0.db"""
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+class ShardedDatabase:
+    """Хранилище из нескольких файлов SQLite с тем же API, что и Database.
+
+    Все данные пользователя (профиль, подписки, платежи) лежат в шарде
+    user_id % shard_count, поэтому у каждого шарда своя блокировка на запись.
+    Выборки по всем пользователям (истекшие подписки, отчеты) обходят шарды.
+    Рассылки хранятся в первом шарде, отметки о доставке - в шарде получателя."""
+
+    def __init__(self, db_path: str = "bot_database.db", shard_count: int = 4, pool_size: int = 4,
+                 cache_size: int = 10000, cache_ttl: float = 300.0):
+        self.db_path = db_path
+        self.shard_count = shard_count
+        self.pool_size = pool_size * shard_count
+        self.shards = [
+            Database(shard_path(db_path, index), pool_size, max(1, cache_size // shard_count), cache_ttl)
+            for index in range(shard_count)
+        ]
+
+    def shard_for(self, user_id: int) -> Database:
+        """Шард, в котором хранятся данные пользователя"""
+        return self.shards[user_id % self.shard_count]
+
+    def _group_by_shard(self, rows: list, user_id_of) -> Dict[int, list]:
+        """Разбиение строк по номерам шардов"""
+        groups = defaultdict(list)
+        for row in rows:
+            groups[user_id_of(row) % self.shard_count].append(row)
+        return groups
+
+    def close(self):
+        """Закрытие соединений всех шардов"""
+        for shard in self.shards:
+            shard.close()
+
+    def get_schema_version(self) -> int:
+        """Версия схемы (минимальная по шардам)"""
+        return min(shard.get_schema_version() for shard in self.shards)
+
+    def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        """Добавление пользователя"""
+        self.shard_for(user_id).add_user(user_id, username, first_name, last_name)
+
+    def upsert_users(self, users: List[tuple]):
+        """Пакетное добавление/обновление пользователей, одна транзакция на шард"""
+        for index, rows in self._group_by_shard(users, lambda row: row[0]).items():
+            self.shards[index].upsert_users(rows)
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Получение профиля пользователя"""
+        return self.shard_for(user_id).get_user(user_id)
+
+    def create_subscription(self, user_id: int, payment_id: str, amount: int = 100000):
+        """Создание подписки, возвращает end_date"""
+        return self.shard_for(user_id).create_subscription(user_id, payment_id, amount)
+
+    def get_user_subscription(self, user_id: int) -> Optional[Subscription]:
+        """Получение активной подписки пользователя"""
+        return self.shard_for(user_id).get_user_subscription(user_id)
+
+    def deactivate_subscription(self, user_id: int):
+        """Деактивация подписки"""
+        self.shard_for(user_id).deactivate_subscription(user_id)
+
+    def cache_stats(self) -> dict:
+        """Суммарная статистика кэшей подписок"""
+        stats = {'size': 0, 'hits': 0, 'misses': 0, 'invalidations': 0}
+        for shard in self.shards:
+            for key, value in shard.cache_stats().items():
+                if key in stats:
+                    stats[key] += value
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / total if total else 0.0
+        return stats
+
+    def _iter_shards(self, method: str, *args) -> Iterator:
+        """Последовательный обход генераторов шардов. Это генератор, поэтому у него есть
+        close(): при досрочной остановке закрывается текущий генератор шарда и его
+        соединение возвращается в пул"""
+        for shard in self.shards:
+            iterator = getattr(shard, method)(*args)
+            try:
+                yield from iterator
+            finally:
+                iterator.close()
+
+    def iter_expired_subscriptions(self) -> Iterator[Subscription]:
+        """Истекшие подписки всех шардов, шарды читаются по очереди"""
+        return self._iter_shards('iter_expired_subscriptions')
+
+    def iter_subscription_deadlines(self, until: int) -> Iterator[tuple]:
+        """Дедлайны подписок всех шардов"""
+        return self._iter_shards('iter_subscription_deadlines', until)
+
+    def claim_expired_subscriptions(self, batch_size: int = 500) -> List[ExpiredSubscription]:
+        """Захват пачки истекших подписок из первого шарда, где они есть"""
+        for shard in self.shards:
+            expired = shard.claim_expired_subscriptions(batch_size)
+            if expired:
+                return expired
+        return []
+
+    def finish_expired_subscriptions(self, expired_subscriptions: List[ExpiredSubscription]):
+        """Окончательная деактивация захваченных подписок"""
+        groups = self._group_by_shard(expired_subscriptions, lambda row: row.user_id)
+        for index, rows in groups.items():
+            self.shards[index].finish_expired_subscriptions(rows)
+
+    def release_expiring_subscriptions(self, expired_subscriptions: Optional[List[ExpiredSubscription]] = None) -> int:
+        """Возврат захваченных подписок (переданных или всех) в очередь на обработку"""
+        if expired_subscriptions is None:
+            return sum(shard.release_expiring_subscriptions() for shard in self.shards)
+        groups = self._group_by_shard(expired_subscriptions, lambda row: row.user_id)
+        return sum(self.shards[index].release_expiring_subscriptions(rows) for index, rows in groups.items())
+
+    def add_payment(self, user_id: int, payment_id: str, amount: int, status: str = 'pending',
+                    confirmation_url: Optional[str] = None, idempotency_key: Optional[str] = None):
+        """Добавление записи о платеже"""
+        self.shard_for(user_id).add_payment(user_id, payment_id, amount, status, confirmation_url, idempotency_key)
+
+    def find_open_payment(self, user_id: int, amount: int, created_after: int) -> Optional[Payment]:
+        """Последний ожидающий оплаты счет пользователя на эту сумму"""
+        return self.shard_for(user_id).find_open_payment(user_id, amount, created_after)
+
+    def reserve_payment_key(self, user_id: int, amount: int, created_after: int, new_key: str) -> str:
+        """Ключ идемпотентности для нового счета пользователя"""
+        return self.shard_for(user_id).reserve_payment_key(user_id, amount, created_after, new_key)
+
+    def get_payment_by_key(self, user_id: int, idempotency_key: str) -> Optional[Payment]:
+        """Платеж пользователя по ключу идемпотентности"""
+        return self.shard_for(user_id).get_payment_by_key(user_id, idempotency_key)
+
+    def get_invoice_number(self, user_id: int, idempotency_key: str) -> int:
+        """Номер счета из общей последовательности в первом шарде"""
+        return self.shards[0].get_invoice_number(user_id, idempotency_key)
+
+    def attach_payment(self, user_id: int, idempotency_key: str, payment_id: str,
+                       confirmation_url: Optional[str] = None) -> bool:
+        """Привязка созданного платежа к ключу идемпотентности"""
+        return self.shard_for(user_id).attach_payment(user_id, idempotency_key, payment_id, confirmation_url)
+
+    def cancel_payment_key(self, user_id: int, idempotency_key: str) -> int:
+        """Отмена неоплаченного платежа с этим ключом идемпотентности"""
+        return self.shard_for(user_id).cancel_payment_key(user_id, idempotency_key)
+
+    def get_payment(self, payment_id: str) -> Optional[Payment]:
+        """Поиск платежа по всем шардам"""
+        for shard in self.shards:
+            payment = shard.get_payment(payment_id)
+            if payment is not None:
+                return payment
+        return None
+
+    def update_payment_status(self, payment_id: str, status: str) -> bool:
+        """Обновление статуса платежа (платеж ищется по всем шардам по уникальному индексу)"""
+        return any(shard.update_payment_status(payment_id, status) for shard in self.shards)
+
+    def activate_payment(self, payment_id: str) -> Optional[Subscription]:
+        """Активация платежа в шарде, где он хранится"""
+        for shard in self.shards:
+            if shard.get_payment(payment_id) is not None:
+                return shard.activate_payment(payment_id)
+        return None
+
+    def save_payment_method(self, user_id: int, payment_method_id: str):
+        """Сохранение способа оплаты пользователя"""
+        self.shard_for(user_id).save_payment_method(user_id, payment_method_id)
+
+    def delete_payment_method(self, user_id: int):
+        """Удаление сохраненного способа оплаты"""
+        self.shard_for(user_id).delete_payment_method(user_id)
+
+    def claim_renewals(self, until: int, limit: int, max_attempts: int, lease: int = 900) -> List[RenewalCandidate]:
+        """Захват подписок для автопродления из всех шардов (не больше limit в сумме)"""
+        claimed = []
+        for shard in self.shards:
+            if len(claimed) >= limit:
+                break
+            claimed.extend(shard.claim_renewals(until, limit - len(claimed), max_attempts, lease))
+        return claimed
+
+    def schedule_renewal(self, user_id: int, subscription_id: int, attempts: int, next_renewal_at: int):
+        """Назначение следующей попытки автопродления подписки"""
+        self.shard_for(user_id).schedule_renewal(user_id, subscription_id, attempts, next_renewal_at)
+
+    def claim_pending_payments(self, limit: int, lease: int = 300) -> List[Payment]:
+        """Захват ожидающих платежей из всех шардов (не больше limit в сумме)"""
+        claimed = []
+        for shard in self.shards:
+            if len(claimed) >= limit:
+                break
+            claimed.extend(shard.claim_pending_payments(limit - len(claimed), lease))
+        return claimed
+
+    def reschedule_payment_check(self, payment_id: str, next_check_at: int):
+        """Назначение следующей проверки ожидающего платежа"""
+        for shard in self.shards:
+            shard.reschedule_payment_check(payment_id, next_check_at)
+
+    def expire_stale_payments(self, created_before: int) -> int:
+        """Перевод давно ожидающих платежей в 'expired' во всех шардах"""
+        return sum(shard.expire_stale_payments(created_before) for shard in self.shards)
+
+    def archive_history(self, before: int, batch_size: int = 500) -> dict:
+        """Перенос пачки старой истории в архив каждого шарда (у шарда свой файл архива)"""
+        moved = defaultdict(int)
+        for shard in self.shards:
+            for table, count in shard.archive_history(before, batch_size).items():
+                moved[table] += count
+        return dict(moved)
+
+    def get_user_history(self, user_id: int) -> dict:
+        """Все платежи и подписки пользователя, включая архивные"""
+        return self.shard_for(user_id).get_user_history(user_id)
+
+    def create_broadcast(self, text: str, audience: str) -> int:
+        """Создание рассылки в первом шарде"""
+        return self.shards[0].create_broadcast(text, audience)
+
+    def get_broadcast(self, broadcast_id: int) -> Optional[Broadcast]:
+        """Рассылка по id"""
+        return self.shards[0].get_broadcast(broadcast_id)
+
+    def get_unfinished_broadcasts(self) -> List[Broadcast]:
+        """Незавершенные рассылки в порядке создания"""
+        return self.shards[0].get_unfinished_broadcasts()
+
+    def get_broadcast_recipients(self, broadcast_id: int, audience: str,
+                                 after_user_id: int, limit: int) -> List[int]:
+        """Следующая страница получателей: слияние страниц всех шардов по user_id"""
+        pages = [
+            shard.get_broadcast_recipients(broadcast_id, audience, after_user_id, limit)
+            for shard in self.shards
+        ]
+        return sorted(itertools.chain.from_iterable(pages))[:limit]
+
+    def count_broadcast_recipients(self, broadcast_id: int, audience: str) -> int:
+        """Сколько получателей рассылки еще не обработано во всех шардах"""
+        return sum(shard.count_broadcast_recipients(broadcast_id, audience) for shard in self.shards)
+
+    def record_broadcast_deliveries(self, broadcast_id: int, deliveries: List[tuple]):
+        """Отметки об обработке получателей в их шардах"""
+        groups = self._group_by_shard(deliveries, lambda row: row[0])
+        for index, rows in groups.items():
+            self.shards[index].record_broadcast_deliveries(broadcast_id, rows)
+
+    def get_broadcast_stats(self, broadcast_id: int) -> dict:
+        """Число обработанных получателей по статусам во всех шардах"""
+        stats = defaultdict(int)
+        for shard in self.shards:
+            for status, count in shard.get_broadcast_stats(broadcast_id).items():
+                stats[status] += count
+        return dict(stats)
+
+    def finish_broadcast(self, broadcast_id: int):
+        """Отметка о завершении рассылки"""
+        self.shards[0].finish_broadcast(broadcast_id)
+
+    def get_report(self) -> dict:
+        """Сводка для отчетов по всем шардам"""
+        report = {'users': 0, 'active_subscriptions': 0, 'payments': defaultdict(int), 'paid_amount': 0}
+        for shard in self.shards:
+            shard_report = shard.get_report()
+            report['users'] += shard_report['users']
+            report['active_subscriptions'] += shard_report['active_subscriptions']
+            report['paid_amount'] += shard_report['paid_amount']
+            for status, count in shard_report['payments'].items():
+                report['payments'][status] += count
+        report['payments'] = dict(report['payments'])
+        return report
+
+
+def split_database(source_path: str, shard_count: int):
+    """Офлайн-разбиение однофайловой БД на шарды (бот должен быть остановлен)"""
+    # Приводим исходную БД к текущей схеме, чтобы колонки совпадали с шардами
+    Database(source_path).close()
+
+    for index in range(shard_count):
+        target_path = shard_path(source_path, index)
+        if os.path.exists(target_path):
+            raise FileExistsError(f"Шард уже существует: {target_path}")
+
+        Database(target_path).close()
+        conn = sqlite3.connect(target_path, isolation_level=None)
+        try:
+            conn.execute('ATTACH DATABASE ? AS source', (source_path,))
+            conn.execute('BEGIN IMMEDIATE')
+            for table in SHARDED_TABLES:
+                conn.execute(
+                    f'INSERT INTO main.{table} SELECT * FROM source.{table} WHERE user_id % ? = ?',
+                    (shard_count, index)
+                )
+            tables = SHARDED_TABLES
+            if index == 0:
+                for table in GLOBAL_TABLES:
+                    conn.execute(f'INSERT INTO main.{table} SELECT * FROM source.{table}')
+                tables += GLOBAL_TABLES
+            conn.execute('COMMIT')
+            counts = {
+                table: conn.execute(f'SELECT COUNT(*) FROM main.{table}').fetchone()[0]
+                for table in tables
+            }
+        finally:
+            conn.close()
+        print(f"{target_path}: {counts}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Инструменты шардированного хранилища")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    split_parser = subparsers.add_parser('split', help="Разбить однофайловую БД на шарды")
+    split_parser.add_argument('source', help="Путь к исходной БД, например bot_database.db")
+    split_parser.add_argument('--shards', type=int, required=True, help="Количество шардов")
+
+    args = parser.parse_args()
+    if args.command == 'split':
+        split_database(args.source, args.shards)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from models import Subscription
+
+# Маркер промаха: None в кэше означает "подписки нет" и тоже является попаданием
+MISSING = object()
+
+
+class SubscriptionCache:
+    """Ограниченный LRU-кэш активных подписок с TTL.
+
+    Запись живет не дольше ttl секунд и не дольше end_date самой подписки.
+    Отсутствие подписки тоже кэшируется. Методы записи в Database сбрасывают
+    запись пользователя; поколение защищает от записи в кэш устаревшего
+    результата чтения, начатого до сброса."""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()  # user_id -> (подписка, expires_at)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int):
+        """Подписка из кэша или MISSING"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                subscription, expires_at = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    return subscription
+                del self._entries[user_id]
+            self.misses += 1
+            return MISSING
+
+    def generation(self) -> int:
+        """Поколение кэша; запоминается перед чтением из БД и передается в put()"""
+        return self._generation
+
+    def put(self, user_id: int, subscription: Optional[Subscription], generation: int):
+        """Сохранение результата чтения, если с его начала кэш не сбрасывался"""
+        now = time.time()
+        expires_at = now + self.ttl
+        if subscription is not None:
+            expires_at = min(expires_at, subscription.end_date)
+        if expires_at <= now:
+            return
+
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[user_id] = (subscription, expires_at)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *user_ids: int):
+        """Сброс записей пользователей после изменения их подписок"""
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+            self.invalidations += len(user_ids)
+
+    def clear(self):
+        """Полный сброс кэша"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / total if total else 0.0
+            }
@@ -1,93 +1,123 @@
 import asyncio
 import datetime
 import logging
-from typing import List
+import time
+from typing import List, Optional
 from telegram import Bot
 from telegram.error import TelegramError
-from database import Database
-from payment_system import YooKassaPayment, MockPaymentSystem, RobokassaPayment
+from async_database import AsyncDatabase
+from database import SUBSCRIPTION_DAYS
+from expiry_scheduler import ExpiryScheduler
+from telegram_pacer import TelegramPacer
 
 class SubscriptionManager:
-    def __init__(self, bot: Bot, db: Database, payment_system, paid_channel_id: str):
+    """Подписки и доступ к платному каналу.
+    
+    pacer задается экземпляру для фоновых задач: отзыв доступа при истечении
+    подписок (пользователи пачки обрабатываются параллельно, а бан, разбан и
+    уведомление одного пользователя - по порядку) и уведомления об автоплатеже
+    идут в общем темпе Bot API. Без pacer (обработка нажатий) вызовы идут
+    напрямую. Ссылка на канал после оплаты и уведомление о продлении всегда
+    отправляются напрямую, не дожидаясь фоновых вызовов."""
+    
+    def __init__(self, bot: Bot, db: AsyncDatabase, payment_system, paid_channel_id: str,
+                 pacer: Optional[TelegramPacer] = None):
         self.bot = bot
         self.db = db
         self.payment_system = payment_system
         self.paid_channel_id = paid_channel_id  # ID платного канала (без @)
+        self.pacer = pacer
         self.logger = logging.getLogger(__name__)
     
-    async def check_and_process_expired_subscriptions(self):
-        """Проверка и обработка истекших подписок"""
+    async def _paced(self, method, **kwargs):
+        """Вызов Bot API в общем темпе фоновых задач (если pacer задан)"""
+        if self.pacer is None:
+            return await method(**kwargs)
+        return await self.pacer.call(method, **kwargs)
+    
+    async def check_and_process_expired_subscriptions(self, batch_size: int = 500):
+        """Проверка и обработка истекших подписок.
+        Подписки захватываются пачками в одной транзакции и сразу передаются на отзыв доступа.
+        Обработанные подписки пачки деактивируются, даже если проверку прервали; остальные
+        возвращаются в очередь и ждут следующей проверки"""
         try:
-            expired_subscriptions = self.db.get_expired_subscriptions()
-            
-            for subscription in expired_subscriptions:
-                user_id = subscription['user_id']
+            processed = 0
+            while True:
+                expired_subscriptions = await self.db.claim_expired_subscriptions(batch_size)
+                if not expired_subscriptions:
+                    break
+                
+                # У пользователя есть другая действующая подписка - доступ не трогаем
+                done = [subscription for subscription in expired_subscriptions if subscription.renewed]
                 
-                # Попытка автоплатежа
-                success = await self._try_auto_payment(user_id)
+                async def revoke(subscription):
+                    await self._process_expired_subscription(subscription.user_id)
+                    done.append(subscription)
                 
-                if not success:
-                    # Если автоплатеж неудачен, удаляем из канала
-                    await self._remove_user_from_channel(user_id)
-                    await self._notify_user_subscription_expired(user_id)
-                    
-                    # Деактивируем подписку в БД
-                    self.db.deactivate_subscription(user_id)
-                    
-                    self.logger.info(f"Подписка пользователя {user_id} истекла и деактивирована")
-                else:
-                    self.logger.info(f"Автоплатеж для пользователя {user_id} успешен")
+                try:
+                    # Число одновременных вызовов Bot API ограничивает self.pacer
+                    # (SubscriptionManager фоновой проверки создается с ним)
+                    results = await asyncio.gather(*(
+                        revoke(subscription)
+                        for subscription in expired_subscriptions
+                        if not subscription.renewed
+                    ), return_exceptions=True)
+                    for result in results:
+                        if isinstance(result, BaseException):
+                            self.logger.error(f"Ошибка отзыва доступа по истекшей подписке: {result!r}")
+                finally:
+                    await self.db.finish_expired_subscriptions(done)
+                    if len(done) < len(expired_subscriptions):
+                        finished = {subscription.user_id for subscription in done}
+                        await self.db.release_expiring_subscriptions([
+                            subscription for subscription in expired_subscriptions
+                            if subscription.user_id not in finished
+                        ])
+                processed += len(done)
+                if len(done) < len(expired_subscriptions):
+                    # Вернувшиеся в очередь подписки не захватываем снова в этой же проверке
+                    break
+            
+            if processed:
+                self.logger.info(f"Обработано истекших подписок: {processed}")
         
         except Exception as e:
             self.logger.error(f"Ошибка при проверке подписок: {e}")
     
-    async def _try_auto_payment(self, user_id: int) -> bool:
-        """Попытка автоплатежа"""
+    async def _process_expired_subscription(self, user_id: int):
+        """Отзыв доступа для одного пользователя с истекшей подпиской.
+        Автоплатеж к этому моменту уже не прошел: продление выполняет RenewalEngine до end_date.
+        Оплата после захвата подписки возвращает ее в is_active = 1 (activate_payment),
+        поэтому перед отзывом доступа подписка проверяется еще раз"""
         try:
-            # Здесь должна быть логика получения сохраненного способа оплаты
-            
-            if isinstance(self.payment_system, YooKassaPayment):
-                # Для реальной ЮKassa нужно сохранять payment_method_id после первой оплаты
-                # payment_method_id = self._get_saved_payment_method(user_id)
-                # if payment_method_id:
-                #     result = self.payment_system.charge_saved_payment_method(
-                #         payment_method_id, 100000, user_id
-                #     )
-                #     return result and result.get('status') == 'succeeded'
-                return False  # Пока не реализовано
-            
-            elif isinstance(self.payment_system, RobokassaPayment):
-                # Для Робокассы рекуррентные платежи требуют отдельного сервиса "Робокасса Рекуррент"
-                # payment_method_id = self._get_saved_payment_method(user_id)
-                # if payment_method_id:
-                #     result = self.payment_system.charge_saved_payment_method(
-                #         payment_method_id, 100000, user_id
-                #     )
-                #     return result and result.get('status') == 'succeeded'
-                return False  # Пока не реализовано
-            
-            elif isinstance(self.payment_system, MockPaymentSystem):
-                # Имитация автоплатежа
-                payment = self.payment_system.create_payment(100000, "Автоплатеж", user_id)
-                # Автоматически помечаем как успешный для тестирования
-                self.payment_system.simulate_successful_payment(payment['id'])
-                return True
+            if await self.db.get_user_subscription(user_id) is not None:
+                self.logger.info(f"Подписка пользователя {user_id} продлена после истечения, доступ сохранен")
+                return
             
-            return False
+            await self._remove_user_from_channel(user_id)
+            if await self.db.get_user_subscription(user_id) is not None:
+                # Оплата пришла, пока пользователя удаляли: выдаем новую ссылку вместо уведомления
+                await self.add_user_to_channel(user_id)
+                self.logger.info(f"Подписка пользователя {user_id} продлена во время отзыва доступа")
+                return
+            await self._notify_user_subscription_expired(user_id)
             
+            self.logger.info(f"Подписка пользователя {user_id} истекла и деактивирована")
+        
         except Exception as e:
-            self.logger.error(f"Ошибка автоплатежа для пользователя {user_id}: {e}")
-            return False
+            self.logger.error(f"Ошибка обработки истекшей подписки пользователя {user_id}: {e}")
     
     async def _remove_user_from_channel(self, user_id: int):
         """Удаление пользователя из платного канала"""
         try:
-            await self.bot.ban_chat_member(
+            await self._paced(
+                self.bot.ban_chat_member,
                 chat_id=self.paid_channel_id,  # Используем chat_id напрямую
                 user_id=user_id
             )
             # Сразу разбаниваем, чтобы пользователь мог снова подписаться
-            await self.bot.unban_chat_member(
+            await self._paced(
+                self.bot.unban_chat_member,
                 chat_id=self.paid_channel_id,
                 user_id=user_id
             )
@@ -105,7 +135,7 @@ class SubscriptionManager:
 
 Нажмите /start чтобы оформить новую подписку."""
             
-            await self.bot.send_message(chat_id=user_id, text=message)
+            await self._paced(self.bot.send_message, chat_id=user_id, text=message)
             
         except TelegramError as e:
             self.logger.error(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
@@ -135,6 +165,58 @@ class SubscriptionManager:
             self.logger.error(f"Ошибка добавления пользователя {user_id} в канал: {e}")
             return False
     
+    async def activate_payment(self, payment_id: str, payment_info: Optional[dict] = None) -> Optional[bool]:
+        """Обработка успешного платежа: подписка создается или продлевается ровно один раз.
+        payment_info - ответ платежной системы, из него сохраняется способ оплаты для автопродления.
+        None - платеж не найден или уже был обработан ранее, иначе - удалось ли выдать доступ к каналу"""
+        subscription = await self.db.activate_payment(payment_id)
+        if subscription is None:
+            return None
+        
+        user_id = subscription.user_id
+        payment_method = (payment_info or {}).get('payment_method') or {}
+        if payment_method.get('saved') and payment_method.get('id'):
+            await self.db.save_payment_method(user_id, str(payment_method['id']))
+        
+        # Продлена подписка, которая еще действовала: пользователь уже в канале
+        previous_end = subscription.end_date - SUBSCRIPTION_DAYS * 86400
+        if subscription.payment_id != payment_id and previous_end > time.time():
+            self.logger.info(f"Платеж {payment_id} продлил подписку пользователя {user_id}")
+            await self._notify_user_subscription_renewed(user_id, subscription.end_date)
+            return True
+        
+        self.logger.info(f"Платеж {payment_id} активировал подписку пользователя {user_id}")
+        return await self.add_user_to_channel(user_id)
+    
+    async def _notify_user_subscription_renewed(self, user_id: int, end_date: int):
+        """Уведомление пользователя о продлении подписки"""
+        try:
+            end = datetime.datetime.fromtimestamp(end_date).strftime('%d.%m.%Y')
+            await self.bot.send_message(
+                chat_id=user_id,
+                text=f"✅ Подписка продлена до {end}. Спасибо, что остаетесь с нами!"
+            )
+        
+        except TelegramError as e:
+            self.logger.error(f"Ошибка отправки уведомления о продлении пользователю {user_id}: {e}")
+    
+    async def notify_renewal_failed(self, user_id: int, final: bool):
+        """Уведомление пользователя о неудачном автоплатеже"""
+        try:
+            if final:
+                message = """⚠️ Не удалось списать оплату за продление подписки.
+
+Автоматических попыток больше не будет. Чтобы сохранить доступ к каналу, оплатите подписку вручную после ее окончания через /start."""
+            else:
+                message = """⚠️ Не удалось списать оплату за продление подписки.
+
+Мы попробуем еще раз позже. Проверьте, что на карте достаточно средств."""
+            
+            await self._paced(self.bot.send_message, chat_id=user_id, text=message)
+        
+        except TelegramError as e:
+            self.logger.error(f"Ошибка отправки уведомления об автоплатеже пользователю {user_id}: {e}")
+    
     async def notify_subscription_expiring_soon(self, days_before: int = 3):
         """Уведомление о скором истечении подписки"""
         try:
@@ -165,14 +247,20 @@ class SubscriptionManager:
             self.logger.error(f"Ошибка отправки уведомления о скором истечении пользователю {user_id}: {e}")
 
 
-async def run_subscription_checker(subscription_manager: SubscriptionManager):
-    """Фоновая задача для проверки подписок"""
-    while True:
-        try:
-            await subscription_manager.check_and_process_expired_subscriptions()
-            # Проверяем каждый час
-            await asyncio.sleep(3600)
-            
-        except Exception as e:
-            logging.error(f"Ошибка в фоновой задаче проверки подписок: {e}")
-            await asyncio.sleep(300)  # При ошибке ждем 5 минут
+async def run_subscription_checker(subscription_manager: SubscriptionManager, reconcile_interval: float = 6 * 3600):
+    """Фоновая задача для проверки подписок: обработка в момент истечения и периодическая сверка"""
+    # Подписки, захваченные до перезапуска, но не обработанные, возвращаем в очередь
+    try:
+        released = await subscription_manager.db.release_expiring_subscriptions()
+        if released:
+            logging.info(f"Возвращено в обработку прерванных подписок: {released}")
+    except Exception as e:
+        logging.error(f"Ошибка восстановления прерванной проверки подписок: {e}")
+    
+    scheduler = ExpiryScheduler(
+        subscription_manager.db,
+        subscription_manager.check_and_process_expired_subscriptions,
+        reconcile_interval
+    )
+    subscription_manager.db.add_subscription_listener(scheduler.on_subscription_changed)
+    await scheduler.run()
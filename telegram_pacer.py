@@ -0,0 +1,41 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from telegram.error import RetryAfter
+
+from resilience import RateLimiter
+
+
+class TelegramPacer:
+    """Общий темп исходящих вызовов Bot API (рассылки, отзыв доступа, уведомления).
+
+    Лимит Telegram общий для всего бота (около 30 вызовов в секунду), поэтому
+    все фоновые задачи, вызывающие Bot API, используют один экземпляр: не больше
+    rate вызовов в секунду и не больше concurrency одновременно. RetryAfter
+    приостанавливает выдачу разрешений всем вызывающим на указанное Telegram
+    время, после чего вызов повторяется (до max_retries раз); остальные ошибки
+    передаются вызывающему."""
+
+    def __init__(self, rate: float = 25.0, concurrency: int = 16, max_retries: int = 5):
+        self.limiter = RateLimiter(rate)
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.logger = logging.getLogger(__name__)
+
+        self.stats = {'calls': 0, 'retry_after': 0}
+
+    async def call(self, method: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Вызов метода Bot API в общем темпе"""
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                await self.limiter.acquire()
+                self.stats['calls'] += 1
+                try:
+                    return await method(*args, **kwargs)
+                except RetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.stats['retry_after'] += 1
+                    self.logger.warning(f"Telegram просит подождать {e.retry_after} с, вызовы Bot API приостановлены")
+                    self.limiter.pause(e.retry_after)
@@ -0,0 +1,142 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+import sys
+from typing import Any, Awaitable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+from http_server import HTTPServer, HTTPRequest, HTTPResponse
+
+# Типы обновлений, для которых у бота есть обработчики (команды и нажатия кнопок)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей.
+
+    Не больше max_concurrent_updates обновлений одновременно, но обновления
+    одного пользователя выполняются строго по очереди, в порядке поступления:
+    медленный вызов провайдера у одного пользователя не задерживает остальных,
+    а повторные нажатия одного пользователя не обгоняют друг друга.
+
+    BaseUpdateProcessor.process_update берет свой семафор до do_process_update,
+    и обновление, ждущее своего пользователя, занимало бы место в лимите. Поэтому
+    семафор базового класса создается без ограничения, а лимит соблюдается здесь,
+    после блокировки пользователя: ожидающие нажатия мест не занимают."""
+
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        super().__init__(sys.maxsize)
+        self._max_concurrent_updates = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: Dict[int, List] = {}  # ключ -> [asyncio.Lock, число ожидающих]
+
+    @staticmethod
+    def ordering_key(update: object) -> Optional[int]:
+        """Ключ упорядочивания: пользователь, иначе чат"""
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return update.effective_user.id
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.ordering_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class TelegramWebhook:
+    """Прием обновлений Telegram через HTTPServer вместо long polling.
+
+    Telegram присылает секрет в заголовке X-Telegram-Bot-Api-Secret-Token,
+    запросы без него отклоняются. Если секрет не задан, он генерируется при
+    каждом запуске: вебхук все равно переустанавливается в run(). Обновление
+    кладется в очередь приложения, и ответ 200 уходит сразу, не дожидаясь обработки."""
+
+    def __init__(self, application: Application, url: str, secret_token: Optional[str] = None):
+        self.application = application
+        self.url = url
+        self.path = urlsplit(url).path or '/telegram'
+        # Допустимые символы секрета: A-Z, a-z, 0-9, _ и -
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self.logger = logging.getLogger(__name__)
+
+        self.stats = {'received': 0, 'rejected': 0}
+
+    def register(self, server: HTTPServer):
+        server.add_route('POST', self.path, self.handle)
+
+    async def handle(self, request: HTTPRequest) -> HTTPResponse:
+        token = request.headers.get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            self.stats['rejected'] += 1
+            return HTTPResponse(403, 'Forbidden')
+        try:
+            update = Update.de_json(request.json(), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            self.logger.warning(f"Некорректное обновление Telegram: {e}")
+            return HTTPResponse(400, 'Bad Request')
+        if update is None:
+            return HTTPResponse(400, 'Bad Request')
+        self.stats['received'] += 1
+        await self.application.update_queue.put(update)
+        return HTTPResponse(200, 'OK')
+
+    async def run(self, max_connections: int = 40):
+        """Жизненный цикл приложения в режиме вебхука (аналог Application.run_polling).
+        HTTP-сервер с маршрутом register() запускается в post_init приложения"""
+        application = self.application
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        await application.initialize()
+        try:
+            if application.post_init is not None:
+                await application.post_init(application)
+            await application.bot.set_webhook(
+                self.url,
+                secret_token=self.secret_token,
+                allowed_updates=ALLOWED_UPDATES,
+                max_connections=max_connections
+            )
+            await application.start()
+            self.logger.info(f"Обновления Telegram принимаются на {self.path}")
+            await stop.wait()
+            await application.stop()
+            if application.post_stop is not None:
+                await application.post_stop(application)
+        finally:
+            await application.shutdown()
+            if application.post_shutdown is not None:
+                await application.post_shutdown(application)
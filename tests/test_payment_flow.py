@@ -0,0 +1,192 @@
+import asyncio
+import time
+
+import pytest
+
+from async_database import AsyncDatabase
+from database import Database
+from http_server import HTTPResponse, HTTPServer
+from payment_intents import PaymentIntents
+from payment_simulator import ProviderStandIn, SimulatedPaymentSystem
+from payment_system import YooKassaPayment
+from payment_webhooks import PaymentWebhookHandler
+from resilience import CLOSED, OPEN, CircuitBreaker, ProviderUnavailableError, ResiliencePolicy, RetryBudget
+from subscription_manager import SubscriptionManager
+
+USER_ID = 42
+AMOUNT = 100000
+
+
+class FakeBot:
+    """Bot API без сети: запоминает отправленные сообщения"""
+
+    class InviteLink:
+        invite_link = 'https://t.me/+invite'
+
+    def __init__(self):
+        self.messages = []
+
+    async def create_chat_invite_link(self, **kwargs):
+        return self.InviteLink()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+
+class RecordingStandIn(ProviderStandIn):
+    """Стенд ЮKassa на свободном порту. Запоминает ключи идемпотентности запросов
+    на создание платежа; первые lost_responses созданий выполняются, но ответ
+    задерживается на lost_delay секунд (клиент успевает отвалиться по таймауту).
+    Пока failing, все запросы получают 500"""
+
+    def __init__(self, simulator: SimulatedPaymentSystem, lost_responses: int = 0, lost_delay: float = 1.0):
+        super().__init__(simulator, port=0)
+        self.lost_responses = lost_responses
+        self.lost_delay = lost_delay
+        self.failing = False
+        self.requests = 0
+        self.keys = []
+
+    async def _fault_response(self, operation):
+        self.requests += 1
+        if self.failing:
+            return HTTPResponse.json({'type': 'error', 'code': 'internal_server_error'}, status=500)
+        return await super()._fault_response(operation)
+
+    async def yookassa_create(self, request):
+        self.keys.append(request.headers.get('idempotence-key'))
+        response = await super().yookassa_create(request)
+        if self.lost_responses > 0:
+            self.lost_responses -= 1
+            await asyncio.sleep(self.lost_delay)
+        return response
+
+
+class Provider:
+    """БД бота, стенд ЮKassa и настоящий клиент YooKassaPayment, направленный на стенд"""
+
+    def __init__(self, tmp_path, lost_responses: int = 0, success_delay: float = 3600.0):
+        self.db = AsyncDatabase(Database(str(tmp_path / 'bot.db')))
+        self.simulator = SimulatedPaymentSystem(latency=0, success_delay=success_delay, seed=1)
+        self.stand_in = RecordingStandIn(self.simulator, lost_responses)
+        self.client = None
+
+    async def __aenter__(self):
+        await self.stand_in.start()
+        self.client = YooKassaPayment('shop', 'secret', api_url=f"http://127.0.0.1:{self.stand_in.server.bound_port}/v3")
+        await self.db.add_user(USER_ID)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        await self.stand_in.stop()
+        await self.db.close()
+
+
+async def wait_until(condition, timeout: float = 5.0):
+    """Ожидание, пока асинхронное условие не станет истинным"""
+    deadline = time.monotonic() + timeout
+    while not await condition():
+        assert time.monotonic() < deadline, "условие не выполнилось за отведенное время"
+        await asyncio.sleep(0.02)
+
+
+def test_create_webhook_activate(tmp_path):
+    async def scenario():
+        async with Provider(tmp_path, success_delay=0.1) as provider:
+            bot = FakeBot()
+            manager = SubscriptionManager(bot, provider.db, provider.client, '-100')
+            handler = PaymentWebhookHandler(provider.client, manager.activate_payment)
+            bot_server = HTTPServer('127.0.0.1', 0)
+            handler.register(bot_server)
+            await bot_server.start()
+            provider.simulator.webhook_url = f"http://127.0.0.1:{bot_server.bound_port}/yookassa/notifications"
+            try:
+                intent = await PaymentIntents(provider.db, provider.client).get_or_create(USER_ID, AMOUNT, "Подписка")
+                assert intent is not None and not intent.reused
+
+                # Стенд проводит оплату и сам отправляет уведомление на сервер бота
+                async def subscribed():
+                    return await provider.db.get_user_subscription(USER_ID) is not None
+
+                await wait_until(subscribed)
+                assert (await provider.db.get_payment(intent.payment_id)).status == 'paid'
+                assert handler.stats['activated'] == 1
+                assert [chat_id for chat_id, _ in bot.messages] == [USER_ID]
+
+                # Повторная доставка того же уведомления не активирует платеж второй раз
+                payment = provider.simulator.payments[intent.payment_id]
+                await provider.simulator._send_webhook(payment['id'])
+                assert handler.stats['duplicates'] == 1
+                assert handler.stats['activated'] == 1
+                assert len(bot.messages) == 1
+            finally:
+                await bot_server.stop()
+
+    asyncio.run(scenario())
+
+
+def test_lost_response_is_retried_with_the_same_key(tmp_path):
+    async def scenario():
+        async with Provider(tmp_path, lost_responses=1) as provider:
+            provider.client.read_timeout = 0.2
+            intent = await PaymentIntents(provider.db, provider.client).get_or_create(USER_ID, AMOUNT, "Подписка")
+            return intent, provider.stand_in.keys, list(provider.simulator.payments)
+
+    intent, keys, payments = asyncio.run(scenario())
+
+    # Первый ответ потерян по таймауту, повтор ResiliencePolicy идет с тем же ключом
+    assert len(keys) == 2
+    assert keys[0] == keys[1]
+    assert payments == [intent.payment_id]
+
+
+def test_unavailable_provider_keeps_the_key_for_the_next_attempt(tmp_path):
+    async def scenario():
+        async with Provider(tmp_path, lost_responses=3) as provider:
+            provider.client.read_timeout = 0.2
+            intents = PaymentIntents(provider.db, provider.client)
+            # Все попытки первого нажатия теряют ответ, но платеж у провайдера создан
+            with pytest.raises(ProviderUnavailableError):
+                await intents.get_or_create(USER_ID, AMOUNT, "Подписка")
+            intent = await intents.get_or_create(USER_ID, AMOUNT, "Подписка")
+            return intent, provider.stand_in.keys, list(provider.simulator.payments)
+
+    intent, keys, payments = asyncio.run(scenario())
+
+    assert len(keys) == 4
+    assert len(set(keys)) == 1
+    assert payments == [intent.payment_id]
+
+
+def test_circuit_breaker_opens_and_closes(tmp_path):
+    async def scenario():
+        async with Provider(tmp_path) as provider:
+            client = provider.client
+            stand_in = provider.stand_in
+            breaker = CircuitBreaker('yookassa', failure_rate=0.5, min_calls=4, open_timeout=0.3)
+            client._resilience = ResiliencePolicy('yookassa', breaker, RetryBudget(ratio=0, min_retries=0))
+            payment = await client.create_payment(AMOUNT, "Подписка", USER_ID)
+
+            # Вместе с успешным созданием платежа - 4 вызова, из них 3 с ошибкой
+            stand_in.failing = True
+            for _ in range(2):
+                assert await client.check_payment_status(payment['id']) is None
+                assert breaker.state == CLOSED
+            assert await client.check_payment_status(payment['id']) is None
+            assert breaker.state == OPEN
+
+            # Разомкнутая цепь отклоняет вызовы, не обращаясь к провайдеру
+            requests = stand_in.requests
+            with pytest.raises(ProviderUnavailableError):
+                await client.check_payment_status(payment['id'])
+            assert stand_in.requests == requests
+
+            # После open_timeout пробный вызов проходит и замыкает цепь
+            stand_in.failing = False
+            await asyncio.sleep(0.35)
+            status = await client.check_payment_status(payment['id'])
+            assert status['id'] == payment['id']
+            assert breaker.state == CLOSED
+
+    asyncio.run(scenario())
@@ -0,0 +1,163 @@
+import asyncio
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from http_server import HTTPResponse, HTTPServer
+from payment_system import RobokassaPayment, parse_op_state
+from resilience import ProviderUnavailableError
+
+HEADER = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<OperationStateResponse xmlns="http://merchant.roboxchange.com/WebService/">'
+    '<Result><Code>0</Code></Result>'
+    '<State><Code>100</Code><RequestDate>2024-01-01T00:00:00</RequestDate></State>'
+)
+INFO = '<Info><IncCurrLabel>BankCard</IncCurrLabel><OutSum>1000.00</OutSum></Info>'
+FOOTER = '</OperationStateResponse>'
+# Ответ с длинным хвостом после Info: разбор должен остановиться, не дочитывая его
+PADDING = '<!--' + 'x' * 64 * 1024 + '-->'
+LONG_TAIL = 200
+
+
+def parse(body: str, chunk_size: int = 16):
+    async def chunks():
+        data = body.encode()
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    return asyncio.run(parse_op_state(chunks()))
+
+
+def test_parse_normal_response():
+    assert parse(HEADER + INFO + FOOTER) == (0, 100, '1000.00')
+
+
+def test_parse_error_result_code():
+    body = '<OperationStateResponse><Result><Code>3</Code></Result></OperationStateResponse>'
+    assert parse(body) == (3, None, None)
+
+
+def test_parse_truncated_response():
+    with pytest.raises(ET.ParseError):
+        parse(HEADER[:-20])
+
+
+def test_parse_non_xml_body():
+    with pytest.raises(ET.ParseError):
+        parse('Internal Server Error: database is locked')
+
+
+def test_parse_stops_after_state():
+    consumed = []
+    closed = []
+
+    async def chunks():
+        try:
+            yield (HEADER + INFO).encode()
+            for _ in range(LONG_TAIL):
+                consumed.append(1)
+                yield PADDING.encode()
+            yield FOOTER.encode()
+        finally:
+            closed.append(True)
+
+    async def scenario():
+        stream = chunks()
+        result = await parse_op_state(stream)
+        await stream.aclose()
+        return result
+
+    assert asyncio.run(scenario()) == (0, 100, '1000.00')
+    assert consumed == []
+    assert closed == [True]
+
+
+class OpStateServer:
+    """Сервер OpState с заданным телом ответа"""
+
+    def __init__(self, body: str, status: int = 200):
+        self.body = body
+        self.status = status
+        self.requests = 0
+        self.server = HTTPServer('127.0.0.1', 0)
+        self.server.add_route('GET', '/Service.asmx/OpState', self.op_state)
+
+    async def op_state(self, request):
+        self.requests += 1
+        return HTTPResponse(self.status, self.body, 'text/xml; charset=utf-8')
+
+
+async def invoice_numbers(user_id: int, idempotency_key: str) -> int:
+    return 1
+
+
+def busy_connections(client: RobokassaPayment) -> int:
+    """Соединения пула httpx, занятые незакрытыми ответами"""
+    return sum(not connection.is_idle() for connection in client._client._transport._pool.connections)
+
+
+def check_status(body: str, status: int = 200, calls: int = 1, max_connections: int = 20):
+    """Проверка статуса счета настоящим клиентом Робокассы; возвращает результаты
+    calls проверок подряд (с числом занятых соединений после каждой) и число запросов,
+    дошедших до сервера"""
+    async def scenario():
+        server = OpStateServer(body, status)
+        await server.server.start()
+        client = RobokassaPayment(
+            'shop', 'password1', 'password2',
+            api_url=f"http://127.0.0.1:{server.server.bound_port}/Service.asmx",
+            invoice_numbers=invoice_numbers
+        )
+        client.max_connections = max_connections
+        client.read_timeout = 2.0
+        results = []
+        try:
+            for _ in range(calls):
+                try:
+                    result = await client.check_payment_status('1')
+                except ProviderUnavailableError as e:
+                    result = e
+                results.append((result, busy_connections(client)))
+        finally:
+            await client.aclose()
+            await server.server.stop()
+        return results, server.requests
+
+    return asyncio.run(scenario())
+
+
+def test_check_status_normal_response():
+    results, requests = check_status(HEADER + INFO + FOOTER)
+    assert results == [({'id': '1', 'status': 'succeeded', 'amount': 100000}, 0)]
+    assert requests == 1
+
+
+def test_check_status_truncated_response_is_a_provider_failure():
+    results, requests = check_status(HEADER[:-20])
+    result, busy = results[0]
+    assert isinstance(result, ProviderUnavailableError)
+    assert busy == 0
+    # Оборванный ответ - сбой провайдера: запрос идемпотентный и повторяется
+    assert requests > 1
+
+
+def test_check_status_non_xml_body_is_a_provider_failure():
+    results, _ = check_status('<html><body>Bad Gateway</body>')
+    result, busy = results[0]
+    assert isinstance(result, ProviderUnavailableError)
+    assert busy == 0
+
+
+def test_check_status_http_error():
+    results, requests = check_status('Not Found', status=404)
+    assert results == [(None, 0)]
+    assert requests == 1
+
+
+def test_early_break_releases_the_connection():
+    # Ответ бросается после Info, не дочитанный хвост не держит соединение:
+    # с одним соединением в пуле все проверки проходят без ожидания
+    results, requests = check_status(HEADER + INFO + PADDING * LONG_TAIL + FOOTER, calls=3, max_connections=1)
+    assert [(result['status'], busy) for result, busy in results] == [('succeeded', 0)] * 3
+    assert requests == 3
@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+
+from telegram_pacer import TelegramPacer
+
+
+class FloodedMethod:
+    """Метод Bot API под flood control: после первого вызова в течение
+    retry_after секунд (или всегда при forever) отвечает RetryAfter"""
+
+    def __init__(self, retry_after: float, forever: bool = False):
+        self.retry_after = retry_after
+        self.forever = forever
+        self.flood_until = None
+        self.calls = 0
+
+    async def __call__(self, **kwargs):
+        self.calls += 1
+        now = time.monotonic()
+        if self.flood_until is None:
+            self.flood_until = now + self.retry_after
+        if self.forever or now < self.flood_until:
+            await asyncio.sleep(0.01)
+            raise RetryAfter(self.retry_after)
+        return kwargs['chat_id']
+
+
+def test_parallel_retry_after_pauses_once():
+    async def scenario():
+        pacer = TelegramPacer(rate=1000, concurrency=16)
+        method = FloodedMethod(retry_after=0.3)
+        started = time.monotonic()
+        results = await asyncio.gather(*(pacer.call(method, chat_id=i) for i in range(16)))
+        return results, time.monotonic() - started, pacer, method
+
+    results, elapsed, pacer, method = asyncio.run(scenario())
+
+    assert results == list(range(16))
+    assert pacer.stats['retry_after'] > 1
+    assert method.calls == 16 + pacer.stats['retry_after']
+    # Одна общая пауза, а не 16 подряд
+    assert 0.3 <= elapsed < 0.3 * 2
+
+
+def test_retry_after_is_raised_when_retries_are_exhausted():
+    async def scenario():
+        pacer = TelegramPacer(rate=1000, max_retries=1)
+        method = FloodedMethod(retry_after=0.05, forever=True)
+        try:
+            await pacer.call(method, chat_id=1)
+        except RetryAfter:
+            return method.calls
+        return None
+
+    assert asyncio.run(scenario()) == 2
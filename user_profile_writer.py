@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from async_database import AsyncDatabase
+
+Profile = Tuple[Optional[str], Optional[str], Optional[str]]
+
+
+class UserProfileWriter:
+    """Буферизованная запись профилей пользователей.
+
+    Повторные /start с тем же username/именем не доходят до БД: последние записанные
+    профили хранятся в ограниченном LRU. Изменения копятся и сбрасываются одной
+    транзакцией раз в flush_interval секунд или при накоплении max_batch строк."""
+
+    def __init__(self, db: AsyncDatabase, flush_interval: float = 0.5, max_batch: int = 500,
+                 known_size: int = 100_000):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.known_size = known_size
+        self.logger = logging.getLogger(__name__)
+
+        self._known: "OrderedDict[int, Profile]" = OrderedDict()  # Профили, уже записанные в БД
+        self._pending: Dict[int, Profile] = {}  # Изменения, ожидающие записи
+        self._wake: Optional[asyncio.Event] = None  # Создается в start(), внутри цикла событий
+        self._task: Optional[asyncio.Task] = None
+
+        self.stats = {'submitted': 0, 'skipped': 0, 'written': 0, 'flushes': 0}
+
+    def submit(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        """Постановка профиля в очередь на запись (без обращения к БД)"""
+        self.stats['submitted'] += 1
+        profile = (username, first_name, last_name)
+
+        if user_id not in self._pending and self._known.get(user_id) == profile:
+            self._known.move_to_end(user_id)
+            self.stats['skipped'] += 1
+            return
+
+        self._pending[user_id] = profile
+        if len(self._pending) >= self.max_batch and self._wake is not None:
+            self._wake.set()
+
+    def _remember(self, user_id: int, profile: Profile):
+        """Запоминание записанного профиля с вытеснением самых старых"""
+        self._known[user_id] = profile
+        self._known.move_to_end(user_id)
+        while len(self._known) > self.known_size:
+            self._known.popitem(last=False)
+
+    def _requeue(self, batch: Dict[int, Profile]):
+        """Возврат незаписанной пачки в очередь (более свежие изменения не затираются)"""
+        for user_id, profile in batch.items():
+            self._pending.setdefault(user_id, profile)
+
+    async def flush(self):
+        """Запись накопленных изменений одной транзакцией"""
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, {}
+        try:
+            await self.db.upsert_users([(user_id, *profile) for user_id, profile in batch.items()])
+        except asyncio.CancelledError:
+            self._requeue(batch)
+            raise
+        except Exception as e:
+            self.logger.error(f"Ошибка записи профилей пользователей: {e}")
+            self._requeue(batch)
+            return
+
+        for user_id, profile in batch.items():
+            self._remember(user_id, profile)
+        self.stats['written'] += len(batch)
+        self.stats['flushes'] += 1
+
+    async def _run(self):
+        """Фоновый цикл периодического сброса буфера"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self):
+        """Запуск фоновой записи"""
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка фоновой записи с сохранением оставшихся изменений"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
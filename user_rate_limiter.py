@@ -0,0 +1,101 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+# Лимиты по классам действий: (пополнение токенов в секунду, емкость корзины)
+DEFAULT_LIMITS: Dict[str, Tuple[float, int]] = {
+    'payment': (0.2, 3),        # Создание счета: в среднем раз в 5 секунд, до 3 подряд
+    'check_payment': (0.5, 5),  # Проверка оплаты
+    'button': (2.0, 10),        # Шаги воронки и прочие кнопки
+    'command': (1.0, 5),        # Команды и сообщения
+}
+
+THROTTLED_TEXT = "⏳ Слишком часто. Подождите несколько секунд."
+
+
+def action_class(update: Update) -> Optional[str]:
+    """Класс действия обновления для выбора лимита"""
+    query = update.callback_query
+    if query is not None:
+        data = query.data or ''
+        if data == 'payment':
+            return 'payment'
+        if data.startswith('check_payment_'):
+            return 'check_payment'
+        return 'button'
+    if update.message is not None:
+        return 'command'
+    return None
+
+
+class UserRateLimiter:
+    """Ограничение частоты действий пользователя: token bucket на пару (пользователь, класс действия).
+
+    Корзины хранятся в OrderedDict в порядке последнего обращения; корзины,
+    к которым не обращались idle_ttl секунд, удаляются (к этому времени они
+    все равно полностью пополнены), а общее число корзин не превышает
+    max_entries. Устанавливается обработчиком TypeHandler в группе -1:
+    лишние нажатия получают короткий ответ на callback и дальше не идут."""
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[float, int]]] = None,
+                 max_entries: int = 100000, idle_ttl: float = 600.0):
+        self.limits = limits or DEFAULT_LIMITS
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.logger = logging.getLogger(__name__)
+
+        self._buckets: OrderedDict = OrderedDict()  # (user_id, класс) -> [токены, время обновления]
+        self.stats = {'allowed': 0, 'throttled': 0, 'evicted': 0}
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_entries and updated > now - self.idle_ttl:
+                break
+            del self._buckets[key]
+            self.stats['evicted'] += 1
+
+    def allow(self, user_id: int, action: str) -> bool:
+        """Списание одного токена; False - лимит исчерпан"""
+        limit = self.limits.get(action)
+        if limit is None:
+            return True
+        rate, burst = limit
+        now = time.monotonic()
+        key = (user_id, action)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(burst), now]
+            self._evict(now)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self.stats['allowed'] += 1
+            return True
+        self.stats['throttled'] += 1
+        return False
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработчик для TypeHandler(Update, ...) в группе -1"""
+        user = update.effective_user
+        action = action_class(update)
+        if user is None or action is None or self.allow(user.id, action):
+            return
+
+        if update.callback_query is not None:
+            # Ответ на callback убирает "часики" с кнопки и не трогает БД и провайдера
+            try:
+                await update.callback_query.answer(THROTTLED_TEXT)
+            except TelegramError as e:
+                self.logger.debug(f"Не удалось ответить на лишнее нажатие: {e}")
+        raise ApplicationHandlerStop